@@ -29,4 +29,18 @@ NN_ACT_MODEL_PATH = 'checkpoints/model_ckpt_soft_attn_pooled_cosine_drop_ava-130
 NN_BATCH = 4
 
 # Max number of frames in a tube chunk to be processed by DNN
-TUBE_SIZE = 32
\ No newline at end of file
+TUBE_SIZE = 32
+
+# The tubes of the last TUBE_WINDOW frames of a camera are sent to the action
+# detectors every TUBE_STRIDE frames. A stride smaller than the window gives
+# overlapping windows and a lower detection latency (e.g. 32 and 8)
+TUBE_WINDOW = 16
+TUBE_STRIDE = 16
+
+# The NN runs on the last TUBE_SIZE clips of a tube every NN_STRIDE new clips.
+# A stride smaller than TUBE_SIZE runs the NN more often on overlapping clips 
+NN_STRIDE = TUBE_SIZE
+
+# Number of tube images (400x400x3 each) kept in shared memory for the act 
+# processes. Set to 0 to copy the tube images through the queues instead 
+CROP_POOL_SIZE = 512
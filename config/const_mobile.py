@@ -4,6 +4,19 @@ SAVE_DATA = True
 # True if you want to run the pipeline online and upload the data to next hop 
 UPLOAD_DATA = False 
 
+# True if you want to send the frames of each detection batch as one message
+# (DataPktBatch), the next hop must run this version of the network servers
+UPLOAD_BATCH = True
+
+# True if you want to send the frames as keyframes + changed blocks instead of
+# one jpg each (network/frame_codec.py), saves bandwidth for static cameras
+VIDEO_CODEC = False
+
+# True if you want to upload with network/aio_client.py, which reconnects with
+# backoff and limits the pkts in flight with the acks of the next hop. Only
+# works if the next hop runs the asyncio server (ASYNC_INGEST in const_tracker)
+ASYNC_UPLOAD = False
+
 # The uploading FPS, this number should be lower if following nodes are overloaded
 UPLOAD_FPS = 20
 
@@ -19,6 +19,30 @@ LOCAL_ADDR = 'localhost'
 # port for receiving incoming traffic
 LOCAL_PORT = 50051
 
+# True to serve all incoming camera connections with one asyncio event loop
+# (network/aio_server.py) instead of one thread per connection. The mobile 
+# nodes can upload with network/aio_client.py (ASYNC_UPLOAD in const_mobile) 
+# for flow control with acks, or with the default socket client (no acks)
+ASYNC_INGEST = False
+
+# True to forward only the metadata and a reference of each frame to the next 
+# hops, which then fetch the frames (or regions of them) from this node's frame 
+# store when they need them (network/frame_store.py)
+FORWARD_META_ONLY = False
+
+# port of the frame store, and the address the next hops use to reach it
+FRAME_STORE_PORT = 50061
+FRAME_STORE_ADDR = 'localhost:50061'
+
+# The number of frames kept in the frame store, should cover the delay of the
+# following nodes
+FRAME_STORE_SIZE = 2048
+
+# Number of tracker processes the cameras are spread over, with one REID for
+# all of them in the main process (tracker/tracker_worker.py). 0 to track all
+# the cameras in the main process
+TRACKER_WORKERS = 0
+
 # Address of the next hop (i.e. the action node) 
 SERVER_ADDR = 'localhost:50052'
 
@@ -25,14 +25,15 @@ from multiprocessing import Process
 from threading import Thread
 
 import config.const_act as const
-from server.server_packet_manager import ServerPktManager
+from server.server_packet_manager import ServerPktManager, ServerPkt, CROP_IMG_SIZE
 from server.action_spatial import SpatialActDetector
 from server.action_nn import NNActDetector
 from server.action_comp import CompActDetector
 from network.data_writer import DataWriter
 from network.socket_client import NetClient
 from network.socket_server import NetServer
-from network.utils import Q
+from network.frame_pool import FramePool
+from network.utils import Q, POLICY_BLOCK, READ_TIMEOUT
 
 
 """
@@ -53,6 +54,7 @@ def main(running):
         address=const.LOCAL_ADDR,
         port=const.LOCAL_PORT,
         buffer_size=const.QUEUE_SIZE,
+        split_batches=False,    # ServerPktManager takes whole batches
     )
     server_proc = Process(target=server.run)
     server_proc.start()
@@ -68,10 +70,19 @@ def main(running):
 
     data_savers = {}
 
-    tube_queue = Q(const.QUEUE_SIZE)
-    act_spatial_queue = Q(const.QUEUE_SIZE)
-    act_nn_queue = Q(const.QUEUE_SIZE)
-    act_comp_queue = Q(const.QUEUE_SIZE)
+    # tube imgs are shared by the act processes through this pool
+    crop_pool = None
+    if const.CROP_POOL_SIZE > 0:
+        crop_pool = FramePool(
+            slot_num=const.CROP_POOL_SIZE,
+            frame_shape=CROP_IMG_SIZE[::-1] + (3,),
+        )
+
+    # stages wait for the next one instead of dropping chunks 
+    tube_queue = Q(const.QUEUE_SIZE, policy=POLICY_BLOCK, on_drop=ServerPkt.release)
+    act_spatial_queue = Q(const.QUEUE_SIZE, policy=POLICY_BLOCK, on_drop=ServerPkt.release)
+    act_nn_queue = Q(const.QUEUE_SIZE, policy=POLICY_BLOCK, on_drop=ServerPkt.release)
+    act_comp_queue = Q(const.QUEUE_SIZE, policy=POLICY_BLOCK, on_drop=ServerPkt.release)
     filter_queue = Q(const.QUEUE_SIZE)
 
     tm = ServerPktManager(
@@ -79,6 +90,9 @@ def main(running):
         out_queue=tube_queue,
         track_list=const.TRACK_LABELS,
         overlap_list=const.ATTACH_LABELS,
+        max_tube_size=const.TUBE_WINDOW,
+        stride=const.TUBE_STRIDE,
+        crop_pool=crop_pool,
     )
     tm_proc = Thread(target=tm.run)
     tm_proc.deamon = True
@@ -87,6 +101,7 @@ def main(running):
     spatial_act = SpatialActDetector(
         in_queue = tube_queue,
         out_queue=act_spatial_queue,
+        crop_pool=crop_pool,
     )
     spatial_proc = Process(target=spatial_act.run)
     spatial_proc.deamon = True
@@ -99,6 +114,8 @@ def main(running):
         batch_size=const.NN_BATCH,
         tube_size=const.TUBE_SIZE,
         filter_queue=filter_queue,
+        crop_pool=crop_pool,
+        stride=const.NN_STRIDE,
     )
     nn_act_proc = Process(target=nn_act.run)
     nn_act_proc.deamon = True
@@ -109,6 +126,7 @@ def main(running):
         in_queue=act_nn_queue,
         out_queue=act_comp_queue,
         filter_queue=filter_queue,
+        crop_pool=crop_pool,
     )
     comp_act_proc = Process(target=comp_act.run)
     comp_act_proc.deamon = True
@@ -119,9 +137,8 @@ def main(running):
     print('server starts')
 
     while running[0]:
-        server_pkt = out_queue.read()
+        server_pkt = out_queue.read(block=True, timeout=READ_TIMEOUT)
         if server_pkt is None:
-            sleep(0.01)
             continue
 
         cid = server_pkt.cam_id
@@ -144,11 +161,15 @@ def main(running):
             if const.SAVE_DATA:
                 data_savers[cid].save_data(frame_id=p.frame_id, meta=p.meta)
 
+        server_pkt.release()
+
     if const.SAVE_DATA:
         for cid in data_savers:
             data_savers[cid].save_to_file()
 
     server.stop()
+    if crop_pool is not None:
+        crop_pool.close()
     print("server finished!")
 
 
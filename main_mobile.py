@@ -23,7 +23,8 @@ import config.const_mobile as const
 from network.data_reader import DataReader
 from network.data_writer import DataWriter
 from network.socket_client import NetClient
-from network.data_packet import DataPkt
+from network.aio_client import NetClient as AioNetClient
+from network.data_packet import DataPkt, DataPktBatch
 
 
 """
@@ -61,10 +62,17 @@ def main(running):
     else:
         raise ValueError("Model not implemented!")
 
-    uploader = NetClient(
+    # with UPLOAD_BATCH each queued item holds OBJ_BATCH_SIZE frames
+    upload_queue_size = const.QUEUE_SIZE
+    if const.UPLOAD_BATCH:
+        upload_queue_size = max(1, const.QUEUE_SIZE // const.OBJ_BATCH_SIZE)
+
+    client_class = AioNetClient if const.ASYNC_UPLOAD else NetClient
+    uploader = client_class(
         client_name=const.CLIENT_NAME,
         server_addr=const.SERVER_ADDR,
-        buffer_size=const.QUEUE_SIZE,
+        buffer_size=upload_queue_size,
+        video_codec=const.VIDEO_CODEC,
     )
 
     if const.UPLOAD_DATA:
@@ -108,6 +116,7 @@ def main(running):
         )
 
         H, W, _ = img.shape
+        batch = DataPktBatch()
         for i in range(const.OBJ_BATCH_SIZE):
             meta = []
             for j in range(len(boxes[i])):
@@ -127,7 +136,10 @@ def main(running):
             )
 
             if const.UPLOAD_DATA:
-                uploader.send_data(pkt)
+                if const.UPLOAD_BATCH:
+                    batch.pkts.append(pkt)
+                else:
+                    uploader.send_data(pkt)
 
             if const.SAVE_DATA:
                 data_saver.save_data(
@@ -135,6 +147,9 @@ def main(running):
                     meta=pkt.meta,
                 )
 
+        if const.UPLOAD_DATA and const.UPLOAD_BATCH:
+            uploader.send_data(batch)
+
         time_past = time() - timer2
         sleep_time = max(0, time_gap - time_past)
         sleep(sleep_time)
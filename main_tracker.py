@@ -28,10 +28,13 @@ import config.const_tracker as const
 from tracker.deepsort import DeepSort
 from tracker.feature_extractor import FExtractor
 from tracker.reid import REID
+from tracker.tracker_worker import TrackerWorker, ReidCoordinator, worker_index
 from network.data_writer import DataWriter
-from network.utils import Q
+from network.utils import Q, POLICY_BLOCK, READ_TIMEOUT
 from network.socket_client import NetClient
 from network.socket_server import NetServer
+from network.aio_server import NetServer as AioNetServer
+from network.frame_store import FrameStore, FrameStoreServer, jpeg_shape
 
 
 """
@@ -47,7 +50,8 @@ print('Output to {}'.format(RES_FOLDER))
 Main function
 """
 def main(running):
-    server = NetServer(
+    server_class = AioNetServer if const.ASYNC_INGEST else NetServer
+    server = server_class(
         name='tracker',
         address=const.LOCAL_ADDR,
         port=const.LOCAL_PORT,
@@ -65,7 +69,17 @@ def main(running):
         client_proc = Process(target=client.run)
         client_proc.start()
 
-    feature_queue = Q(const.QUEUE_SIZE)
+    # frames of the forwarded pkts are kept here in metadata-only mode
+    frame_store = None
+    if const.FORWARD_META_ONLY:
+        frame_store = FrameStore(capacity=const.FRAME_STORE_SIZE)
+        FrameStoreServer(
+            store=frame_store,
+            address=const.LOCAL_ADDR,
+            port=const.FRAME_STORE_PORT,
+        ).start()
+
+    feature_queue = Q(const.QUEUE_SIZE, policy=POLICY_BLOCK)
     feature_extractor = FExtractor(
         in_queue=server.data_queue,
         out_queue=feature_queue,
@@ -74,7 +88,31 @@ def main(running):
     tm_proc = Process(target=feature_extractor.run)
     tm_proc.start()
 
-    reid = REID(topo_path=const.TOPO_PATH, img_shape=const.IMG_SHAPE)
+    # sharded mode: cameras are tracked by the workers, the REID runs here
+    workers, worker_procs = [], []
+    if const.TRACKER_WORKERS > 0:
+        event_queue = Q(const.QUEUE_SIZE * const.TRACKER_WORKERS, policy=POLICY_BLOCK)
+        for i in range(const.TRACKER_WORKERS):
+            workers.append(TrackerWorker(
+                index=i,
+                event_queue=event_queue,
+                track_labels=const.TRACK_LABELS,
+                attach_labels=const.ATTACH_LABELS,
+                client=client if const.UPLOAD_DATA else None,
+                res_folder=RES_FOLDER if const.SAVE_DATA else None,
+                queue_size=const.QUEUE_SIZE
+            ))
+            worker_procs.append(Process(target=workers[-1].run))
+            worker_procs[-1].start()
+        coordinator = ReidCoordinator(
+            topo_path=const.TOPO_PATH,
+            img_shape=const.IMG_SHAPE,
+            workers=workers,
+            event_queue=event_queue
+        )
+        coordinator.start()
+    else:
+        reid = REID(topo_path=const.TOPO_PATH, img_shape=const.IMG_SHAPE)
 
     trackers = {}
     data_savers = {}
@@ -82,12 +120,20 @@ def main(running):
 
     cur_time = time()
     while running[0]:
-        pkt = feature_queue.read()
+        pkt = feature_queue.read(block=True, timeout=READ_TIMEOUT)
         if pkt is None:
-            sleep(0.01)
             continue
 
         cid = pkt.cam_id
+        if frame_store is not None and pkt.has_img() and not pkt.is_frame_ref():
+            data = bytes(pkt.img_data)
+            frame_store.put(cid, pkt.frame_id, data)
+            pkt.set_frame_ref(const.FRAME_STORE_ADDR, jpeg_shape(data))
+
+        if workers:
+            workers[worker_index(cid, len(workers))].in_queue.write(pkt)
+            continue
+
         if cid not in trackers:
             trackers[cid] = DeepSort(
                 track_labels=const.TRACK_LABELS, 
@@ -111,6 +157,12 @@ def main(running):
         for cid in data_savers:
             data_savers[cid].save_to_file()
 
+    for w, p in zip(workers, worker_procs):
+        w.stop()
+        p.join()
+    if workers:
+        coordinator.stop()
+
     server.stop()
     print('tracker finished')
 
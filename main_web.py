@@ -24,7 +24,7 @@ from web.code_generator import Generator
 from web.visualizer import Visualizer
 from network.data_writer import DataWriter
 from network.socket_server import NetServer
-from network.utils import Q
+from network.utils import Q, POLICY_DROP_OLDEST, READ_TIMEOUT
 from network.video_manager import VideoWriter
 
 
@@ -59,7 +59,9 @@ def main(running):
     code_generator.run()
 
     web_msg_queue = Q(2)
-    display_queues = {v: Q(const.QUEUE_SIZE) for v in const.CLIENT_NAMES}
+    # show the latest frames if the browser falls behind 
+    display_queues = {v: Q(const.QUEUE_SIZE, policy=POLICY_DROP_OLDEST) 
+                        for v in const.CLIENT_NAMES}
 
     from web.web_server import WebServer
     ip, port = const.WEB_ADDR.split(':')
@@ -85,9 +87,8 @@ def main(running):
         }
 
     while running:
-        d = server.read_data()
+        d = server.read_data(block=True, timeout=READ_TIMEOUT)
         if d is None:
-            sleep(0.01)
             continue
 
         img = d.img
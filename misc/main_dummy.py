@@ -14,11 +14,11 @@ from time import time, sleep
 from multiprocessing import Process
 from threading import Thread
 from network.socket_server import NetServer
+from network.utils import pack_frame, READ_TIMEOUT
 
 
 QUEUE_SIZE = 64 
 LOCAL_NAME = 'dummy'
-HEADER = b'\x00\x00CAESAR\x00\x00'
 
 
 def main(running, address, port, server_addr):
@@ -46,9 +46,8 @@ def main(running, address, port, server_addr):
 
     print('Dummy starts!')
     while running[0]:
-        pkt = server.data_queue.read()
+        pkt = server.data_queue.read(block=True, timeout=READ_TIMEOUT)
         if pkt is None:
-            sleep(0.01)
             continue
 
         print('pkt: %d' % pkt.frame_id)
@@ -57,11 +56,11 @@ def main(running, address, port, server_addr):
             continue 
 
         need_reconnect = False     
-        d = pkt.encode()
+        d = pack_frame(pkt.encode())
 
         while True:
             try:
-                client_socket.send(HEADER + d)
+                client_socket.sendall(d)
                 break 
             except socket.error:
                 print('Cannot send pkt')
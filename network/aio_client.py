@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from network.utils import Q, ACK_HEADER, FRAME_HEADER, READ_TIMEOUT, pack_frame
+from network.frame_codec import StreamEncoder
+
+
+# max number of pkts sent but not acked by the server yet
+MAX_INFLIGHT = 32
+
+# reconnect backoff in seconds, doubled after each failed attempt
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30.
+
+
+class NetClient:
+    def __init__(self, client_name, server_addr, buffer_size, max_inflight=MAX_INFLIGHT,
+                    video_codec=False):
+        ''' Same interface as network/socket_client.NetClient, talks to
+            network/aio_server.NetServer. Reconnects with exponential backoff,
+            and stops sending when max_inflight pkts are not acked yet
+
+        Args:
+        - client_name: identifier of the camera
+        - server_addr: ip:port in str
+        - buffer_size: size of request_queue
+        - max_inflight: flow-control window in pkts
+        - video_codec: send the imgs as keyframes + changed blocks
+            (network/frame_codec.py) instead of one jpg per frame
+        '''
+        self.client_name = client_name
+        self.server_ip = server_addr.split(':')[0]
+        self.server_port = int(server_addr.split(':')[1])
+        self.request_queue = Q(buffer_size)
+        self.max_inflight = max_inflight
+        self.frame_cnt = 0
+        self.img_codec = StreamEncoder() if video_codec else None
+
+        self.pending = None     # pkt taken from the queue but not sent yet
+        # own thread for the blocking queue reads, so that many clients in 
+        # one event loop (run_clients) do not share the default executor 
+        self.executor = None
+        self.running = True
+        self.log('init')
+
+    def log(self, s):
+        logging.info('[AioNetClient-%s]: %s' % (self.client_name, s))
+
+    def send_data(self, pkt):
+        '''
+        Public: send data to rpc queue
+        '''
+        self.request_queue.write(pkt)
+        self.frame_cnt += 1
+
+        if self.frame_cnt % 20 == 0:
+            self.log('Sending pkt %d' % self.frame_cnt)
+
+        if self.request_queue.full():
+            if self.frame_cnt % 10 == 0:
+                self.log('send queue full! %d pkts dropped' % self.dropped())
+            return False
+
+        return True
+
+    def dropped(self):
+        '''
+        Public: number of pkts dropped so far because the send queue was full
+        '''
+        return self.request_queue.drop_count()
+
+    def run(self):
+        '''
+        Keeps running until close()
+        '''
+        asyncio.run(self.connect_loop())
+        self.log('done')
+
+    async def connect_loop(self):
+        backoff = MIN_BACKOFF
+        while self.running:
+            try:
+                reader, writer = await asyncio.open_connection(
+                                            self.server_ip, self.server_port)
+            except OSError as e:
+                self.log('cannot connect to server (%s), retry in %.1fs' % (str(e), backoff))
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+
+            self.log('connected to %s!' % self.server_ip)
+            backoff = MIN_BACKOFF
+            await self.stream(reader, writer)
+
+    async def stream(self, reader, writer):
+        ''' Send pkts over one connection until it breaks
+        '''
+        loop = asyncio.get_running_loop()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        if self.img_codec is not None:
+            self.img_codec.reset()  # new connection, new decoder on the server
+        self.sent, self.acked = 0, 0
+        self.ack_event = asyncio.Event()
+        ack_task = asyncio.ensure_future(self.read_acks(reader))
+
+        try:
+            writer.write(FRAME_HEADER.pack(ACK_HEADER, 0))  # ask for acks
+            while self.running and not ack_task.done():
+                if self.sent - self.acked >= self.max_inflight:
+                    self.ack_event.clear()
+                    try:
+                        await asyncio.wait_for(self.ack_event.wait(), READ_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                if self.pending is None:
+                    self.pending = await loop.run_in_executor(
+                            self.executor, self.request_queue.read, True, READ_TIMEOUT)
+                    if self.pending is None:
+                        continue
+
+                writer.write(pack_frame(self.pending.encode(self.img_codec)))
+                await writer.drain()
+                self.pending = None
+                self.sent += 1
+
+        except (ConnectionError, OSError) as e:
+            self.log('connection lost: %s' % str(e))
+        finally:
+            ack_task.cancel()
+            writer.close()
+
+    async def read_acks(self, reader):
+        try:
+            while True:
+                head = await reader.readexactly(FRAME_HEADER.size)
+                magic, cnt = FRAME_HEADER.unpack(head)
+                if magic != ACK_HEADER:
+                    self.log('bad ack from server')
+                    return
+                self.acked = cnt
+                self.ack_event.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.log('server closed the connection')
+
+    def close(self):
+        self.running = False
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.log('Connection closed')
+
+
+def run_clients(clients):
+    ''' Run several NetClients (e.g. one per camera) in one event loop
+    '''
+    async def _run_all():
+        await asyncio.gather(*[c.connect_loop() for c in clients])
+    asyncio.run(_run_all())
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from network.utils import Q, HEADER, ACK_HEADER, FRAME_HEADER, MAX_FRAME_SIZE
+from network.data_packet import load_pkts
+from network.frame_codec import StreamDecoder
+
+
+# send a flow-control ack to the client after this many pkts
+ACK_EVERY = 4
+
+
+class NetServer:
+    def __init__(self, name, address, port, buffer_size, ack_every=ACK_EVERY,
+                    split_batches=True):
+        ''' Same interface as network/socket_server.NetServer, but all the
+            connections (e.g. one per camera) are served by one asyncio event
+            loop instead of one thread each. Clients must use length-prefixed
+            framing. Acks are only sent to the clients that ask for them
+            (network/aio_client.NetClient), so socket_client.NetClient, which
+            never reads from the socket, does not stall on a full send buffer
+
+        Args:
+        - name: the name of local machine
+        - address, port: where to listen for incoming connections
+        - buffer_size: size of input data queue
+        - ack_every: send an ack to the client every ack_every pkts, if the
+            client asked for acks
+        - split_batches: put the pkts of a received DataPktBatch into the
+            data queue one by one, otherwise the whole batch is one item
+        '''
+        self.name = name
+        self.address = address
+        self.port = port
+        self.ack_every = ack_every
+        self.split_batches = split_batches
+        self.data_queue = Q(buffer_size)
+        self.conn_cnt = 0
+        self.running = True
+
+        self.log('Start running.')
+
+    def run(self):
+        asyncio.run(self.serve())
+        self.log('ended')
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_connection,
+                                            self.address, self.port,
+                                            reuse_address=True)
+        self.log("Waiting for incoming connections...")
+        async with server:
+            while self.running:
+                await asyncio.sleep(1)
+
+    async def handle_connection(self, reader, writer):
+        ip, port = writer.get_extra_info('peername')[:2]
+        self.conn_cnt += 1
+        self.log('Got connection from %s:%d (%d in total)' % (ip, port, self.conn_cnt))
+
+        pkt_cnt = 0
+        send_acks = False
+        img_decoder = StreamDecoder()   # for clients with video_codec
+        try:
+            while True:
+                head = await reader.readexactly(FRAME_HEADER.size)
+                magic, length = FRAME_HEADER.unpack(head)
+                if magic == ACK_HEADER and not pkt_cnt and not send_acks:
+                    send_acks = True    # the client reads the acks
+                    continue
+                if magic != HEADER or length > MAX_FRAME_SIZE:
+                    self.log('Stream from %s:%d out of sync' % (ip, port))
+                    break
+
+                d = await reader.readexactly(length)
+                pkt_cnt += 1
+
+                try:
+                    for pkt in load_pkts(d, self.split_batches):
+                        if img_decoder.decode_pkt(pkt):
+                            self.data_queue.write(pkt)
+                except ValueError as e:
+                    self.log('Drop bad pkt from %s:%d: %s' % (ip, port, str(e)))
+
+                if send_acks and pkt_cnt % self.ack_every == 0:
+                    writer.write(FRAME_HEADER.pack(ACK_HEADER, pkt_cnt))
+                    await writer.drain()
+
+        except asyncio.IncompleteReadError:
+            self.log('Connection from %s:%d ended' % (ip, port))
+        except ConnectionError as e:
+            self.log('Connection from %s:%d lost: %s' % (ip, port, str(e)))
+        finally:
+            self.conn_cnt -= 1
+            writer.close()
+
+    def read_data(self, block=False, timeout=None):
+        return self.data_queue.read(block, timeout)
+
+    def stop(self):
+        self.running = False
+
+    def log(self, s):
+        logging.debug('[AioNetServer] %s' % s)
@@ -19,7 +19,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   package='cas_proto',
   syntax='proto3',
   serialized_options=_b('\n\032io.grpc.examples.cas_protoB\010CASProtoP\001\242\002\003HLW'),
-  serialized_pb=_b('\n\x0f\x63\x61s_proto.proto\x12\tcas_proto\"+\n\rUploadRequest\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x02 \x01(\x0c\"\x1e\n\x0bUploadReply\x12\x0f\n\x07message\x18\x01 \x01(\t2H\n\x08Uploader\x12<\n\x06Upload\x12\x18.cas_proto.UploadRequest\x1a\x16.cas_proto.UploadReply\"\x00\x42.\n\x1aio.grpc.examples.cas_protoB\x08\x43\x41SProtoP\x01\xa2\x02\x03HLWb\x06proto3')
+  serialized_pb=_b('\n\x0f\x63\x61s_proto.proto\x12\tcas_proto\"+\n\rUploadRequest\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x02 \x01(\x0c\"\x1e\n\x0bUploadReply\x12\x0f\n\x07message\x18\x01 \x01(\t2\x90\x01\n\x08Uploader\x12<\n\x06Upload\x12\x18.cas_proto.UploadRequest\x1a\x16.cas_proto.UploadReply\"\x00\x12\x46\n\x0cUploadStream\x12\x18.cas_proto.UploadRequest\x1a\x16.cas_proto.UploadReply\"\x00(\x01\x30\x01\x42.\n\x1aio.grpc.examples.cas_protoB\x08\x43\x41SProtoP\x01\xa2\x02\x03HLWb\x06proto3')
 )
 
 
@@ -120,8 +120,8 @@ _UPLOADER = _descriptor.ServiceDescriptor(
   file=DESCRIPTOR,
   index=0,
   serialized_options=None,
-  serialized_start=107,
-  serialized_end=179,
+  serialized_start=108,
+  serialized_end=252,
   methods=[
   _descriptor.MethodDescriptor(
     name='Upload',
@@ -132,6 +132,15 @@ _UPLOADER = _descriptor.ServiceDescriptor(
     output_type=_UPLOADREPLY,
     serialized_options=None,
   ),
+  _descriptor.MethodDescriptor(
+    name='UploadStream',
+    full_name='cas_proto.Uploader.UploadStream',
+    index=1,
+    containing_service=None,
+    input_type=_UPLOADREQUEST,
+    output_type=_UPLOADREPLY,
+    serialized_options=None,
+  ),
 ])
 _sym_db.RegisterServiceDescriptor(_UPLOADER)
 
@@ -19,6 +19,11 @@ class UploaderStub(object):
         request_serializer=cas__proto__pb2.UploadRequest.SerializeToString,
         response_deserializer=cas__proto__pb2.UploadReply.FromString,
         )
+    self.UploadStream = channel.stream_stream(
+        '/cas_proto.Uploader/UploadStream',
+        request_serializer=cas__proto__pb2.UploadRequest.SerializeToString,
+        response_deserializer=cas__proto__pb2.UploadReply.FromString,
+        )
 
 
 class UploaderServicer(object):
@@ -32,6 +37,14 @@ class UploaderServicer(object):
     context.set_details('Method not implemented!')
     raise NotImplementedError('Method not implemented!')
 
+  def UploadStream(self, request_iterator, context):
+    """Pipelines the frames of one client over a single stream, the replies
+    carry the control messages for that client whenever there are any.
+    """
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
 
 def add_UploaderServicer_to_server(servicer, server):
   rpc_method_handlers = {
@@ -40,6 +53,11 @@ def add_UploaderServicer_to_server(servicer, server):
           request_deserializer=cas__proto__pb2.UploadRequest.FromString,
           response_serializer=cas__proto__pb2.UploadReply.SerializeToString,
       ),
+      'UploadStream': grpc.stream_stream_rpc_method_handler(
+          servicer.UploadStream,
+          request_deserializer=cas__proto__pb2.UploadRequest.FromString,
+          response_serializer=cas__proto__pb2.UploadReply.SerializeToString,
+      ),
   }
   generic_handler = grpc.method_handlers_generic_handler(
       'cas_proto.Uploader', rpc_method_handlers)
@@ -1,16 +1,71 @@
-import pickle
+import json
+import struct
 import cv2
 import numpy as np
 
+from network.frame_store import get_client
+
+''' Wire format of an encoded DataPkt (all numbers little-endian):
+
+    header (WIRE_HEADER): magic, version, img flags, len(cam_id), frame_id,
+        num of meta, feature dim, num of features, len(label table),
+        len(extras), len(img)
+    cam_id: utf-8 str
+    label table: utf-8 labels joined by '\n', referred by their index
+    meta_flags: uint8 x num_meta, which columns each meta entry has
+    label ids: uint16 x num_meta
+    boxes: int32 x num_meta x 4
+    scores: float32 x num_meta
+    features: float32 x num_features x feature_dim, for entries with META_FEATURE
+    extras: json list (one dict per meta entry) of the fields not stored above
+    img: the jpg bytes, or a frame of network/frame_codec.py if img flags are set,
+        or FRAME_REF (frame width, height) + the address of the frame store
+        that has the jpg (network/frame_store.py) if IMG_REF is set
+
+Each block starts at a 4-byte aligned offset so the receiver can wrap it
+with np.frombuffer without copying.
+'''
+WIRE_MAGIC = b'CPKT'
+WIRE_VERSION = 1
+WIRE_HEADER = struct.Struct('<4sBBHqIHIIII')
+WIRE_ALIGN = 4
+
+# meta_flags bits
+META_BOX = 1
+META_SCORE = 2
+META_LABEL = 4
+META_FEATURE = 8
+
+# img flags bits, set for imgs encoded by network/frame_codec.py
+IMG_KEY = 1         # a keyframe, still a plain jpg
+IMG_DELTA = 2       # the changed blocks since the last frame of the camera
+# set for metadata-only pkts, the img is fetched from a frame store on demand
+IMG_REF = 4
+FRAME_REF = struct.Struct('<HH')
+
+
+def _padding(n):
+    return (WIRE_ALIGN - n % WIRE_ALIGN) % WIRE_ALIGN
+
+
+def _json_default(o):
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError('%s is not serializable' % type(o))
+
 
 class DataPkt:
-    def __init__(self, img=None, cam_id='', frame_id=0, meta=[]):
+    def __init__(self, img=None, cam_id='', frame_id=0, meta=[], img_data=None):
         ''' Pkt to be tranismitted between machines
 
         Args:
         - img: the cv2 img
         - cam_id: str
         - frame_id: int
+        - img_data: the jpg bytes of img, can be given instead of img. The img
+            is decoded from it only when pkt.img is read
 
         - meta: a list of bounding boxes with following fields:
             "box": [x0, y0, x1, y1]
@@ -21,33 +76,354 @@ class DataPkt:
             "feature": list, reid feature
             "score": float, confidence of the box
         '''
-        self.img = img
+        self._img = img
+        self._img_data = img_data if img is None else None
+        self.img_flags = 0
         self.cam_id = cam_id
         self.frame_id = frame_id
         self.meta = meta
 
+    @property
+    def img(self):
+        ''' The decoded img, decoded from the jpg bytes on first access.
+            Note: in-place drawing on it is not forwarded by encode(), assign a
+            new img to pkt.img to change what is sent
+        '''
+        if self._img is None and self.img_flags & IMG_REF:
+            data = get_client(self.frame_ref()[0]).fetch(self.cam_id, self.frame_id)
+            self._img = self.decode_img(data) if data is not None else None
+        elif self._img is None and self._img_data is not None and \
+                not self.img_flags & IMG_DELTA:
+            self._img = self.decode_img(self._img_data)
+        return self._img
+
+    @img.setter
+    def img(self, img):
+        self._img = img
+        self._img_data = None
+        self.img_flags = 0
+
+    @property
+    def img_data(self):
+        ''' The jpg bytes of the img, encoded only if the pkt was not received
+            as jpg (so forwarding a pkt never re-encodes it)
+        '''
+        if self._img_data is None and self._img is not None:
+            self._img_data = self.encode_img(self._img)
+        return self._img_data
+
+    def has_img(self):
+        return self._img is not None or self._img_data is not None
+
+    def is_frame_ref(self):
+        return bool(self.img_flags & IMG_REF)
+
+    def set_frame_ref(self, store_addr, frame_shape):
+        ''' Send only the reference of the img from now on, the next hops
+            fetch it (or regions of it) from the frame store when they need it
+
+        Args:
+        - store_addr: ip:port of the FrameStoreServer that has the jpg
+        - frame_shape: (height, width) of the img
+        '''
+        h, w = frame_shape[:2]
+        self._img_data = FRAME_REF.pack(w, h) + store_addr.encode('utf-8')
+        self.img_flags = IMG_REF
+
+    def frame_ref(self):
+        ''' Return (store_addr, (height, width)) of a metadata-only pkt '''
+        w, h = FRAME_REF.unpack_from(self._img_data)
+        return str(self._img_data[FRAME_REF.size:], 'utf-8'), (h, w)
+
+    def fetch_rois(self, rois):
+        ''' Return the regions [x0, y0, x1, y1] of the img. For metadata-only
+            pkts only these regions are fetched from the frame store
+
+        Return: a list of imgs, or None if the img is not available
+        '''
+        if self._img is None and self.is_frame_ref():
+            return get_client(self.frame_ref()[0]).fetch_rois(
+                                            self.cam_id, self.frame_id, rois)
+
+        img = self.img
+        if img is None:
+            return None
+        H, W = img.shape[:2]
+        return [img[max(0, y0):min(H, y1), max(0, x0):min(W, x1)]
+                    for x0, y0, x1, y1 in rois]
+
+    def __getstate__(self):
+        ''' Pickle (e.g. through a multiprocessing queue) the jpg bytes only
+            if we have them, instead of the decoded img
+        '''
+        d = self.__dict__.copy()
+        if d['_img_data'] is not None:
+            d['_img'] = None
+            d['_img_data'] = bytes(d['_img_data'])
+        return d
+
     def encode_img(self, img):
         # return b64encode(cv2.imencode('.jpg', im)[1].tostring())
-        return cv2.imencode('.jpg', img)[1].tostring()
+        return cv2.imencode('.jpg', img)[1].tobytes()
 
     def decode_img(self, data):
-        d = np.fromstring(data, dtype=np.uint8)
+        d = np.frombuffer(data, dtype=np.uint8)
         return cv2.imdecode(d, 1)
 
+    def encode_meta(self):
+        ''' Return the columns (see the wire format above) of self.meta
+        '''
+        n = len(self.meta)
+        flags = np.zeros(n, np.uint8)
+        label_ids = np.zeros(n, np.uint16)
+        boxes = np.zeros((n, 4), np.int32)
+        scores = np.zeros(n, np.float32)
+        features = []
+        extras = []
+        labels = {}
+        has_extras = False
+
+        for i, m in enumerate(self.meta):
+            extra = {}
+            for k, v in m.items():
+                if k == 'box' and len(v) == 4:
+                    boxes[i] = v
+                    flags[i] |= META_BOX
+                elif k == 'score':
+                    scores[i] = v
+                    flags[i] |= META_SCORE
+                elif k == 'label' and isinstance(v, str):
+                    label_ids[i] = labels.setdefault(v, len(labels))
+                    flags[i] |= META_LABEL
+                elif k == 'feature' and len(v) and \
+                        (not features or len(v) == len(features[0])):
+                    features.append(v)
+                    flags[i] |= META_FEATURE
+                else:
+                    extra[k] = v
+            extras.append(extra)
+            has_extras = has_extras or len(extra) > 0
+
+        features = np.asarray(features, np.float32)
+        feature_dim = features.shape[1] if len(features) else 0
+        label_table = '\n'.join(labels.keys()).encode('utf-8')
+        extras = json.dumps(extras, default=_json_default).encode('utf-8') \
+                    if has_extras else b''
+
+        return flags, label_ids, boxes, scores, features, feature_dim, label_table, extras
+
+    def load_from_string(self, s):
+        ''' Parse the output of encode(). s could be bytes, bytearray, or
+            memoryview. Arrays in meta (e.g. 'feature') are views into s
+        '''
+        if len(s) < WIRE_HEADER.size:
+            raise ValueError('pkt too short: %d bytes' % len(s))
+
+        magic, version, img_flags, cam_len, frame_id, meta_num, feature_dim, \
+            feature_num, label_len, extras_len, img_len = WIRE_HEADER.unpack_from(s)
+        if magic != WIRE_MAGIC:
+            raise ValueError('not a DataPkt: bad magic %s' % str(magic))
+        if version != WIRE_VERSION:
+            raise ValueError('unsupported DataPkt version %d' % version)
+
+        buf = memoryview(s)
+        pos = WIRE_HEADER.size
+
+        def _block(size):
+            nonlocal pos
+            pos += _padding(pos)
+            start = pos
+            pos += size
+            if pos > len(buf):
+                raise ValueError('pkt truncated')
+            return start
+
+        def _array(dtype, count):
+            return np.frombuffer(buf, dtype=dtype, count=count,
+                                offset=_block(np.dtype(dtype).itemsize * count))
+
+        start = _block(cam_len)
+        self.cam_id = str(buf[start:pos], 'utf-8')
+        self.frame_id = frame_id
+
+        start = _block(label_len)
+        labels = str(buf[start:pos], 'utf-8').split('\n') if label_len else []
+        meta_flags = _array('<u1', meta_num)
+        label_ids = _array('<u2', meta_num)
+        boxes = _array('<i4', meta_num * 4).reshape(meta_num, 4).tolist()
+        scores = _array('<f4', meta_num).tolist()
+        features = _array('<f4', feature_num * feature_dim).reshape(
+                                                    feature_num, feature_dim)
+        start = _block(extras_len)
+        extras = json.loads(str(buf[start:pos], 'utf-8')) if extras_len else []
+        start = _block(img_len)
+
+        # the payload must agree with the header, so a malformed pkt is
+        # rejected here instead of failing while building the meta
+        if np.any(label_ids[(meta_flags & META_LABEL) > 0] >= len(labels)):
+            raise ValueError('label id out of range')
+        if extras_len and (not isinstance(extras, list) or len(extras) != meta_num
+                            or not all(isinstance(e, dict) for e in extras)):
+            raise ValueError('extras do not match %d metas' % meta_num)
+        if feature_num != np.count_nonzero(meta_flags & META_FEATURE):
+            raise ValueError('%d features for %d flagged metas' % (
+                            feature_num, np.count_nonzero(meta_flags & META_FEATURE)))
+
+        self._img = None
+        self._img_data = buf[start:pos] if img_len else None
+        self.img_flags = img_flags
+
+        label_ids = label_ids.tolist()
+        self.meta = []
+        feature_ptr = 0
+        for i, f in enumerate(meta_flags.tolist()):
+            m = extras[i] if extras else {}
+            if f & META_BOX:
+                m['box'] = boxes[i]
+            if f & META_SCORE:
+                m['score'] = scores[i]
+            if f & META_LABEL:
+                m['label'] = labels[label_ids[i]]
+            if f & META_FEATURE:
+                m['feature'] = features[feature_ptr]
+                feature_ptr += 1
+            self.meta.append(m)
+
+    def encode(self, img_codec=None):
+        ''' return a serialized data for data streaming
+
+        Args:
+        - img_codec: a StreamEncoder (network/frame_codec.py) to encode the img
+            with instead of jpg, the receiver needs the matching StreamDecoder
+        '''
+        flags, label_ids, boxes, scores, features, feature_dim, label_table, \
+            extras = self.encode_meta()
+        cam_id = self.cam_id.encode('utf-8')
+        img, img_flags = b'', 0
+        if self.has_img():
+            if img_codec is not None:
+                img, img_flags = img_codec.encode_img(self.cam_id, self.img)
+            else:
+                img, img_flags = self.img_data, self.img_flags
+
+        head = WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, img_flags, len(cam_id),
+                                self.frame_id, len(self.meta), feature_dim,
+                                len(features), len(label_table), len(extras),
+                                len(img))
+
+        blocks = [cam_id, label_table, flags.tobytes(), label_ids.tobytes(),
+                    boxes.tobytes(), scores.tobytes(), features.tobytes(),
+                    extras, img]
+        output = [head]
+        pos = len(head)
+        for b in blocks:
+            pad = _padding(pos)
+            output.append(b'\x00' * pad)
+            output.append(b)
+            pos += pad + len(b)
+
+        return b''.join(output)
+
+
+''' Wire format of an encoded DataPktBatch (all numbers little-endian):
+
+    header (BATCH_HEADER): magic, version, num of pkts
+    lengths: uint32 x num_pkts, size of each encoded pkt
+    pkts: the encode() output of each DataPkt, each at a 4-byte aligned offset
+'''
+BATCH_MAGIC = b'CBAT'
+BATCH_VERSION = 1
+BATCH_HEADER = struct.Struct('<4sBxxxI')
+
+
+class DataPktBatch:
+    def __init__(self, pkts=[]):
+        ''' Several DataPkts (e.g. the frames of one detection batch) sent as
+            one message, so they share one header, one syscall and one queue
+            operation
+
+        Args:
+        - pkts: a list of DataPkt
+        '''
+        self.pkts = list(pkts)
+
+    @property
+    def cam_id(self):
+        return self.pkts[0].cam_id if self.pkts else ''
+
+    @property
+    def frame_id(self):
+        return self.pkts[0].frame_id if self.pkts else 0
+
+    def __len__(self):
+        return len(self.pkts)
+
+    def __iter__(self):
+        return iter(self.pkts)
+
     def load_from_string(self, s):
-        d = pickle.loads(s)
-        self.img = self.decode_img(d['img'])
-        self.cam_id = d['cam_id']
-        self.frame_id = d['frame_id']
-        self.meta = d['meta']
+        ''' Parse the output of encode(), the pkts are views into s
+        '''
+        if len(s) < BATCH_HEADER.size:
+            raise ValueError('batch too short: %d bytes' % len(s))
 
-    def encode(self):
+        magic, version, num = BATCH_HEADER.unpack_from(s)
+        if magic != BATCH_MAGIC:
+            raise ValueError('not a DataPktBatch: bad magic %s' % str(magic))
+        if version != BATCH_VERSION:
+            raise ValueError('unsupported DataPktBatch version %d' % version)
+
+        buf = memoryview(s)
+        pos = BATCH_HEADER.size
+        if pos + 4 * num > len(buf):
+            raise ValueError('batch truncated')
+        lengths = np.frombuffer(buf, dtype='<u4', count=num, offset=pos).tolist()
+        pos += 4 * num
+
+        self.pkts = []
+        for n in lengths:
+            pos += _padding(pos)
+            if pos + n > len(buf):
+                raise ValueError('batch truncated')
+            pkt = DataPkt()
+            pkt.load_from_string(buf[pos:pos + n])
+            self.pkts.append(pkt)
+            pos += n
+
+    def encode(self, img_codec=None):
         ''' return a serialized data for data streaming
         '''
-        output = {  'img': self.encode_img(self.img),
-                    'frame_id': self.frame_id,
-                    'cam_id': self.cam_id,
-                    'meta': self.meta,
-                }
+        data = [pkt.encode(img_codec) for pkt in self.pkts]
+        lengths = np.array([len(d) for d in data], np.uint32)
+
+        output = [BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, len(data)),
+                    lengths.astype('<u4').tobytes()]
+        pos = BATCH_HEADER.size + 4 * len(data)
+        for d in data:
+            pad = _padding(pos)
+            output.append(b'\x00' * pad)
+            output.append(d)
+            pos += pad + len(d)
+
+        return b''.join(output)
+
+
+def load_pkts(s, split_batches=True):
+    ''' Parse a received message, either an encoded DataPkt or DataPktBatch
+
+    Args:
+    - s: the message (bytes, bytearray, or memoryview)
+    - split_batches: return the pkts of a batch one by one, otherwise the
+        batch is returned as a single item
+
+    Return: a list of DataPkt (or DataPktBatch)
+    Raise ValueError if s is neither
+    '''
+    if bytes(s[:len(BATCH_MAGIC)]) == BATCH_MAGIC:
+        batch = DataPktBatch()
+        batch.load_from_string(s)
+        return batch.pkts if split_batches else [batch]
 
-        return pickle.dumps(output)
+    pkt = DataPkt()
+    pkt.load_from_string(s)
+    return [pkt]
@@ -0,0 +1,246 @@
+import logging
+import struct
+import cv2
+import numpy as np
+from collections import defaultdict
+
+from network.data_packet import DataPktBatch, IMG_KEY, IMG_DELTA
+
+
+''' A simple inter-frame codec for stationary cameras (conditional replenishment):
+
+    keyframe: the whole frame as a plain jpg, sent every KEYFRAME_INTERVAL
+        frames, on the first frame of a connection, and when too much changed
+    delta: only the BLOCK_SIZE x BLOCK_SIZE blocks that changed since the last
+        frame, packed into one mosaic jpg:
+            header (DELTA_HEADER): seq, width, height, block size, num of blocks
+            block ids: uint16 x num_blocks (row-major), padded to 4 bytes
+            mosaic: the jpg of the changed blocks, laid out row by row
+
+The encoder compares against what the decoder will reconstruct (not against
+the original frames), so jpg errors do not pile up across deltas. seq counts
+the frames since the keyframe, a decoder that missed a frame drops the
+deltas until the next keyframe.
+'''
+DELTA_HEADER = struct.Struct('<IHHHI')
+
+# max number of frames between two keyframes
+KEYFRAME_INTERVAL = 32
+
+# side of the blocks in pixels
+BLOCK_SIZE = 32
+
+# a block is sent if its mean abs pixel difference is larger than this
+DIFF_THRES = 6.
+
+# send a keyframe instead if more than this ratio of blocks changed
+MAX_DELTA_RATIO = 0.6
+
+JPEG_QUALITY = 90
+
+
+def _encode_jpg(img, quality=JPEG_QUALITY):
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def _decode_jpg(data):
+    ''' Return the img, or None if data is not a valid jpg '''
+    try:
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), 1)
+    except cv2.error:
+        return None
+
+
+def _pad(img, block_size):
+    ''' Pad img to a multiple of block_size by repeating its edges '''
+    h, w = img.shape[:2]
+    ph, pw = -h % block_size, -w % block_size
+    if ph or pw:
+        img = cv2.copyMakeBorder(img, 0, ph, 0, pw, cv2.BORDER_REPLICATE)
+    return img
+
+
+def _to_blocks(img, block_size):
+    ''' (H, W, C) img -> (H/b, W/b, b, b, C) view of its blocks '''
+    h, w, c = img.shape
+    return img.reshape(h // block_size, block_size, w // block_size,
+                        block_size, c).swapaxes(1, 2)
+
+
+class FrameEncoder:
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL, block_size=BLOCK_SIZE,
+                    diff_thres=DIFF_THRES, quality=JPEG_QUALITY):
+        ''' Encode the frames of one camera
+
+        Args:
+        - keyframe_interval: max number of frames between two keyframes
+        - block_size: side of the blocks in pixels
+        - diff_thres: min mean abs difference of a changed block
+        - quality: jpg quality of keyframes and mosaics
+        '''
+        self.keyframe_interval = keyframe_interval
+        self.block_size = block_size
+        self.diff_thres = diff_thres
+        self.quality = quality
+        self.reset()
+
+    def reset(self):
+        ''' Start over with a keyframe, e.g. after reconnecting '''
+        self.ref = None     # padded frame as the decoder has it
+        self.shape = None
+        self.seq = 0
+
+    def encode(self, img):
+        ''' Return (bytes, flags) of img, flags is IMG_KEY or IMG_DELTA
+        '''
+        if self.ref is None or img.shape != self.shape or \
+                self.seq + 1 >= self.keyframe_interval:
+            return self.encode_key(img)
+
+        b = self.block_size
+        cur = _pad(img, b)
+        diff = cv2.absdiff(cur, self.ref)
+        changed = _to_blocks(diff, b).mean(axis=(2, 3, 4)) > self.diff_thres
+        ids = np.flatnonzero(changed)
+        if len(ids) > MAX_DELTA_RATIO * changed.size:
+            return self.encode_key(img)
+
+        self.seq += 1
+        h, w = img.shape[:2]
+        head = DELTA_HEADER.pack(self.seq, w, h, b, len(ids))
+        if not len(ids):
+            return head, IMG_DELTA
+
+        # lay the changed blocks out in a roughly square mosaic
+        cols = int(np.ceil(np.sqrt(len(ids))))
+        rows = int(np.ceil(len(ids) / cols))
+        tiles = np.zeros((rows * cols, b, b, 3), np.uint8)
+        tiles[:len(ids)] = _to_blocks(cur, b).reshape(-1, b, b, 3)[ids]
+        mosaic = tiles.reshape(rows, cols, b, b, 3).swapaxes(1, 2).reshape(
+                                                            rows * b, cols * b, 3)
+        data = _encode_jpg(mosaic, self.quality)
+
+        # update the reference with what the decoder will see
+        paste_blocks(self.ref, ids, _decode_jpg(data), b)
+
+        ids = ids.astype('<u2').tobytes()
+        ids += b'\x00' * (-len(ids) % 4)
+        return b''.join([head, ids, data]), IMG_DELTA
+
+    def encode_key(self, img):
+        data = _encode_jpg(img, self.quality)
+        self.ref = _pad(_decode_jpg(data), self.block_size)
+        self.shape = img.shape
+        self.seq = 0
+        return data, IMG_KEY
+
+
+def paste_blocks(ref, ids, mosaic, block_size):
+    ''' Copy the blocks of mosaic (laid out by FrameEncoder) into the padded
+        frame ref at the block ids
+    '''
+    b = block_size
+    tiles = _to_blocks(mosaic, b).reshape(-1, b, b, 3)[:len(ids)]
+    ref_blocks = _to_blocks(ref, b)
+    nx = ref_blocks.shape[1]
+    ref_blocks[ids // nx, ids % nx] = tiles
+
+
+class FrameDecoder:
+    def __init__(self):
+        ''' Decode the frames of one camera, the reverse of FrameEncoder
+        '''
+        self.ref = None     # last frame, padded once the first delta arrives
+        self.seq = -1       # -1: out of sync, waiting for a keyframe
+
+    def decode(self, data, flags):
+        ''' Return the img, or None if it can't be reconstructed (no keyframe
+            received yet, a frame was missed, or a malformed delta)
+        '''
+        if flags & IMG_KEY:
+            self.ref = _decode_jpg(data)
+            self.seq = -1 if self.ref is None else 0
+            return None if self.ref is None else self.ref.copy()
+
+        if not flags & IMG_DELTA:
+            return _decode_jpg(data)
+
+        if len(data) < DELTA_HEADER.size:
+            self.seq = -1
+            return None
+        seq, w, h, b, num = DELTA_HEADER.unpack_from(data)
+        if self.seq < 0 or seq != self.seq + 1 or not 0 < b <= max(w, h) or \
+                self.ref.shape[:2] not in ((h, w), (h + -h % b, w + -w % b)):
+            self.seq = -1
+            return None
+
+        self.ref = _pad(self.ref, b)
+
+        if num:
+            # check the blocks before touching the reference 
+            pos = DELTA_HEADER.size
+            if pos + 2 * num > len(data):
+                self.seq = -1
+                return None
+            ids = np.frombuffer(data, dtype='<u2', count=num, offset=pos).astype(np.int64)
+            pos += 2 * num + (-2 * num % 4)
+            mosaic = _decode_jpg(data[pos:])
+            if ids.max() >= self.ref.shape[0] // b * (self.ref.shape[1] // b) or \
+                    mosaic is None or mosaic.shape[0] % b or mosaic.shape[1] % b or \
+                    mosaic.shape[0] // b * (mosaic.shape[1] // b) < num:
+                self.seq = -1
+                return None
+            paste_blocks(self.ref, ids, mosaic, b)
+
+        self.seq = seq
+        return self.ref[:h, :w].copy()
+
+
+class StreamEncoder:
+    ''' The FrameEncoders of all cameras sent over one connection, passed to
+        DataPkt.encode()
+    '''
+    def __init__(self, **kwargs):
+        self.encoders = defaultdict(lambda: FrameEncoder(**kwargs))
+
+    def encode_img(self, cam_id, img):
+        return self.encoders[cam_id].encode(img)
+
+    def reset(self):
+        for e in self.encoders.values():
+            e.reset()
+
+
+class StreamDecoder:
+    ''' The FrameDecoders of all cameras received on one connection '''
+    def __init__(self):
+        self.decoders = defaultdict(FrameDecoder)
+        self.fail_cnt = 0
+
+    def decode_pkt(self, pkt):
+        ''' Reconstruct the img of a pkt sent with a StreamEncoder. Pkts with
+            a plain jpg are not touched (and stay lazily decoded)
+
+        Return: False if the img can't be reconstructed. For a DataPktBatch,
+            the pkts that can't be are removed from it
+        '''
+        if isinstance(pkt, DataPktBatch):
+            pkt.pkts = [p for p in pkt.pkts if self.decode_pkt(p)]
+            return len(pkt.pkts) > 0
+
+        if not pkt.img_flags:
+            return True
+
+        img = self.decoders[pkt.cam_id].decode(pkt.img_data, pkt.img_flags)
+        if img is None:
+            self.fail_cnt += 1
+            if self.fail_cnt % 20 == 1:
+                self.log('cannot decode frame %d of %s, waiting for keyframe'
+                            % (pkt.frame_id, pkt.cam_id))
+            return False
+
+        pkt.img = img
+        return True
+
+    def log(self, s):
+        logging.debug('[StreamDecoder] %s' % s)
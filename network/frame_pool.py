@@ -0,0 +1,155 @@
+import logging
+import numpy as np
+from multiprocessing import Lock
+from multiprocessing import shared_memory
+
+
+# pools created or attached in this process: {name: FramePool}
+_POOLS = {}
+
+
+def get_pool(name):
+    ''' Return the FramePool with the name in this process. The pool must be
+        created here or passed (pickled) to this process, e.g. as a member of
+        the object that the Process runs
+    '''
+    if name not in _POOLS:
+        raise KeyError('frame pool %s is not attached in this process' % name)
+    return _POOLS[name]
+
+
+class FrameRef:
+    ''' A handle to one slot of a FramePool, the thing that goes through the
+        queues instead of the image
+    '''
+    __slots__ = ('pool_name', 'slot')
+
+    def __init__(self, pool_name, slot):
+        self.pool_name = pool_name
+        self.slot = slot
+
+    def __getstate__(self):
+        return (self.pool_name, self.slot)
+
+    def __setstate__(self, state):
+        self.pool_name, self.slot = state
+
+    def get(self):
+        ''' Return the image as a view into the shared memory '''
+        return get_pool(self.pool_name).view(self.slot)
+
+    def retain(self):
+        get_pool(self.pool_name).retain(self)
+
+    def release(self):
+        get_pool(self.pool_name).release(self)
+
+
+class FramePool:
+    def __init__(self, slot_num, frame_shape, dtype=np.uint8):
+        ''' A ring of fixed-shape image slots in shared memory, shared by all
+            the processes of a node. Each slot has a reference count, a slot is
+            reused once its count drops to 0
+
+        Args:
+        - slot_num: number of images the pool holds
+        - frame_shape: shape of each image, e.g. (400, 400, 3)
+        - dtype: numpy type of the images
+        '''
+        self.slot_num = slot_num
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.lock = Lock()
+
+        frame_size = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(
+                        create=True, size=slot_num * (frame_size + 4))
+        self.name = self.shm.name
+        self.owner = True
+        self.attach()
+        self.refcounts[:] = 0
+        self.log('init, %d slots of %s' % (slot_num, str(self.frame_shape)))
+
+    def attach(self):
+        frame_size = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self.frames = np.ndarray((self.slot_num,) + self.frame_shape,
+                                    self.dtype, buffer=self.shm.buf)
+        self.refcounts = np.ndarray((self.slot_num,), np.int32, buffer=self.shm.buf,
+                                    offset=self.slot_num * frame_size)
+        self.cursor = 0
+        self.full_cnt = 0
+        _POOLS[self.name] = self
+
+    def __getstate__(self):
+        return {'name': self.name,
+                'slot_num': self.slot_num,
+                'frame_shape': self.frame_shape,
+                'dtype': self.dtype.str,
+                'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.name = state['name']
+        self.slot_num = state['slot_num']
+        self.frame_shape = state['frame_shape']
+        self.dtype = np.dtype(state['dtype'])
+        self.lock = state['lock']
+        try:
+            # only the creator unlinks the memory
+            self.shm = shared_memory.SharedMemory(name=self.name, track=False)
+        except TypeError:   # python < 3.13
+            self.shm = shared_memory.SharedMemory(name=self.name)
+        self.owner = False
+        self.attach()
+
+    def alloc(self, img=None):
+        ''' Take a free slot (its count is set to 1) and copy img into it
+
+        Return: a FrameRef, or None if all slots are in use
+        '''
+        slot = -1
+        with self.lock:
+            for i in range(self.slot_num):
+                j = (self.cursor + i) % self.slot_num
+                if self.refcounts[j] == 0:
+                    slot = j
+                    self.refcounts[j] = 1
+                    self.cursor = (j + 1) % self.slot_num
+                    break
+
+        if slot < 0:
+            self.full_cnt += 1
+            if self.full_cnt % 100 == 1:
+                self.log('pool full! (%d times)' % self.full_cnt)
+            return None
+
+        if img is not None:
+            self.frames[slot] = img
+        return FrameRef(self.name, slot)
+
+    def view(self, slot):
+        return self.frames[slot]
+
+    def retain(self, ref):
+        with self.lock:
+            self.refcounts[ref.slot] += 1
+
+    def release(self, ref):
+        with self.lock:
+            if self.refcounts[ref.slot] > 0:
+                self.refcounts[ref.slot] -= 1
+
+    def used(self):
+        ''' Return the number of slots in use '''
+        return int(np.count_nonzero(self.refcounts))
+
+    def close(self):
+        self.frames = None
+        self.refcounts = None
+        _POOLS.pop(self.name, None)
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.log('closed')
+
+    def log(self, s):
+        logging.debug('[FramePool] %s' % s)
@@ -0,0 +1,227 @@
+import logging
+import socket
+import struct
+import cv2
+import numpy as np
+from collections import OrderedDict
+from threading import Thread, Lock
+
+from network.utils import pack_frame, recv_frame
+
+
+''' Side channel for pkts forwarded without their img (metadata-only mode):
+the ingest node keeps the jpgs in a FrameStore, and the following nodes fetch
+the whole frame, or only some regions of it, when they need the pixels.
+
+    request: FETCH_REQUEST (len(cam_id), frame_id, num of rois), cam_id,
+        int32 x num_rois x 4 (x0, y0, x1, y1)
+    reply: the jpg of the frame if num_rois is 0, otherwise uint32 x num_rois
+        jpg sizes followed by the jpg of each region. Empty if the frame is
+        not in the store (anymore)
+
+Both are sent with the framing of network/utils.py.
+'''
+FETCH_REQUEST = struct.Struct('<HqH')
+
+# number of frames kept by a FrameStore
+STORE_SIZE = 1024
+
+# number of decoded frames kept by each server thread for region requests
+DECODED_CACHE_SIZE = 4
+
+# seconds to wait for a reply
+FETCH_TIMEOUT = 2.
+
+ROI_JPEG_QUALITY = 95
+
+
+def jpeg_shape(data):
+    ''' Return (height, width) of a jpg from its header, without decoding it
+    '''
+    data = memoryview(data)
+    pos = 2
+    while pos + 9 < len(data):
+        if data[pos] != 0xFF:
+            break
+        marker = data[pos + 1]
+        seg_len = (data[pos + 2] << 8) + data[pos + 3]
+        # SOF markers, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack_from('>HH', data, pos + 5)
+            return h, w
+        pos += 2 + seg_len
+    raise ValueError('no frame size in jpg header')
+
+
+class FrameStore:
+    def __init__(self, capacity=STORE_SIZE):
+        ''' LRU cache of the jpgs of recent frames, keyed by (cam_id, frame_id)
+        '''
+        self.capacity = capacity
+        self.frames = OrderedDict()
+        self.lock = Lock()
+
+    def put(self, cam_id, frame_id, data):
+        with self.lock:
+            self.frames[cam_id, frame_id] = data
+            self.frames.move_to_end((cam_id, frame_id))
+            while len(self.frames) > self.capacity:
+                self.frames.popitem(last=False)
+
+    def get(self, cam_id, frame_id):
+        with self.lock:
+            return self.frames.get((cam_id, frame_id))
+
+    def __len__(self):
+        return len(self.frames)
+
+
+class FrameStoreServer(Thread):
+    def __init__(self, store, address, port):
+        ''' Serve the frames (or regions of them) in store to other nodes
+
+        Args:
+        - store: the FrameStore
+        - address, port: where to listen for incoming connections
+        '''
+        Thread.__init__(self)
+        self.daemon = True
+        self.store = store
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((address, port))
+        self.log('init on %s:%d' % (address, port))
+
+    def run(self):
+        self.socket.listen(8)
+        while True:
+            conn, (ip, port) = self.socket.accept()
+            self.log('Got connection from %s:%d' % (ip, port))
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        decoded = OrderedDict()     # region requests of a chunk hit the same frames
+        try:
+            while True:
+                req = recv_frame(conn)
+                if req is None:
+                    break
+                conn.sendall(pack_frame(self.reply(req, decoded)))
+        except (struct.error, ValueError) as e:
+            self.log('bad request, closing the connection: %s' % str(e))
+        except OSError as e:
+            self.log('connection error: %s' % str(e))
+        conn.close()
+
+    def reply(self, req, decoded):
+        cam_len, frame_id, roi_num = FETCH_REQUEST.unpack_from(req)
+        pos = FETCH_REQUEST.size
+        cam_id = str(req[pos:pos + cam_len], 'utf-8')
+        pos += cam_len
+        rois = np.frombuffer(req, dtype='<i4', count=roi_num * 4,
+                            offset=pos).reshape(roi_num, 4)
+
+        data = self.store.get(cam_id, frame_id)
+        if data is None or not roi_num:
+            return data or b''
+
+        key = (cam_id, frame_id)
+        if key not in decoded:
+            decoded[key] = cv2.imdecode(np.frombuffer(data, np.uint8), 1)
+            if len(decoded) > DECODED_CACHE_SIZE:
+                decoded.popitem(last=False)
+        frame = decoded[key]
+
+        H, W = frame.shape[:2]
+        crops = []
+        for x0, y0, x1, y1 in rois.tolist():
+            crop = frame[max(0, y0):min(H, y1), max(0, x0):min(W, x1)]
+            if not crop.size:
+                crops.append(b'')
+                continue
+            crops.append(cv2.imencode('.jpg', crop,
+                            [cv2.IMWRITE_JPEG_QUALITY, ROI_JPEG_QUALITY])[1].tobytes())
+
+        sizes = np.array([len(c) for c in crops], '<u4').tobytes()
+        return b''.join([sizes] + crops)
+
+    def log(self, s):
+        logging.debug('[FrameStoreServer] %s' % s)
+
+
+class FrameStoreClient:
+    def __init__(self, server_addr):
+        ''' Fetch frames from a FrameStoreServer, over one kept-alive connection
+
+        Args:
+        - server_addr: ip:port in str
+        '''
+        self.server_ip = server_addr.split(':')[0]
+        self.server_port = int(server_addr.split(':')[1])
+        self.sock = None
+        self.lock = Lock()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.server_ip, self.server_port),
+                                            timeout=FETCH_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, req):
+        with self.lock:
+            for _ in range(2):      # reconnect once if the connection broke
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    self.sock.sendall(pack_frame(req))
+                    d = recv_frame(self.sock)
+                    if d is not None:
+                        return d
+                except (ValueError, OSError) as e:
+                    self.log('fetch failed: %s' % str(e))
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+        return None
+
+    def fetch(self, cam_id, frame_id):
+        ''' Return the jpg of a frame, or None if not available
+        '''
+        cam = cam_id.encode('utf-8')
+        d = self.request(FETCH_REQUEST.pack(len(cam), frame_id, 0) + cam)
+        return d if d else None
+
+    def fetch_rois(self, cam_id, frame_id, rois):
+        ''' Return a list of imgs, one per [x0, y0, x1, y1] in rois (clipped
+            to the frame), or None if the frame is not available
+        '''
+        cam = cam_id.encode('utf-8')
+        rois = np.asarray(rois, '<i4').reshape(-1, 4)
+        d = self.request(FETCH_REQUEST.pack(len(cam), frame_id, len(rois)) +
+                        cam + rois.tobytes())
+        if not d:
+            return None
+
+        sizes = np.frombuffer(d, dtype='<u4', count=len(rois)).tolist()
+        pos = 4 * len(rois)
+        res = []
+        for n, (x0, y0, x1, y1) in zip(sizes, rois.tolist()):
+            if n:
+                res.append(cv2.imdecode(np.frombuffer(d, np.uint8, count=n, offset=pos), 1))
+            else:
+                res.append(np.zeros((max(0, y1 - y0), max(0, x1 - x0), 3), np.uint8))
+            pos += n
+        return res
+
+    def log(self, s):
+        logging.debug('[FrameStoreClient] %s' % s)
+
+
+# one client per store address in each process
+_CLIENTS = {}
+
+
+def get_client(server_addr):
+    if server_addr not in _CLIENTS:
+        _CLIENTS[server_addr] = FrameStoreClient(server_addr)
+    return _CLIENTS[server_addr]
@@ -5,25 +5,33 @@ import sys
 import logging 
 import network.cas_proto_pb2 as cas_pb2
 import network.cas_proto_pb2_grpc as cas_pb2_grpc
-from network.utils import Q
+from network.utils import Q, READ_TIMEOUT
 
 import cv2
 from network.data_packet import DataPkt
 
 
+# seconds to wait before reopening a broken stream
+RETRY_INTERVAL = 1.
+
+
 class NetClient:
-    def __init__(self, client_name, server_addr, buffer_size):
+    def __init__(self, client_name, server_addr, buffer_size, streaming=False):
         '''
         Args:
         - clien_name: identifier of the camera (same as the one in topo)
         - server_addr: ip:port in str
         - buffer_size: size of request_queue, and response queue
+        - streaming: send the pkts over one UploadStream instead of one Upload
+            round trip each, so the throughput does not depend on the RTT. The
+            server then replies only with control msgs (no frame ids)
         '''
         channel = grpc.insecure_channel(server_addr)
         self.stub = cas_pb2_grpc.UploaderStub(channel)
         self.client_name = client_name
         self.request_queue = Q(buffer_size)
         self.response_queue = Q(buffer_size)
+        self.streaming = streaming
         self.log('init, connect to %s' % server_addr)
 
 
@@ -60,14 +68,40 @@ class NetClient:
         return ''
 
 
+    def stream_requests(self):
+        while True:
+            input_pkt = self.request_queue.read(block=True, timeout=READ_TIMEOUT)
+            if input_pkt is None:
+                continue
+
+            yield cas_pb2.UploadRequest(name=self.client_name,
+                                        data=input_pkt.encode())
+
+
+    def run_stream(self):
+        ''' Keep one UploadStream open, reopen it if it breaks
+        '''
+        while True:
+            try:
+                replies = self.stub.UploadStream(self.stream_requests())
+                for reply in replies:
+                    if reply.message:
+                        self.response_queue.write(reply.message)
+            except grpc.RpcError as e:
+                self.log('stream broken: %s' % str(e.code()))
+            sleep(RETRY_INTERVAL)
+
+
     def run(self):
         ''' Keeps running until get empty input_pkt
         '''
         self.log('running!')
+        if self.streaming:
+            self.run_stream()
+
         while True:
-            input_pkt = self.request_queue.read()
+            input_pkt = self.request_queue.read(block=True, timeout=READ_TIMEOUT)
             if input_pkt is None:
-                sleep(0.01)
                 continue
 
             reply = self.send_rpc(input_pkt.encode())
@@ -6,58 +6,118 @@ from concurrent import futures
 import logging
 import network.cas_proto_pb2 as cas_pb2
 import network.cas_proto_pb2_grpc as cas_pb2_grpc
-from network.utils import Q
-from network.data_packet import DataPkt
+from network.utils import Q, READ_TIMEOUT
+from network.data_packet import load_pkts
 
 
 class Uploader(cas_pb2_grpc.UploaderServicer):
-    def __init__(self, data_queue, control_queues, buffer_size):
+    def __init__(self, data_queue, control_queues, buffer_size, split_batches=True):
         self.data_queue = data_queue
+        self.split_batches = split_batches
         self.control_queues = control_queues
         self.buffer_size = buffer_size
         self.timer = time()
         print('Uploader inited')
 
 
-    def Upload(self, request, context):
-        '''
-        Args:
-        - request: the data from the client 
-        '''
-        pkt = DataPkt()
-        pkt.load_from_string(request.data)
+    def receive(self, request):
+        ''' Parse a request (a DataPkt or DataPktBatch) and put it in data_queue
 
-        cam_id = pkt.cam_id
+        Return: the last pkt, or None if the request is not valid
+        '''
+        try:
+            pkts = load_pkts(request.data, self.split_batches)
+        except ValueError as e:
+            logging.debug('[Uploader] Drop bad pkt from %s: %s' % (request.name, str(e)))
+            return None
+        if not pkts:
+            return None
+
+        cam_id = pkts[-1].cam_id
         if cam_id not in self.control_queues:
             print('receive data from %s' % cam_id)
             self.control_queues[cam_id] = Q(self.buffer_size)
 
-        self.data_queue.write(pkt)
+        for pkt in pkts:
+            self.data_queue.write(pkt)
         if self.data_queue.full():
             print('rpc server queue full!')
 
+        return pkts[-1]
+
+
+    def Upload(self, request, context):
+        '''
+        Args:
+        - request: the data from the client 
+        '''
+        pkt = self.receive(request)
+        if pkt is None:
+            return cas_pb2.UploadReply(message='')
+
         msg = str(pkt.frame_id)
-        if not self.control_queues[cam_id].empty():
-            msg = self.control_queues[cam_id].read()
+        if not self.control_queues[pkt.cam_id].empty():
+            msg = self.control_queues[pkt.cam_id].read()
 
         return cas_pb2.UploadReply(message=msg)
 
 
+    def UploadStream(self, request_iterator, context):
+        ''' The requests are consumed by a separate thread, so the client can
+            keep sending without waiting for replies. Only the control msgs of
+            the client's camera are sent back, as soon as they are written
+
+        Args:
+        - request_iterator: the data from the client, one request per pkt
+        '''
+        cams = []
+
+        def _consume():
+            try:
+                for request in request_iterator:
+                    pkt = self.receive(request)
+                    if pkt is not None and not cams:
+                        cams.append(pkt.cam_id)
+            except grpc.RpcError:
+                pass
+
+        consumer = Thread(target=_consume, daemon=True)
+        consumer.start()
+
+        while consumer.is_alive() and context.is_active():
+            if not cams:
+                consumer.join(READ_TIMEOUT)
+                continue
+
+            msg = self.control_queues[cams[0]].read(block=True, timeout=READ_TIMEOUT)
+            if msg is not None:
+                yield cas_pb2.UploadReply(message=msg)
+
+        logging.debug('[Uploader] Stream from %s ended' % (cams[0] if cams else '?'))
+
+
 class NetServer:
-    def __init__(self, name, address, port, buffer_size):
+    def __init__(self, name, address, port, buffer_size, max_workers=10,
+                    split_batches=True):
         '''
         Args:
         - name: the name of local machine 
         - port: int port number
         - buffer_size: size of input data queue
+        - max_workers: size of the rpc thread pool. Each UploadStream holds
+            one worker while it is open, so it should be larger than the
+            number of streaming clients
+        - split_batches: put the pkts of a received DataPktBatch into the
+            data queue one by one, otherwise the whole batch is one item
         '''
         self.data_queue = Q(buffer_size)
         self.control_queues = {}
         self.name = name
-        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
         cas_pb2_grpc.add_UploaderServicer_to_server(Uploader(data_queue=self.data_queue,
                                                             control_queues=self.control_queues,
-                                                            buffer_size=buffer_size),
+                                                            buffer_size=buffer_size,
+                                                            split_batches=split_batches),
                                                             self.server)
         self.server.add_insecure_port('[::]:%d' % port)
         self.server.start()
@@ -85,10 +145,10 @@ class NetServer:
             self.control_queues[client_name].write(msg)
 
 
-    def read_data(self):
+    def read_data(self, block=False, timeout=None):
         ''' Read data from data_queue
         '''
-        return self.data_queue.read()
+        return self.data_queue.read(block, timeout)
 
 
     def log(self, s):
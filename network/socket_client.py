@@ -5,20 +5,31 @@ import logging
 import pickle 
 from struct import pack
 from time import time, sleep 
-from network.utils import Q
+from network.utils import Q, FRAMING_LENGTH, FRAMING_MODES, READ_TIMEOUT, pack_frame
 from network.data_packet import DataPkt
-
-
-HEADER = b'\x00\x00CAESAR\x00\x00'
+from network.frame_codec import StreamEncoder
 
 
 class NetClient:
-    def __init__(self, client_name, server_addr, buffer_size):
+    def __init__(self, client_name, server_addr, buffer_size, framing=FRAMING_LENGTH,
+                    video_codec=False):
+        '''
+        Args:
+        - client_name: identifier of the camera
+        - server_addr: ip:port in str
+        - buffer_size: size of request_queue
+        - framing: FRAMING_LENGTH or FRAMING_HEADER (network/utils.py)
+        - video_codec: send the imgs as keyframes + changed blocks
+            (network/frame_codec.py) instead of one jpg per frame
+        '''
+        assert framing in FRAMING_MODES, 'unknown framing %s' % framing
         self.client_name = client_name
+        self.framing = framing
         self.server_ip = server_addr.split(':')[0]
         self.server_port = int(server_addr.split(':')[1])
         self.request_queue = Q(buffer_size)
         self.frame_cnt = 0 
+        self.img_codec = StreamEncoder() if video_codec else None
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.running = True
@@ -39,11 +50,17 @@ class NetClient:
             
         if self.request_queue.full():
             if self.frame_cnt % 10 == 0:
-                self.log('send queue full!')
+                self.log('send queue full! %d pkts dropped' % self.dropped())
             return False
 
         return True
 
+    def dropped(self):
+        ''' 
+        Public: number of pkts dropped so far because the send queue was full
+        '''
+        return self.request_queue.drop_count()
+
     def run(self):
         ''' 
         Keeps running until get empty input_pkt
@@ -58,16 +75,15 @@ class NetClient:
         self.log('connected to %s!' % self.server_ip)
 
         while self.running:
-            input_pkt = self.request_queue.read()
+            input_pkt = self.request_queue.read(block=True, timeout=READ_TIMEOUT)
             if input_pkt is None:
-                sleep(0.01)
                 continue
 
-            d = input_pkt.encode()
+            d = pack_frame(input_pkt.encode(self.img_codec), self.framing)
 
             while True:
                 try:
-                    self.socket.send(HEADER + d)
+                    self.socket.sendall(d)
                     break 
                 except socket.error:
                     print('Cannot send pkt')
@@ -75,6 +91,11 @@ class NetClient:
                 sleep(1)
                 self.socket.close()
                 print('closed the socket, try reconnecting...')
+
+                # the server starts a new decoder, resend this pkt as keyframes
+                if self.img_codec is not None:
+                    self.img_codec.reset()
+                    d = pack_frame(input_pkt.encode(self.img_codec), self.framing)
                 
                 while True:
                     try:
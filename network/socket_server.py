@@ -4,23 +4,28 @@ from time import time, sleep
 import sys 
 import logging 
 
-from network.utils import Q
-from network.data_packet import DataPkt
+from network.utils import Q, HEADER, FRAMING_LENGTH, FRAMING_HEADER, FRAMING_MODES
+from network.utils import recv_frame
+from network.data_packet import load_pkts
+from network.frame_codec import StreamDecoder
 
 
 SOCKET_BUFF_SIZE = 2048
 QUEUE_SIZE = 128
-HEADER = b'\x00\x00CAESAR\x00\x00'
 
 
 class ServerThread(Thread):
-    def __init__(self, name, ip, port, sock, queue):
+    def __init__(self, name, ip, port, sock, queue, framing=FRAMING_LENGTH,
+                    split_batches=True):
         Thread.__init__(self)
         self.name = name
         self.ip = ip
         self.port = port
         self.sock = sock
         self.queue = queue
+        self.framing = framing
+        self.split_batches = split_batches
+        self.img_decoder = StreamDecoder()    # for clients with video_codec
 
         self.header = HEADER
         self.log("Server thread-" + ip + ":" + str(port))
@@ -32,13 +37,49 @@ class ServerThread(Thread):
         self.sock.close()
 
     def run(self):
+        if self.framing == FRAMING_HEADER:
+            self.run_header_scan()
+        else:
+            self.run_length_prefixed()
+
+        self.close()
+        self.log('Thread finished')
+
+    def run_length_prefixed(self):
+        ''' Read HEADER + payload length, then exactly that many bytes. 
+            A pkt is released as soon as its last byte arrives
+        '''
+        while True:
+            try:
+                d = recv_frame(self.sock)
+            except ValueError as e:
+                self.log('Stream out of sync: %s' % str(e))
+                break
+
+            if d is None:
+                self.log('Connection ended')
+                break
+
+            try:
+                pkts = load_pkts(d, self.split_batches)
+            except ValueError as e:
+                self.log('Drop bad pkt: %s' % str(e))
+                continue
+
+            for pkt in pkts:
+                if self.img_decoder.decode_pkt(pkt):
+                    self.queue.write(pkt)
+
+    def run_header_scan(self):
+        ''' Legacy framing: scan for HEADER, a pkt is released when the next
+            pkt's header arrives
+        '''
         d = b''
         while True:
             pkt_bytes = self.sock.recv(SOCKET_BUFF_SIZE)
 
             if not pkt_bytes:
                 self.log('Connection ended')
-                self.sock.close()
                 break
 
             d += pkt_bytes
@@ -53,21 +94,38 @@ class ServerThread(Thread):
 
             next_head += head + 1
             
-            pkt = DataPkt()
-            pkt.load_from_string(d[head + len(self.header): next_head])
+            try:
+                pkts = load_pkts(d[head + len(self.header): next_head],
+                                    self.split_batches)
+            except ValueError as e:
+                self.log('Drop bad pkt: %s' % str(e))
+                pkts = []
 
             d = d[next_head:]
             
-            self.queue.write(pkt)
-
-        self.close()
-        self.log('Thread finished')
+            for pkt in pkts:
+                if self.img_decoder.decode_pkt(pkt):
+                    self.queue.write(pkt)
 
 
 class NetServer(Thread):
-    def __init__(self, name, address, port, buffer_size):
+    def __init__(self, name, address, port, buffer_size, framing=FRAMING_LENGTH,
+                    split_batches=True):
+        '''
+        Args:
+        - name: the name of local machine 
+        - address, port: where to listen for incoming connections
+        - buffer_size: size of input data queue
+        - framing: FRAMING_LENGTH or FRAMING_HEADER (network/utils.py), must 
+            match the clients' framing
+        - split_batches: put the pkts of a received DataPktBatch into the
+            data queue one by one, otherwise the whole batch is one item
+        '''
         Thread.__init__(self)
+        assert framing in FRAMING_MODES, 'unknown framing %s' % framing
         self.name = name
+        self.framing = framing
+        self.split_batches = split_batches
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((address, port))
@@ -92,7 +150,9 @@ class NetServer(Thread):
                 ip, 
                 port, 
                 conn,
-                self.data_queue
+                self.data_queue,
+                framing=self.framing,
+                split_batches=self.split_batches,
             )
             newthread.setDaemon(True)
             newthread.start()
@@ -103,8 +163,8 @@ class NetServer(Thread):
             t.join()
         self.log('ended')
 
-    def read_data(self):
-        return self.data_queue.read()
+    def read_data(self, block=False, timeout=None):
+        return self.data_queue.read(block, timeout)
 
     def stop(self):
         self.running = False
@@ -1,5 +1,6 @@
-from multiprocessing import Queue
+from multiprocessing import Queue, Value
 import queue
+import struct
 from time import time 
 
 ''' Given a file path, extract its file name 
@@ -10,27 +11,200 @@ def fname(s):
     return '.'.join(s.split('.')[:-1])
 
 
+# socket framing 
+HEADER = b'\x00\x00CAESAR\x00\x00'
+
+# 'length': each pkt is sent as HEADER + 4-byte payload length + payload
+# 'header': legacy mode, pkts are only separated by HEADER  
+FRAMING_LENGTH = 'length'
+FRAMING_HEADER = 'header'
+FRAMING_MODES = (FRAMING_LENGTH, FRAMING_HEADER)
+
+FRAME_HEADER = struct.Struct('!%dsI' % len(HEADER))
+
+# max payload length of a frame, a larger one means the stream is corrupt 
+# (e.g. a DataPktBatch of 16 1080p frames is a few MB)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# flow-control acknowledgement from server to client (network/aio_server.py):
+# ACK_HEADER + 4-byte number of pkts received so far on the connection. Only
+# sent to the clients that read them, which ask for them by sending
+# ACK_HEADER + 0 as their first frame (network/aio_client.py)
+ACK_HEADER = b'\x00\x00CASACK\x00\x00'
+
+
+def pack_frame(d, framing=FRAMING_LENGTH):
+    ''' Return the bytes to put on the wire for one serialized pkt
+    '''
+    if framing == FRAMING_HEADER:
+        return HEADER + d
+    return FRAME_HEADER.pack(HEADER, len(d)) + d
+
+
+def recv_exact(sock, n):
+    ''' Read exactly n bytes from sock into a new bytearray with recv_into. 
+        Return None if the connection ended before that
+    '''
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        cnt = sock.recv_into(view[pos:], n - pos)
+        if not cnt:
+            return None
+        pos += cnt
+    return buf
+
+
+def recv_frame(sock):
+    ''' Read one length-prefixed frame from sock. Return the payload as a 
+        bytearray, or None if the connection ended 
+
+    Raise ValueError if the stream is out of sync (bad magic header, or a
+    length over MAX_FRAME_SIZE)
+    '''
+    head = recv_exact(sock, FRAME_HEADER.size)
+    if head is None:
+        return None
+
+    magic, length = FRAME_HEADER.unpack(head)
+    if magic != HEADER:
+        raise ValueError('bad frame header %s' % str(bytes(head)))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError('stream out of sync: frame of %d bytes' % length)
+
+    return recv_exact(sock, length)
+
+
 # queue operations 
+# What Q.write does when the queue is full:
+# - block: wait (up to write_timeout) until there is space
+# - drop_oldest: evict the oldest item to make space (keeps the freshest data)
+# - drop_newest: drop the new item
+# - sample: evict the oldest for one of every sample_rate new items, drop the 
+#           others, so the queue keeps a sparse sample of the incoming stream
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DROP_NEWEST = 'drop_newest'
+POLICY_SAMPLE = 'sample'
+QUEUE_POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_SAMPLE)
+
+# Max seconds a loop waits on an empty queue before checking if it should stop
+READ_TIMEOUT = 0.5
+EVICT_TIMEOUT = 0.05
+
+
 class Q:
-    def __init__(self, qsize):
+    def __init__(self, qsize, policy=POLICY_DROP_NEWEST, write_timeout=None,
+                    sample_rate=4, on_drop=None):
+        ''' A multiprocessing queue with an overflow policy and a drop counter
+            shared by all processes
+
+        Args:
+        - qsize: max number of items
+        - policy: one of QUEUE_POLICIES, see above 
+        - write_timeout: for POLICY_BLOCK, max seconds to wait (None: forever)
+        - sample_rate: for POLICY_SAMPLE
+        - on_drop: called with each item the queue evicts itself, e.g. 
+            ServerPkt.release to give back its tube imgs. Must be picklable 
+            (a module-level function or method) to be shared by processes
+        '''
+        assert policy in QUEUE_POLICIES, 'unknown queue policy %s' % policy
         self.q = Queue(qsize)
+        self.policy = policy
+        self.write_timeout = write_timeout
+        self.sample_rate = sample_rate
+        self.on_drop = on_drop
+        self.drops = Value('i', 0)
+        self.overflows = Value('i', 0)
+
+
+    def count_drop(self, v=None):
+        ''' Items evicted by the queue itself are passed to on_drop '''
+        with self.drops.get_lock():
+            self.drops.value += 1
+        if v is not None and self.on_drop is not None:
+            self.on_drop(v)
+
+
+    def evict_and_put(self, v):
+        try:
+            # short wait: a full queue may still have items in its feeder thread
+            self.count_drop(self.q.get(timeout=EVICT_TIMEOUT))
+        except queue.Empty:
+            pass
+        try:
+            self.q.put_nowait(v)
+            return True
+        except queue.Full:      # another writer took the space
+            self.count_drop()
+            return False
 
 
     def write(self, v):
+        ''' Return False if v is dropped because the queue is full
+        '''
         try:
             self.q.put_nowait(v)
+            return True
         except queue.Full:
             pass
 
+        if self.policy == POLICY_BLOCK:
+            try:
+                self.q.put(v, timeout=self.write_timeout)
+                return True
+            except queue.Full:
+                self.count_drop()
+                return False
 
-    def read(self):
+        if self.policy == POLICY_DROP_OLDEST:
+            return self.evict_and_put(v)
+
+        if self.policy == POLICY_SAMPLE:
+            with self.overflows.get_lock():
+                self.overflows.value += 1
+                keep = self.overflows.value % self.sample_rate == 0
+            if keep:
+                return self.evict_and_put(v)
+
+        self.count_drop()
+        return False
+
+
+    def read(self, block=False, timeout=None):
+        ''' Return the next item, or None if the queue is empty (non-blocking)
+            or nothing arrived within timeout seconds (blocking)
+        '''
         try:
-            d = self.q.get_nowait()
+            d = self.q.get(block, timeout)
             return d 
         except queue.Empty:
             return None
 
 
+    def read_many(self, n, timeout=None):
+        ''' Wait up to timeout seconds for the first item, then return it 
+            together with all items that are ready, at most n in total
+        '''
+        d = self.read(block=True, timeout=timeout)
+        if d is None:
+            return []
+
+        res = [d]
+        while len(res) < n:
+            d = self.read()
+            if d is None:
+                break
+            res.append(d)
+        return res
+
+
+    def drop_count(self):
+        ''' Number of items dropped so far, by all processes '''
+        return self.drops.value
+
+
     def empty(self):
         return self.q.empty()
 
@@ -4,15 +4,18 @@ from threading import Thread
 from copy import deepcopy
 import logging
 from server.action_graph import Act, load_graph_from_file
+from network.utils import READ_TIMEOUT
 
 
 MAX_GRAPH_CACHE_SIZE = 1000
 ACT_DEF_PATH = 'config/act_def.txt'
 
 class CompActDetector:
-    def __init__(self, in_queue, out_queue, filter_queue):
+    def __init__(self, in_queue, out_queue, filter_queue, crop_pool=None):
         self.in_queue = in_queue
         self.out_queue = out_queue
+        # the FramePool of the tube imgs, so dropped pkts can be released here
+        self.crop_pool = crop_pool
         # this queue includes all the tube ids that we need to run NN on
         self.filter_queue = filter_queue    
 
@@ -24,9 +27,8 @@ class CompActDetector:
 
     def run(self):
         while True:
-            server_pkt = self.in_queue.read()
+            server_pkt = self.in_queue.read(block=True, timeout=READ_TIMEOUT)
             if server_pkt is None:
-                sleep(0.01)
                 continue
 
             res = []
@@ -90,7 +92,8 @@ class CompActDetector:
                     )
                 )
 
-            self.out_queue.write(server_pkt)
+            if not self.out_queue.write(server_pkt):
+                server_pkt.release()   # dropped, give back its tube imgs
 
     def get_reid_act(self, cam_id, tube_label, tube_id, prev_cid, prev_tid):
         self.log("REID: (%s: %d) -> (%s: %d)" % (prev_cid, prev_tid, cam_id, tube_id))
@@ -6,10 +6,12 @@ import numpy as np
 import server.acam.action_detector as act
 from server.action_graph import Act
 from web.visualizer import Visualizer
+from network.utils import READ_TIMEOUT
 
 
-# will clean the tube from the cache if it's been inactive too long
-# the newly refreshed tube's age is 0 
+# will clean the tube from the cache if it's been inactive for more than this
+# number of tube_size frames (counted in frames, so it does not depend on how 
+# many frames each ServerPkt carries), the newly refreshed tube's age is 0 
 MAX_TUBE_AGE_IN_CACHE = 2
 
 # after how many rounds we have to process a non-filled cache
@@ -29,9 +31,13 @@ NN_ACT_THRES = {
                 }
 
 class NNActDetector:
-    def __init__(self, in_queue, out_queue, model_path, batch_size, tube_size, filter_queue):
+    def __init__(self, in_queue, out_queue, model_path, batch_size, tube_size, filter_queue,
+                    crop_pool=None, stride=None):
         self.in_queue = in_queue
         self.out_queue = out_queue
+        # the FramePool that holds the tube imgs, passed here so the pool 
+        # is attached in the NN process 
+        self.crop_pool = crop_pool
 
         self.model_path = model_path
         self.detector_dict = {}
@@ -40,6 +46,9 @@ class NNActDetector:
         self.batch_size = batch_size
         # the lenght of tube that will be feed to NN 
         self.tube_size = tube_size
+        # run the NN on the last tube_size clips of a tube every stride new
+        # clips, for overlapping tube windows (see ServerPktManager)
+        self.stride = stride or tube_size
         # this queue includes all the tube ids that we need to run NN on
         self.filter_queue = filter_queue
         # how many rounds that the cache is non empty and not processed
@@ -53,7 +62,7 @@ class NNActDetector:
         """ 
         Generate an empty tube data to fill the NN input 
         """
-        dummy_img = np.zeros((400, 400, 3))
+        dummy_img = np.zeros((400, 400, 3), np.uint8)
         dummy_roi = [0.25,0.25,0.75,0.75]
         return {
                 'imgs': [dummy_img for _ in range(self.tube_size)],
@@ -70,7 +79,7 @@ class NNActDetector:
             return []
 
         cache_underfilled = len(self.cache) < self.batch_size // 2
-        if cache_underfilled and self.non_empty_cache_round < MAX_TUBE_AGE_IN_CACHE:
+        if cache_underfilled and self.non_empty_cache_round < MAX_NON_EMPTY_CACHE_ROUND:
             self.non_empty_cache_round += 1
             return []
 
@@ -82,8 +91,11 @@ class NNActDetector:
         cam_ids = []
         tube_ids = []
 
+        tube_data_list = []
+
         for i in range(self.batch_size):
             tube_data = self.cache.popleft() if self.cache else self.dummy_tube
+            tube_data_list.append(tube_data)
             imgs.append(tube_data['imgs'])
             rois.append(tube_data['rois'][0])
             cam_ids.append(tube_data['cam_id'])
@@ -91,6 +103,9 @@ class NNActDetector:
 
         cur_time = time()
         probs = self.detect_on_tubes(imgs, rois)
+        for tube_data in tube_data_list:
+            for clip in tube_data.get('clips', []):
+                clip.release()
         # self.log("proc time: %f" % (time() - cur_time))
 
         res = []
@@ -161,50 +176,91 @@ class NNActDetector:
                                 'pred_probs': pred_probs
                             }
 
+    def cache_tube(self, cam_id, tid, clips):
+        """
+        Add the imgs and rois of the clips to self.cache for the NN 
+        """
+        tmp_tube_imgs = []
+        tmp_tube_rois = []
+        tmp_tube_clips = []
+        for clip in clips:
+            clip.retain()   # also kept for the next windows 
+            tmp_tube_imgs.append(clip.img)
+            tmp_tube_rois.append(clip.roi)
+            tmp_tube_clips.append(clip)
+
+        self.cache.append({'imgs': tmp_tube_imgs, 
+                            'rois': tmp_tube_rois,
+                            'clips': tmp_tube_clips,
+                            'cam_id': cam_id,
+                            'tube_id': tid})
+        # self.log('add tube %s to cache' % str(tid))
+
     def run(self):
         ''' 
         Input: from in_queue, read ServerPkt (server.server_packet_manager)
         Output: to out_queue, write ServerPkt (server.server_packet_manager)
         '''
         self.set_up_detector(self.model_path)
-        local_tube_cache = {}
+        local_tube_cache = {}    # (cam_id, tid) -> deque of TubeClip
+        tube_ages = {}           # (cam_id, tid) -> # of frames since last refresh
+        tube_last_fids = {}      # (cam_id, tid) -> frame id of the last clip
+        tube_new_cnts = {}       # (cam_id, tid) -> # of clips since last NN run
         # self.vis = Visualizer()
 
         while True:
-            server_pkt = self.in_queue.read()
+            server_pkt = self.in_queue.read(block=True, timeout=READ_TIMEOUT)
             if server_pkt is None:
-                sleep(0.01)
                 continue
 
+            cam_id = server_pkt.cam_id
+            for key in tube_ages:
+                if key[0] == cam_id:
+                    tube_ages[key] += len(server_pkt.pkts)
+
             for tube in server_pkt.tubes:
                 if tube.label != 'person':
                     continue 
 
                 tid = tube.tube_id
-                if tid not in local_tube_cache:
-                    local_tube_cache[tid] = deque()
-
+                key = (cam_id, tid)
+                if key not in local_tube_cache:
+                    local_tube_cache[key] = deque()
+                    tube_last_fids[key] = -1
+                    tube_new_cnts[key] = 0
+                tube_ages[key] = 0
+
+                clips = local_tube_cache[key]
                 for clip in tube.tube_clips:
-                    local_tube_cache[tid].append(clip)
-
-                if len(local_tube_cache[tid]) < self.tube_size:
-                    continue 
-
-                tmp_tube_imgs = []
-                tmp_tube_rois = []
-                for _ in range(self.tube_size):
-                    clip = local_tube_cache[tid].popleft()
-                    tmp_tube_imgs.append(clip.img)
-                    tmp_tube_rois.append(clip.roi)
-
-                self.cache.append({'imgs': tmp_tube_imgs, 
-                                    'rois': tmp_tube_rois,
-                                    'cam_id': server_pkt.cam_id,
-                                    'tube_id': tid})
-                # self.log('add tube %s to cache' % str(tid))
+                    # skip the clips already received with the previous window
+                    if clip.frame_id <= tube_last_fids[key]:
+                        continue 
+                    clip.retain()
+                    clips.append(clip)
+                    if len(clips) > self.tube_size:
+                        clips.popleft().release()
+                    tube_last_fids[key] = clip.frame_id
+                    tube_new_cnts[key] += 1
+
+                    # take the tube exactly at the stride-th new clip, so no
+                    # clip is dropped before it is classified 
+                    if len(clips) < self.tube_size or tube_new_cnts[key] < self.stride:
+                        continue 
+                    tube_new_cnts[key] = 0
+                    self.cache_tube(cam_id, tid, clips)
+
+            # clean the tubes that have been inactive too long 
+            max_age = MAX_TUBE_AGE_IN_CACHE * self.tube_size
+            for key in [k for k, age in tube_ages.items() if age > max_age]:
+                for clip in local_tube_cache.pop(key):
+                    clip.release()
+                del tube_ages[key]
+                del tube_last_fids[key]
+                del tube_new_cnts[key]
 
             server_pkt.actions += self.generate_actions()
-            self.out_queue.write(server_pkt)
+            if not self.out_queue.write(server_pkt):
+                server_pkt.release()   # dropped, give back its tube imgs
 
         self.log('finish')
 
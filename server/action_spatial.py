@@ -2,6 +2,7 @@ import numpy as np
 from time import time, sleep
 from collections import defaultdict
 from server.action_graph import Act
+from network.utils import READ_TIMEOUT
 import logging
 
 """
@@ -21,19 +22,6 @@ def box_dist(b1, b2):
             ((b1[1] + b1[3]) / 2 - (b2[1] + b2[3]) / 2) ** 2) ** 0.5 
 
 
-def get_boxes_within_fid_range(tube, t1, t2):
-    res = []
-    for clip in tube.tube_clips:
-        fid = clip.frame_id
-        if fid > t2:
-            break 
-        if fid < t1:
-            continue 
-        res.append(clip.box)
-
-    return res 
-
-
 """
 Spatial actions definition
 """
@@ -49,40 +37,107 @@ MOVEMENT_THRES_RATIO = 1.1
 CLOSE_MAX_RATIO = 1.8
 NEAR_MAX_RATIO = 3
 
-def tube_dist_relation(t1, t2):
+
+def tube_box_tensor(tubes):
     """
-    Return if the two tubes are far, near, or close; Also return if 
-    the two tubes (approach), (cross), or (leave) each other
+    Return the boxes of the tubes on a common frame axis: the sorted frame ids
+    (F,) of all clips, the (T, F, 4) boxes, and the (T, F) mask of the frames
+    each tube has a clip in
     """
-    start_fid = max(t1.tube_clips[0].frame_id, t2.tube_clips[0].frame_id)
-    end_fid = min(t1.tube_clips[-1].frame_id, t2.tube_clips[-1].frame_id)
-    if end_fid - start_fid < MIN_OVERLAP_FRAME_NUM:
-        return []
-    boxes1 = get_boxes_within_fid_range(t1, start_fid, end_fid)
-    boxes2 = get_boxes_within_fid_range(t2, start_fid, end_fid) 
-    b1_wid_avg = (boxes1[0][2] - boxes1[0][0]) / 2 +  (boxes1[-1][2] - boxes1[-1][0]) / 2
+    fids = np.unique([c.frame_id for t in tubes for c in t.tube_clips])
+    boxes = np.zeros((len(tubes), len(fids), 4))
+    mask = np.zeros((len(tubes), len(fids)), bool)
+    for i, t in enumerate(tubes):
+        idx = np.searchsorted(fids, [c.frame_id for c in t.tube_clips])
+        boxes[i, idx] = [c.box for c in t.tube_clips]
+        mask[i, idx] = True
+    return fids, boxes, mask
 
-    start_dist = box_dist(boxes1[0], boxes2[0]) / b1_wid_avg
-    mid_dist = box_dist(boxes1[len(boxes1)//2], boxes2[len(boxes2)//2]) / b1_wid_avg
-    end_dist = box_dist(boxes1[-1], boxes2[-1]) / b1_wid_avg
 
-    def _dist_relation(d):
-        if d < CLOSE_MAX_RATIO:
-            return 'close'
-        if d < NEAR_MAX_RATIO:
-            return 'near'
-        return 'far'
+def tube_dist_relations(tubes):
+    """
+    Return if each pair of tubes (but car-car pairs) is far, near, or close;
+    Also return if the two tubes (approach), (cross), or (leave) each other.
+    The distances at the start, middle, and end of the frames both tubes have
+    are relative to the avg box wid of t1
 
-    res = []
-    if end_dist <= mid_dist and start_dist - end_dist > MOVEMENT_THRES_RATIO:
-        res.append('approach')
-    elif min(end_dist, start_dist) - mid_dist > MOVEMENT_THRES_RATIO:
-        res.append('cross')
-    elif start_dist <= mid_dist and end_dist - start_dist > MOVEMENT_THRES_RATIO:
-        res.append('leave')
+    Return: a list of (i, j, relations) for the pairs (tubes[i], tubes[j]) that
+        have relations, with tubes[i] as t1 (the person of a car-person pair)
+    """
+    T = len(tubes)
+    if T < 2:
+        return []
+
+    a, b = np.triu_indices(T, 1)
+    labels = np.array([t.label for t in tubes])
+    swap = (labels[a] == 'car') & (labels[b] == 'person')
+    a, b = np.where(swap, b, a), np.where(swap, a, b)
+    keep = ~((labels[a] == 'car') & (labels[b] == 'car'))
+    a, b = a[keep], b[keep]
+
+    fids, boxes, mask = tube_box_tensor(tubes)
+
+    # overlapping frame range of each pair 
+    F = len(fids)
+    first = np.array([t.tube_clips[0].frame_id for t in tubes])
+    last = np.array([t.tube_clips[-1].frame_id for t in tubes])
+    start_fid = np.maximum(first[a], first[b])
+    end_fid = np.minimum(last[a], last[b])
+    keep = end_fid - start_fid >= MIN_OVERLAP_FRAME_NUM
+    a, b = a[keep], b[keep]
+    s = np.searchsorted(fids, start_fid[keep])
+    e = np.searchsorted(fids, end_fid[keep])
+
+    # the k-th clip of a tube within the range, by a searchsorted over the 
+    # clip counts of all tubes, each row offset to keep the rows apart 
+    cnt = np.cumsum(mask, axis=1)
+    offsets = np.arange(T) * (F + 1)
+    flat = (cnt + offsets[:, None]).ravel()
+
+    def clip_index(t, k):
+        return np.searchsorted(flat, offsets[t] + k) - t * F
+
+    def range_clips(t):
+        before = cnt[t, s] - mask[t, s]
+        n = cnt[t, e] - before
+        return n, [clip_index(t, before + k) for k in (1, n // 2 + 1, np.maximum(n, 1))]
+
+    n1, (f1, m1, l1) = range_clips(a)
+    n2, (f2, m2, l2) = range_clips(b)
+    keep = (n1 > 0) & (n2 > 0)
+
+    def dists(i1, i2):
+        b1, b2 = boxes[a, i1], boxes[b, i2]
+        return (((b1[:, 0] + b1[:, 2]) / 2 - (b2[:, 0] + b2[:, 2]) / 2) ** 2 +
+                ((b1[:, 1] + b1[:, 3]) / 2 - (b2[:, 1] + b2[:, 3]) / 2) ** 2) ** 0.5
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b1_wid_avg = (boxes[a, f1, 2] - boxes[a, f1, 0]) / 2 + \
+                        (boxes[a, l1, 2] - boxes[a, l1, 0]) / 2
+        start_dist = dists(f1, f2) / b1_wid_avg
+        mid_dist = dists(m1, m2) / b1_wid_avg
+        end_dist = dists(l1, l2) / b1_wid_avg
+
+        approach = (end_dist <= mid_dist) & (start_dist - end_dist > MOVEMENT_THRES_RATIO)
+        cross = ~approach & \
+                (np.minimum(end_dist, start_dist) - mid_dist > MOVEMENT_THRES_RATIO)
+        leave = ~approach & ~cross & (start_dist <= mid_dist) & \
+                (end_dist - start_dist > MOVEMENT_THRES_RATIO)
+        close = mid_dist < CLOSE_MAX_RATIO
+        near = ~close & (mid_dist < NEAR_MAX_RATIO)
 
-    res.append(_dist_relation(mid_dist))
-    return res 
+    res = []
+    for k in np.flatnonzero(keep):
+        r = []
+        if approach[k]:
+            r.append('approach')
+        elif cross[k]:
+            r.append('cross')
+        elif leave[k]:
+            r.append('leave')
+        r.append('close' if close[k] else 'near' if near[k] else 'far')
+        res.append((int(a[k]), int(b[k]), r))
+    return res
 
 
 MOVING_SEG_SIZE = 10
@@ -118,9 +173,11 @@ def moving_status(tube):
 MAX_INACTIVE_FRAME_NUM = 120
 
 class SpatialActDetector:
-    def __init__(self, in_queue, out_queue):
+    def __init__(self, in_queue, out_queue, crop_pool=None):
         self.in_queue = in_queue
         self.out_queue = out_queue
+        # the FramePool of the tube imgs, so dropped pkts can be released here
+        self.crop_pool = crop_pool
 
         # A dict that record the last active frame_id of each tube: 
         # key-(cam_id, label, tube_id),     val-last_frame_id
@@ -170,28 +227,6 @@ class SpatialActDetector:
 
         return res
 
-    def get_cross_actions(self, t1, t2):
-        ''' Currently we handle (attach obj), (car-person), and (person person).
-
-        Args: 
-        - tube t1, t2: (label, tube_id, tube_clips, overlap_objs)
-
-        Return: a list of Act (server.action_graph.py)
-        '''
-        if t1.label == t2.label == 'car':  # skip the both-car case
-            return []
-        if t1.label == 'car' and t2.label == 'person':
-            t2, t1 = t1, t2
-
-        res = []
-
-        dist_relations = tube_dist_relation(t1, t2)
-        for r in dist_relations:
-            res.append(Act(r, t1.label, t1.tube_id, t2.label, t2.tube_id))
-            res.append(Act(r, t2.label, t2.tube_id, t1.label, t1.tube_id))
-        
-        return res
-
     def run(self):
         ''' 
         Input: from in_queue, read ServerPkt (server.server_packet)
@@ -199,24 +234,34 @@ class SpatialActDetector:
         '''
         logging.basicConfig(level=logging.DEBUG)
         while True:
-            server_pkt = self.in_queue.read()
+            server_pkt = self.in_queue.read(block=True, timeout=READ_TIMEOUT)
             if server_pkt is None:
-                sleep(0.01)
                 continue
 
             res = []
             tubes = server_pkt.tubes
             cam_id = server_pkt.cam_id
+
+            # relations of all tube pairs, computed together 
+            cross_actions = defaultdict(list)
+            for i, j, relations in tube_dist_relations(tubes):
+                t1, t2 = tubes[i], tubes[j]
+                for r in relations:
+                    cross_actions[min(i, j)].append(
+                                    Act(r, t1.label, t1.tube_id, t2.label, t2.tube_id))
+                    cross_actions[min(i, j)].append(
+                                    Act(r, t2.label, t2.tube_id, t1.label, t1.tube_id))
+
             for i in range(len(tubes)):
                 res += self.get_single_actions(cam_id, tubes[i])
-                for j in range(i + 1, len(tubes)):
-                    res += self.get_cross_actions(tubes[i], tubes[j])
+                res += cross_actions[i]
 
             # get "end" actions 
             res += self.get_end_actions(server_pkt.get_first_frame_id())
 
             server_pkt.actions += res
-            self.out_queue.write(server_pkt)
+            if not self.out_queue.write(server_pkt):
+                server_pkt.release()   # dropped, give back its tube imgs
 
     def log(self, s):
         logging.debug('[Spatial] %s' % s)
@@ -3,16 +3,20 @@ import cv2
 import logging
 import numpy as np
 from time import time, sleep
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from server.action_graph import Act
 from server.action_spatial import overlap
-from network.data_packet import DataPkt
-from network.utils import Q
+from network.data_packet import DataPkt, DataPktBatch
+from network.utils import Q, READ_TIMEOUT
 
 
 CONTEXT_BOX_RATIO = 1.3
 CROP_IMG_SIZE = (400, 400)
 
+# number of threads cropping the tube imgs as the pkts arrive
+CROP_WORKERS = 2
+
 class ServerPkt:
     def __init__(self, cam_id, pkts, tubes, reid={}):
         ''' Pkt passed from TM to Spatial, NN, and Complex Act
@@ -70,58 +74,197 @@ class ServerPkt:
         for p in self.pkts:
             yield p
 
+    def release(self):
+        """ Give back the tube images held in the crop pool (if any) """
+        for tube in self.tubes:
+            for clip in tube.tube_clips:
+                clip.release()
+
 
-def generate_clip_image_roi(box, whole_frame, context_box_ratio=CONTEXT_BOX_RATIO, dst_img_size=CROP_IMG_SIZE):
+def clip_context_bounds(box, frame_shape, context_box_ratio=CONTEXT_BOX_RATIO):
     """
-    Return image and the roi for action detection tube image (each frame)
+    Return the part of the frame around the box used for its tube image
 
-    Params: 
-    - box: absolute x0, y0, x1, y1 in the whole frame 
-    - whole_frame: the whole frame 
+    Params:
+    - box: absolute x0, y0, x1, y1 in the whole frame
+    - frame_shape: (H, W) of the whole frame
     - context_box_ratio: the context square's edge length L = (w + h) * context_box_ratio
-    - dst_img_size: resize the context square to this shape 
 
     Return:
-    img, roi
+    [left, bottom, right, top] in pixels, as a region [x0, y0, x1, y1]
     """
-    H, W, _ = whole_frame.shape
+    H, W = frame_shape[:2]
     box_center = [(box[0] + box[2]) // 2, (box[1] + box[3]) // 2]
-    box_wid = (box[2] - box[0])
-    box_hei = (box[3] - box[1])
-    edge = int(min((box_wid + box_hei) * context_box_ratio, H))
+    edge = int(min(((box[2] - box[0]) + (box[3] - box[1])) * context_box_ratio, H))
     h_edge = edge // 2     # half edge size 
 
     left_bound = max(0, box_center[0] - h_edge + 1)
     bottom_bound = max(0, box_center[1] - h_edge + 1)
     right_bound = min(W - 1, box_center[0] + h_edge - 1)
     top_bound = min(H - 1, box_center[1] + h_edge - 1)
+    return [left_bound, bottom_bound, right_bound, top_bound]
 
-    frame_crop = whole_frame[bottom_bound:top_bound, left_bound:right_bound]
-    left_paste_pos = h_edge - (box_center[0] - left_bound)
-    bottom_paste_pos = h_edge - (box_center[1] - bottom_bound)
 
-    img_crop = np.zeros((edge, edge, 3), np.uint8)
-    img_crop[bottom_paste_pos:bottom_paste_pos+(top_bound-bottom_bound),
-            left_paste_pos:left_paste_pos+(right_bound-left_bound)] = frame_crop
+def clip_transforms(boxes, frame_shape, context_box_ratio=CONTEXT_BOX_RATIO,
+                    dst_img_size=CROP_IMG_SIZE):
+    """
+    Return the geometry of the tube images of several boxes of one frame: the
+    context square around each box (see clip_context_bounds), scaled to
+    dst_img_size, with the parts outside the frame black
 
-    img = cv2.resize(img_crop, dst_img_size)
-    roi = [(h_edge - box_wid/2) / edge, (h_edge - box_hei/2) / edge, 
-            (h_edge + box_wid/2) / edge, (h_edge + box_hei/2) / edge]
-    
-    return img, roi
+    Params:
+    - boxes: (N, 4) absolute x0, y0, x1, y1 in the whole frame
+    - frame_shape: (H, W) of the whole frame
+    - context_box_ratio, dst_img_size: see generate_clip_image_roi
+
+    Return:
+    bounds (N, 4) as clip_context_bounds, the (N, 4) rectangles x0, y0, x1, y1
+    in the tube images the bounds regions are scaled to, rois (N, 4)
+    """
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    H, W = frame_shape[:2]
+    box_wid = boxes[:, 2] - boxes[:, 0]
+    box_hei = boxes[:, 3] - boxes[:, 1]
+    centers = (boxes[:, :2] + boxes[:, 2:]) // 2
+    edge = np.minimum((box_wid + box_hei) * context_box_ratio, H).astype(np.int64)
+    h_edge = edge // 2     # half edge size 
+
+    bounds = np.empty((len(boxes), 4), np.int64)
+    bounds[:, :2] = np.maximum(0, centers - h_edge[:, None] + 1)
+    bounds[:, 2] = np.minimum(W - 1, centers[:, 0] + h_edge - 1)
+    bounds[:, 3] = np.minimum(H - 1, centers[:, 1] + h_edge - 1)
+
+    # where the region is in the context square, scaled to the tube image 
+    paste_pos = h_edge[:, None] - (centers - bounds[:, :2])
+    scale = np.asarray(dst_img_size, np.float64) / np.maximum(edge, 1)[:, None]
+    rects = np.c_[paste_pos, paste_pos + bounds[:, 2:] - bounds[:, :2]]
+    rects = np.rint(rects * np.tile(scale, 2)).astype(np.int64)
+
+    edge = np.maximum(edge, 1)[:, None]
+    rois = np.c_[h_edge - box_wid / 2, h_edge - box_hei / 2,
+                h_edge + box_wid / 2, h_edge + box_hei / 2] / edge
+    return bounds, rects, rois
+
+
+def generate_clip_images_rois(boxes, frames, context_box_ratio=CONTEXT_BOX_RATIO,
+                            dst_img_size=CROP_IMG_SIZE, frame_shape=None, outs=None):
+    """
+    Batched generate_clip_image_roi over the boxes of one frame: the region of
+    each box is resized straight into its place in the output buffer, and the
+    rest of the buffer (outside the frame) is filled black
+
+    Params: 
+    - boxes: a list of absolute x0, y0, x1, y1 in the whole frame 
+    - frames: the whole frame, or a list with the region of each box given by
+        clip_context_bounds() if frame_shape is given
+    - frame_shape: (H, W) of the whole frame, if frames are the regions
+    - outs: uint8 buffers of dst_img_size (h, w, 3) to write the images into,
+        allocated if None
+
+    Return:
+    a list of imgs, a list of rois
+    """
+    is_region = frame_shape is not None
+    if not is_region:
+        frame_shape = frames.shape
+    bounds, rects, rois = clip_transforms(boxes, frame_shape,
+                                            context_box_ratio, dst_img_size)
+    if outs is None:
+        outs = [np.empty((dst_img_size[1], dst_img_size[0], 3), np.uint8)
+                    for _ in range(len(bounds))]
+
+    for i, (x0, y0, x1, y1) in enumerate(bounds.tolist()):
+        src = frames[i] if is_region else frames[y0:y1, x0:x1]
+        out = outs[i]
+        rx0, ry0, rx1, ry1 = rects[i].tolist()
+        if src is None or not src.size or rx1 <= rx0 or ry1 <= ry0:
+            out[:] = 0
+            continue
+        out[:ry0] = 0
+        out[ry1:] = 0
+        out[ry0:ry1, :rx0] = 0
+        out[ry0:ry1, rx1:] = 0
+        cv2.resize(src, (rx1 - rx0, ry1 - ry0), dst=out[ry0:ry1, rx0:rx1])
+    return outs, rois.tolist()
+
+
+def generate_clip_image_roi(box, whole_frame, context_box_ratio=CONTEXT_BOX_RATIO,
+                            dst_img_size=CROP_IMG_SIZE, frame_shape=None, out=None):
+    """
+    Return image and the roi for action detection tube image (each frame)
+
+    Params: 
+    - box: absolute x0, y0, x1, y1 in the whole frame 
+    - whole_frame: the whole frame, or only its region given by
+        clip_context_bounds() if frame_shape is given
+    - context_box_ratio: the context square's edge length L = (w + h) * context_box_ratio
+    - dst_img_size: resize the context square to this shape 
+    - frame_shape: (H, W) of the whole frame, if whole_frame is only the region
+    - out: uint8 buffer to write the image into
+
+    Return:
+    img, roi
+    """
+    frames = [whole_frame] if frame_shape is not None else whole_frame
+    imgs, rois = generate_clip_images_rois([box], frames, context_box_ratio,
+                        dst_img_size, frame_shape, None if out is None else [out])
+    return imgs[0], rois[0]
+
+
+def crop_tube_clips(boxes, frame_id, frames, crop_pool=None, frame_shape=None):
+    """
+    Return the TubeClips of the boxes of one frame
+
+    Params: 
+    - boxes: a list of absolute x0, y0, x1, y1 in the whole frame 
+    - frame_id: ..
+    - frames: see generate_clip_images_rois
+    - crop_pool: if given, the tube imgs are written straight into this shared
+        memory FramePool (network/frame_pool.py) and only their handles are
+        pickled
+    - frame_shape: (H, W) of the whole frame, if frames are the regions
+    """
+    refs, outs = [], []
+    for _ in boxes:
+        ref = crop_pool.alloc() if crop_pool is not None else None
+        refs.append(ref)
+        outs.append(ref.get() if ref is not None else
+                    np.empty((CROP_IMG_SIZE[1], CROP_IMG_SIZE[0], 3), np.uint8))
+
+    imgs, rois = generate_clip_images_rois(boxes, frames, frame_shape=frame_shape,
+                                            outs=outs)
+    return [TubeClip(box, frame_id, roi, img, ref)
+                for box, roi, img, ref in zip(boxes, rois, imgs, refs)]
 
 
 class TubeClip:
-    def __init__(self, box, frame_id, whole_frame):
+    def __init__(self, box, frame_id, roi, img, img_ref=None):
         """
         Params: 
         - box: absolute x0, y0, x1, y1 in the whole frame 
         - frame_id: ..
-        - whole_frame: the whole frame 
+        - roi: the box in the tube img, in ratios
+        - img: the tube img (see crop_tube_clips)
+        - img_ref: the handle of img if it's kept in a crop pool
         """
         self.box = box
         self.frame_id = frame_id
-        self.img, self.roi = generate_clip_image_roi(box, whole_frame)
+        self.roi = roi
+        self.img_ref = img_ref
+        self._img = img if self.img_ref is None else None
+
+    @property
+    def img(self):
+        return self.img_ref.get() if self.img_ref is not None else self._img
+
+    def retain(self):
+        """ Keep the tube img alive after the ServerPkt is released """
+        if self.img_ref is not None:
+            self.img_ref.retain()
+
+    def release(self):
+        if self.img_ref is not None:
+            self.img_ref.release()
 
     
 class Tube:
@@ -139,98 +282,183 @@ class Tube:
         self.overlap_objs = set()
     
 
-    def add_tube_clip(self, box, frame_id, img):
+    def add_tube_clip(self, box, frame_id, img, crop_pool=None, frame_shape=None):
         """
         Add one tube clip to the tube 
         """
-        self.tube_clips.append(TubeClip(box, frame_id, img))
+        frames = [img] if frame_shape is not None else img
+        self.tube_clips += crop_tube_clips([box], frame_id, frames, crop_pool, frame_shape)
         
 
+class TubeFrame:
+    ''' One frame of a tube in the PktCache window '''
+    __slots__ = ('pkt_index', 'pkt', 'obj', 'overlap_objs', 'future', 'k')
+
+    def __init__(self, pkt_index, pkt, obj, overlap_objs):
+        self.pkt_index = pkt_index
+        self.pkt = pkt
+        self.obj = obj
+        self.overlap_objs = overlap_objs
+        self.future = None      # crop job of the frame's pkt, once started
+        self.k = 0              # index of the TubeClip in the job result
+
+    def clip(self):
+        return self.future.result()[self.k]
+
+
+def crop_objs(pkt, objs, crop_pool=None):
+    ''' Return the TubeClip of each obj in pkt, or None if its frame is not
+        available. Run in the crop workers of PktCache
+    '''
+    # metadata-only pkt: fetch only the regions of the tubes 
+    frames, frame_shape = pkt.img, None
+    if pkt.is_frame_ref():
+        frame_shape = pkt.frame_ref()[1]
+        frames = pkt.fetch_rois([clip_context_bounds(obj['box'], frame_shape)
+                                    for obj in objs])
+    if frames is None:
+        logging.debug('[PktCache] frame %d of %s is not available' % (
+                        pkt.frame_id, pkt.cam_id))
+        return [None] * len(objs)
+
+    return crop_tube_clips([obj['box'] for obj in objs], pkt.frame_id, frames,
+                            crop_pool, frame_shape)
+
+
 class PktCache:
-    def __init__(self, track_list, overlap_list, max_tube_size, min_tube_size):
-        ''' Cache the pkts of a camera, other modules can query for original images
+    def __init__(self, track_list, overlap_list, max_tube_size, min_tube_size,
+                    crop_pool=None, executor=None, stride=None):
+        ''' Cache the pkts of a camera, other modules can query for original images.
+            The tubes of the last max_tube_size pkts (the window) are output
+            every stride pkts, so consecutive windows overlap if stride is
+            smaller. The tubes are built as the pkts arrive: once a tube has
+            min_tube_size frames in the window, its tube imgs are cropped by
+            the executor (and those of its later frames on arrival), and they
+            are reused by the following windows
+
+        Args:
+        - executor: concurrent.futures executor for the crops, None to crop
+            in the calling thread
+        - stride: number of new pkts between two windows, max_tube_size if None
         '''
-        self.pkts = []                  # a list of pkts for this camera
+        self.pkts = deque()             # the pkts in the window
+        self.pkt_cnt = 0                # number of pkts received
+        self.new_cnt = 0                # number of pkts since the last window
+        self.crop_pool = crop_pool      # shared memory pool for tube imgs
+        self.executor = executor
 
         self.track_list = track_list  # list of obj labels that will be tracked
         self.overlap_list = overlap_list  # list of objs that will be attachement
-        self.max_tube_size = max_tube_size  # output when receive max_size new pkts
+        self.max_tube_size = max_tube_size  # window size in pkts
         self.min_tube_size = min_tube_size  # min frame number of a valid tube
+        self.stride = stride or max_tube_size  # output when receive stride new pkts
+        self.tubes = OrderedDict()      # (label, tid): deque of TubeFrame
         self.reid = {}
 
         self.log('init')
 
     def is_full(self):
-        """ return true if cache is full """
-        return len(self.pkts) >= self.max_tube_size
+        """ return true if a window is ready """
+        return self.new_cnt >= self.stride
+
+    def new_pkts(self):
+        """ return the pkts since the last window """
+        return list(self.pkts)[len(self.pkts) - self.new_cnt:]
+
+    def crop(self, pkt, objs):
+        ''' Start cropping the tube imgs of objs in one pkt, return a future '''
+        if self.executor is None:
+            future = Future()
+            future.set_result(crop_objs(pkt, objs, self.crop_pool))
+            return future
+        return self.executor.submit(crop_objs, pkt, objs, self.crop_pool)
+
+    def add_pkt(self, pkt):
+        ''' Cache one pkt and update the tubes with its objs '''
+        i = self.pkt_cnt
+        self.pkts.append(pkt)
+        self.pkt_cnt += 1
+        self.new_cnt += 1
+
+        overlap_boxes = [(obj['label'], obj['box']) for obj in pkt.meta
+                            if obj['label'] in self.overlap_list]
+
+        to_crop = defaultdict(list)     # pkt: TubeFrames of the valid tubes
+        for obj in pkt.meta:
+            if 'id' not in obj or obj['label'] not in self.track_list:
+                continue
+            label, tid, box = obj['label'], obj['id'], obj['box']
+
+            # find overlapped obj for person tubes
+            overlap_objs = set()
+            if label == 'person':
+                overlap_objs = {obj_label for obj_label, obj_box in overlap_boxes
+                                    if overlap(box, obj_box)}
+
+            if (label, tid) not in self.tubes:
+                self.tubes[label, tid] = deque()
+            frames = self.tubes[label, tid]
+            frames.append(TubeFrame(i, pkt, obj, overlap_objs))
+            if len(frames) < self.min_tube_size:
+                continue
 
-    def get_all_valid_tubes(self):
-        ''' Return a dict {label: [tube_id]} of tubes that long enough
-        '''
-        valid_tubes = defaultdict(int)
+            # the tube just became valid: crop its frames not cropped yet 
+            for f in reversed(frames):
+                if f.future is not None:
+                    break
+                to_crop[f.pkt_index].append(f)
 
-        for pkt in self.pkts:
-            for obj in pkt.meta:
-                if 'id' in obj and obj['label'] in self.track_list:
-                    valid_tubes[obj['label'], obj['id']] += 1
+        # one crop job per pkt 
+        for frames in to_crop.values():
+            future = self.crop(frames[0].pkt, [f.obj for f in frames])
+            for k, f in enumerate(frames):
+                f.future, f.k = future, k
 
-        res = set()
-        for label, tid in valid_tubes.keys():
-            if valid_tubes[label, tid] >= self.min_tube_size:
-                res.add((label, tid))
-        return res
-
-    def get_overlap_obj_list(self):
-        ''' Return a list of overlap obj box position: [{label: [box_pos]}]
+    def generate_tubes(self):
         '''
+        Return a lis of tubes for all valid tubes in the window, with the
+            re-id marks of the new pkts in self.reid
+        '''
+        first_new = self.pkt_cnt - self.new_cnt
         res = []
-        for pkt in self.pkts:
-            cur = {}
-            for obj in pkt.meta:
-                label = obj['label']
-                if label in self.overlap_list:
-                    if not label in cur:
-                        cur[label] = []
-                    cur[label].append(obj['box'])
-            res.append(cur)
+        for (label, tid), frames in self.tubes.items():
+            if len(frames) < self.min_tube_size:
+                continue    # skip tubes that are too short
+
+            tube = Tube(label, tid)
+            for f in frames:
+                clip = f.clip()
+                if clip is not None:
+                    clip.retain()   # the cache keeps its own ref for later windows
+                    tube.tube_clips.append(clip)
+                tube.overlap_objs |= f.overlap_objs
+                if 'reid' in f.obj and f.pkt_index >= first_new:
+                    # mark original tid and cid if tube just reided
+                    self.reid[tid] = f.obj['reid']
+            if tube.tube_clips:
+                res.append(tube)
 
         return res
 
-    def generate_tubes(self):
+    def slide(self):
+        ''' Drop the pkts that are not in the next window, and the tubes imgs
+            of their frames
         '''
-        Return a lis of tubes for all valid tubes in the cacahed packets
-        '''
-        valid_track_ids = self.get_all_valid_tubes()
-        overlap_objs = self.get_overlap_obj_list()
-
-        res = {}
-        for label, tid in valid_track_ids:
-            res[label, tid] = Tube(label, tid)
-
-        for i, pkt in enumerate(self.pkts):
-            for obj in pkt.meta:
-                if 'id' not in obj:   # skip item that not being tracked
-                    continue
-
-                label, tid, box = obj['label'], obj['id'], obj['box']
-                if (label, tid) not in res:   # skip tubes that are too short
-                    continue
-
-                if 'reid' in obj:     # mark original tid and cid if tube just reided
-                    self.reid[tid] = obj['reid']
-
-                tube = res[label, tid]
-                tube.add_tube_clip(box, pkt.frame_id, pkt.img)
-
-                # find overlapped obj for person tubes
-                if label == 'person':
-                    for obj_label in overlap_objs[i]:
-                        for obj_box in overlap_objs[i][obj_label]:
-                            if overlap(box, obj_box):
-                                tube.overlap_objs.add(obj_label)
-                                break
-
-        return [tube for _, tube in res.items()]
+        self.new_cnt = 0
+        self.reid = {}
+        keep = max(0, self.max_tube_size - self.stride)
+        while len(self.pkts) > keep:
+            self.pkts.popleft()
+        first = self.pkt_cnt - len(self.pkts)
+
+        for key in list(self.tubes.keys()):
+            frames = self.tubes[key]
+            while frames and frames[0].pkt_index < first:
+                f = frames.popleft()
+                if f.future is not None and f.clip() is not None:
+                    f.clip().release()
+            if not frames:
+                del self.tubes[key]
 
     def log(self, s):
         logging.debug('[PktCache] %s' % s)
@@ -242,7 +470,8 @@ MIN_TUBE_SIZE_DEFAULT = 8
 class ServerPktManager:
     def __init__(self, in_queue, out_queue, track_list, overlap_list,
                     max_tube_size=MAX_TUBE_SIZE_DEFAULT,
-                    min_tube_size=MIN_TUBE_SIZE_DEFAULT):
+                    min_tube_size=MIN_TUBE_SIZE_DEFAULT,
+                    crop_pool=None, crop_workers=CROP_WORKERS, stride=None):
         ''' Batch Datapkt (frames and boxes) into ServerPkt (frame_batch and tubes)
             Also extract attachment object for person tubes, filter too short tubes,
             and re-identify person tubes. Main function: run
@@ -252,47 +481,72 @@ class ServerPktManager:
         - out_queue: queue that contains output data
         - track_list: a list of trackable labels
         - overlap_list: a list of overlappable labels for human attachment
-        - max_tube_size: max # of frames in a tube
+        - max_tube_size: max # of frames in a tube, i.e. the window size
         - min_tube_size: min # of frames in a tube
+        - crop_pool: FramePool (network/frame_pool.py) for the tube imgs, so
+            the following processes only receive handles to them
+        - crop_workers: number of threads cropping the tube imgs, 0 to crop
+            in the thread of run()
+        - stride: output the tubes of the last max_tube_size frames every
+            stride frames, max_tube_size (non-overlapping chunks) if None
         '''
+        self.crop_workers = crop_workers
+        self.executor = None    # started in the process that runs the manager
 
         # temporary cache the packets
         self.caches = defaultdict(lambda: PktCache(track_list=track_list,
                                                 overlap_list=overlap_list,
                                                 max_tube_size=max_tube_size,
-                                                min_tube_size=min_tube_size))
+                                                min_tube_size=min_tube_size,
+                                                crop_pool=crop_pool,
+                                                executor=self.get_executor(),
+                                                stride=stride))
         self.in_queue = in_queue
         self.out_queue = out_queue
         self.log('init')
 
+    def get_executor(self):
+        if self.executor is None and self.crop_workers > 0:
+            self.executor = ThreadPoolExecutor(self.crop_workers)
+        return self.executor
+
+    def add_pkt(self, pkt):
+        ''' Cache one DataPkt, output a ServerPkt when the cache of its camera
+            is full
+        '''
+        cam_id = pkt.cam_id
+        cache = self.caches[cam_id]
+        cache.add_pkt(pkt)
+
+        if not cache.is_full():  # continue if cache not full
+            return
+
+        # init the server pkt with the new frames and the tubes of the window
+        output_pkt = ServerPkt(cam_id=cam_id,
+                                pkts=cache.new_pkts(),
+                                tubes=cache.generate_tubes(),
+                                reid=cache.reid)
+
+        if not self.out_queue.write(output_pkt):
+            output_pkt.release()   # dropped, give back its tube imgs
+        cache.slide()
+
     def run(self):
         '''
-        Input: read from in_queue, input is DataPkt (network.data_packet)
+        Input: read from in_queue, input is DataPkt or DataPktBatch (network.data_packet)
 
         Output: write to outqueue, output is ServerPkt (server.server_packet)
         '''
         while True:
-            pkt = self.in_queue.read()
+            pkt = self.in_queue.read(block=True, timeout=READ_TIMEOUT)
             if pkt is None:
-                sleep(0.01)
                 continue
 
-            cam_id = pkt.cam_id
-            cache = self.caches[cam_id]
-            cache.pkts.append(pkt)
-
-            if not cache.is_full():  # continue if cache not full
-                continue
-
-            # init the server pkt with frames and frame ids
-            output_pkt = ServerPkt(cam_id=cam_id,
-                                    pkts=cache.pkts,
-                                    tubes=cache.generate_tubes(),
-                                    reid=cache.reid)
-
-            self.out_queue.write(output_pkt)
-            cache.pkts = []
-            cache.reid = {}
+            if isinstance(pkt, DataPktBatch):
+                for p in pkt:
+                    self.add_pkt(p)
+            else:
+                self.add_pkt(pkt)
 
     def log(self, s):
         logging.debug('[ServerPktManager] %s' % s)
@@ -0,0 +1,65 @@
+import socket
+import unittest
+import numpy as np
+
+from network.data_packet import DataPkt, IMG_DELTA
+from network.frame_codec import StreamEncoder, FrameDecoder, DELTA_HEADER
+from network.socket_server import ServerThread
+from network.utils import Q, pack_frame
+
+
+class GarbageCodec:
+    ''' Sends the given bytes as the delta of every img '''
+    def __init__(self, data):
+        self.data = data
+
+    def encode_img(self, cam_id, img):
+        return self.data, IMG_DELTA
+
+
+def make_img(seed):
+    return np.random.default_rng(seed).integers(0, 255, (96, 128, 3), np.uint8)
+
+
+class TestMalformedDelta(unittest.TestCase):
+    def test_decoder_drops_bad_deltas(self):
+        enc = StreamEncoder()
+        data, flags = enc.encode_img('c', make_img(0))
+        bad_deltas = [
+            b'\x01\x02',                                        # truncated header
+            DELTA_HEADER.pack(1, 128, 96, 32, 3),               # no block ids
+            DELTA_HEADER.pack(1, 128, 96, 32, 1) + b'\xff\xff\x00\x00',  # bad id
+            DELTA_HEADER.pack(1, 128, 96, 0, 0),                # no block size
+            DELTA_HEADER.pack(1, 128, 96, 32, 1) + b'\x00' * 4 + b'garbage',
+        ]
+        for delta in bad_deltas:
+            dec = FrameDecoder()
+            self.assertIsNotNone(dec.decode(data, flags))
+            self.assertIsNone(dec.decode(delta, IMG_DELTA))
+
+    def test_server_thread_keeps_serving(self):
+        server_sock, client_sock = socket.socketpair()
+        queue = Q(16)
+        thread = ServerThread('test', 'localhost', 0, server_sock, queue)
+        thread.daemon = True
+        thread.start()
+
+        enc = StreamEncoder()
+        pkts = [DataPkt(img=make_img(0), cam_id='c', frame_id=0).encode(enc),
+                DataPkt(img=make_img(1), cam_id='c', frame_id=1).encode(
+                                                    GarbageCodec(b'\x01\x02')),
+                DataPkt(img=make_img(2), cam_id='c', frame_id=2).encode(
+                        GarbageCodec(DELTA_HEADER.pack(1, 128, 96, 32, 9))),
+                DataPkt(img=make_img(3), cam_id='c', frame_id=3).encode()]
+        for d in pkts:
+            client_sock.sendall(pack_frame(d))
+
+        frame_ids = [queue.read(block=True, timeout=5).frame_id for _ in range(2)]
+        self.assertEqual(frame_ids, [0, 3])
+        self.assertTrue(thread.is_alive())
+        client_sock.close()
+        thread.join(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
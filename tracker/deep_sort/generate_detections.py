@@ -55,7 +55,7 @@ def extract_image_patch(image, bbox, patch_shape):
 
     # convert to top left, bottom right
     bbox[2:] += bbox[:2]
-    bbox = bbox.astype(np.int)
+    bbox = bbox.astype(int)
 
     # clip at image boundaries
     bbox[:2] = np.maximum(0, bbox[:2])
@@ -68,6 +68,56 @@ def extract_image_patch(image, bbox, patch_shape):
     return image
 
 
+def extract_image_patches(image, boxes, patch_shape, out=None):
+    """Extract the image patches of all bounding boxes of an image, the same
+    way as `extract_image_patch` with a `patch_shape`.
+
+    Parameters
+    ----------
+    image : ndarray
+        The full image.
+    boxes : array_like
+        An Nx4 matrix of bounding boxes in format (x, y, width, height).
+    patch_shape : array_like
+        The patch shape (height, width).
+    out : Optional[ndarray]
+        A uint8 buffer of at least N patches to write the patches into.
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        The N patches (a view into `out` if given), and a boolean mask of the
+        valid ones. Patches of empty boxes or boxes fully outside of the image
+        are left black and marked invalid.
+
+    """
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+    num = len(boxes)
+    height, width = patch_shape[:2]
+    if out is None:
+        out = np.zeros((num, height, width, image.shape[2]), np.uint8)
+    out = out[:num]
+
+    # correct aspect ratio to patch shape
+    new_width = float(width) / height * boxes[:, 3]
+    boxes[:, 0] -= (new_width - boxes[:, 2]) / 2
+    boxes[:, 2] = new_width
+
+    # convert to top left, bottom right, and clip at image boundaries
+    boxes[:, 2:] += boxes[:, :2]
+    boxes = boxes.astype(int)
+    boxes[:, :2] = np.maximum(0, boxes[:, :2])
+    boxes[:, 2:] = np.minimum(np.asarray(image.shape[:2][::-1]) - 1, boxes[:, 2:])
+    valid = np.all(boxes[:, :2] < boxes[:, 2:], axis=1)
+
+    for i, (sx, sy, ex, ey) in enumerate(boxes.tolist()):
+        if valid[i]:
+            cv2.resize(image[sy:ey, sx:ex], (width, height), dst=out[i])
+        else:
+            out[i] = 0
+    return out, valid
+
+
 class ImageEncoder(object):
 
     def __init__(self, checkpoint_filename, input_name="images",
@@ -102,17 +152,58 @@ def create_box_encoder(model_filename, input_name="images",
     image_encoder = ImageEncoder(model_filename, input_name, output_name)
     image_shape = image_encoder.image_shape
 
+    patch_buffer = [np.zeros([0] + image_shape, np.uint8)]
+
     def encoder(image, boxes):
-        image_patches = []
-        for box in boxes:
-            patch = extract_image_patch(image, box, image_shape[:2])
-            if patch is None:
-                print("WARNING: Failed to extract image patch: %s." % str(box))
-                patch = np.random.uniform(
-                    0., 255., image_shape).astype(np.uint8)
-            image_patches.append(patch)
-        image_patches = np.asarray(image_patches)
-        return image_encoder(image_patches, batch_size)
+        if len(patch_buffer[0]) < len(boxes):
+            patch_buffer[0] = np.zeros([len(boxes)] + image_shape, np.uint8)
+        patches, valid = extract_image_patches(
+            image, boxes, image_shape[:2], patch_buffer[0])
+        if not np.all(valid):
+            print("WARNING: Failed to extract %d image patches." % np.sum(~valid))
+
+        features = np.zeros((len(boxes), image_encoder.feature_dim), np.float32)
+        if np.any(valid):
+            features[valid] = image_encoder(patches[valid], batch_size)
+        return features
+
+    return encoder
+
+
+def create_multi_image_encoder(model_filename, input_name="images",
+                               output_name="features", batch_size=32):
+    """Like `create_box_encoder`, but the encoder takes the boxes of several
+    images at once, so the network runs on full batches even if each image
+    only has a few boxes.
+
+    The returned encoder takes a list of (image, boxes) pairs and returns a
+    list with (the matrix of feature vectors, the mask of valid boxes) of each
+    pair. Invalid boxes (see `extract_image_patches`) are not encoded, their
+    feature rows are 0.
+    """
+    image_encoder = ImageEncoder(model_filename, input_name, output_name)
+    image_shape = image_encoder.image_shape
+    patch_buffer = [np.zeros([0] + image_shape, np.uint8)]
+
+    def encoder(images_and_boxes):
+        sizes = [len(boxes) for _, boxes in images_and_boxes]
+        total = sum(sizes)
+        if len(patch_buffer[0]) < total:
+            patch_buffer[0] = np.zeros([total] + image_shape, np.uint8)
+        patches = patch_buffer[0][:total]
+
+        valid = np.zeros(total, bool)
+        pos = 0
+        for (image, boxes), size in zip(images_and_boxes, sizes):
+            _, valid[pos:pos + size] = extract_image_patches(
+                image, boxes, image_shape[:2], patches[pos:pos + size])
+            pos += size
+
+        features = np.zeros((total, image_encoder.feature_dim), np.float32)
+        if np.any(valid):
+            features[valid] = image_encoder(patches[valid], batch_size)
+        splits = np.cumsum(sizes)[:-1]
+        return list(zip(np.split(features, splits), np.split(valid, splits)))
 
     return encoder
 
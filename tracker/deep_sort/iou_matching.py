@@ -39,6 +39,37 @@ def iou(bbox, candidates):
     return area_intersection / (area_bbox + area_candidates - area_intersection)
 
 
+def iou_matrix(bboxes, candidates):
+    """Computer intersection over union of all pairs of boxes.
+
+    Parameters
+    ----------
+    bboxes : ndarray
+        A matrix of N bounding boxes (one per row) in format
+        `(top left x, top left y, width, height)`.
+    candidates : ndarray
+        A matrix of M candidate bounding boxes in the same format.
+
+    Returns
+    -------
+    ndarray
+        The NxM matrix of `iou(bboxes[i], candidates)` rows.
+
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    candidates = np.asarray(candidates, dtype=np.float64).reshape(-1, 4)
+    tl = np.maximum(bboxes[:, np.newaxis, :2], candidates[np.newaxis, :, :2])
+    br = np.minimum(bboxes[:, np.newaxis, :2] + bboxes[:, np.newaxis, 2:],
+                    candidates[np.newaxis, :, :2] + candidates[np.newaxis, :, 2:])
+    wh = np.maximum(0., br - tl)
+
+    area_intersection = wh.prod(axis=2)
+    area_bboxes = bboxes[:, 2:].prod(axis=1)
+    area_candidates = candidates[:, 2:].prod(axis=1)
+    return area_intersection / (
+        area_bboxes[:, np.newaxis] + area_candidates - area_intersection)
+
+
 def iou_cost(tracks, detections, track_indices=None,
              detection_indices=None):
     """An intersection over union distance metric.
@@ -70,12 +101,14 @@ def iou_cost(tracks, detections, track_indices=None,
         detection_indices = np.arange(len(detections))
 
     cost_matrix = np.zeros((len(track_indices), len(detection_indices)))
-    for row, track_idx in enumerate(track_indices):
-        if tracks[track_idx].time_since_update > 1:
-            cost_matrix[row, :] = linear_assignment.INFTY_COST
-            continue
-
-        bbox = tracks[track_idx].to_tlwh()
-        candidates = np.asarray([detections[i].tlwh for i in detection_indices])
-        cost_matrix[row, :] = 1. - iou(bbox, candidates)
+    if not len(track_indices) or not len(detection_indices):
+        return cost_matrix
+
+    bboxes = np.asarray([tracks[i].to_tlwh() for i in track_indices])
+    candidates = np.asarray([detections[i].tlwh for i in detection_indices])
+    cost_matrix[:] = 1. - iou_matrix(bboxes, candidates)
+
+    stale = [row for row, i in enumerate(track_indices)
+             if tracks[i].time_since_update > 1]
+    cost_matrix[stale, :] = linear_assignment.INFTY_COST
     return cost_matrix
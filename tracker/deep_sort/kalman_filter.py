@@ -1,6 +1,5 @@
 # vim: expandtab:ts=4:sw=4
 import numpy as np
-import scipy.linalg
 
 
 """
@@ -20,10 +19,22 @@ chi2inv95 = {
     9: 16.919}
 
 
+def _diag_square(std):
+    """Stack the last axis of `std` (..., K) into diagonal matrices (..., K, K)
+    of its squares."""
+    k = std.shape[-1]
+    out = np.zeros(std.shape + (k,))
+    out[..., np.arange(k), np.arange(k)] = np.square(std)
+    return out
+
+
 class KalmanFilter(object):
     """
     A simple Kalman filter for tracking bounding boxes in image space.
 
+    Except for `initiate`, all methods also take a stack of N states, i.e.,
+    Nx8 means and Nx8x8 covariances, and process them in one batched operation.
+
     The 8-dimensional state space
 
         x, y, a, h, vx, vy, va, vh
@@ -104,21 +115,16 @@ class KalmanFilter(object):
             state. Unobserved velocities are initialized to 0 mean.
 
         """
-        std_pos = [
-            self._std_weight_position * mean[3],
-            self._std_weight_position * mean[3],
-            1e-2,
-            self._std_weight_position * mean[3]]
-        std_vel = [
-            self._std_weight_velocity * mean[3],
-            self._std_weight_velocity * mean[3],
-            1e-5,
-            self._std_weight_velocity * mean[3]]
-        motion_cov = np.diag(np.square(np.r_[std_pos, std_vel]))
+        h = mean[..., 3]
+        std_pos = self._std_weight_position * h
+        std_vel = self._std_weight_velocity * h
+        motion_cov = _diag_square(np.stack([
+            std_pos, std_pos, np.full_like(h, 1e-2), std_pos,
+            std_vel, std_vel, np.full_like(h, 1e-5), std_vel], axis=-1))
 
-        mean = np.dot(self._motion_mat, mean)
-        covariance = np.linalg.multi_dot((
-            self._motion_mat, covariance, self._motion_mat.T)) + motion_cov
+        mean = np.matmul(mean, self._motion_mat.T)
+        covariance = np.matmul(np.matmul(
+            self._motion_mat, covariance), self._motion_mat.T) + motion_cov
 
         return mean, covariance
 
@@ -139,16 +145,14 @@ class KalmanFilter(object):
             estimate.
 
         """
-        std = [
-            self._std_weight_position * mean[3],
-            self._std_weight_position * mean[3],
-            1e-1,
-            self._std_weight_position * mean[3]]
-        innovation_cov = np.diag(np.square(std))
-
-        mean = np.dot(self._update_mat, mean)
-        covariance = np.linalg.multi_dot((
-            self._update_mat, covariance, self._update_mat.T))
+        h = mean[..., 3]
+        std_pos = self._std_weight_position * h
+        innovation_cov = _diag_square(np.stack([
+            std_pos, std_pos, np.full_like(h, 1e-1), std_pos], axis=-1))
+
+        mean = np.matmul(mean, self._update_mat.T)
+        covariance = np.matmul(np.matmul(
+            self._update_mat, covariance), self._update_mat.T)
         return mean, covariance + innovation_cov
 
     def update(self, mean, covariance, measurement):
@@ -173,16 +177,14 @@ class KalmanFilter(object):
         """
         projected_mean, projected_cov = self.project(mean, covariance)
 
-        chol_factor, lower = scipy.linalg.cho_factor(
-            projected_cov, lower=True, check_finite=False)
-        kalman_gain = scipy.linalg.cho_solve(
-            (chol_factor, lower), np.dot(covariance, self._update_mat.T).T,
-            check_finite=False).T
+        # K = P H^T S^-1, solved as S K^T = H P^T (P, S symmetric)
+        kalman_gain = np.swapaxes(np.linalg.solve(
+            projected_cov, np.matmul(self._update_mat, covariance)), -1, -2)
         innovation = measurement - projected_mean
 
-        new_mean = mean + np.dot(innovation, kalman_gain.T)
-        new_covariance = covariance - np.linalg.multi_dot((
-            kalman_gain, projected_cov, kalman_gain.T))
+        new_mean = mean + np.matmul(kalman_gain, innovation[..., None])[..., 0]
+        new_covariance = covariance - np.matmul(np.matmul(
+            kalman_gain, projected_cov), np.swapaxes(kalman_gain, -1, -2))
         return new_mean, new_covariance
 
     def gating_distance(self, mean, covariance, measurements,
@@ -212,18 +214,17 @@ class KalmanFilter(object):
         ndarray
             Returns an array of length N, where the i-th element contains the
             squared Mahalanobis distance between (mean, covariance) and
-            `measurements[i]`.
+            `measurements[i]`. For a stack of K states, a KxN matrix with one
+            such row per state.
 
         """
         mean, covariance = self.project(mean, covariance)
         if only_position:
-            mean, covariance = mean[:2], covariance[:2, :2]
+            mean, covariance = mean[..., :2], covariance[..., :2, :2]
             measurements = measurements[:, :2]
 
         cholesky_factor = np.linalg.cholesky(covariance)
-        d = measurements - mean
-        z = scipy.linalg.solve_triangular(
-            cholesky_factor, d.T, lower=True, check_finite=False,
-            overwrite_b=True)
-        squared_maha = np.sum(z * z, axis=0)
+        d = measurements - mean[..., None, :]
+        z = np.linalg.solve(cholesky_factor, np.swapaxes(d, -1, -2))
+        squared_maha = np.sum(z * z, axis=-2)
         return squared_maha
@@ -1,12 +1,98 @@
 # vim: expandtab:ts=4:sw=4
 from __future__ import absolute_import
 import numpy as np
-from sklearn.utils.linear_assignment_ import linear_assignment
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from . import kalman_filter
 
 
 INFTY_COST = 1e+5
 
+# Cost matrices with at least this many entries are split into independent
+# blocks (connected by entries within the gating threshold) before solving.
+SPLIT_MIN_SIZE = 400
+
+
+def _solve_scipy(cost_matrix):
+    return linear_sum_assignment(cost_matrix)
+
+
+def _solve_lap(cost_matrix):
+    import lap
+    _, x, _ = lap.lapjv(cost_matrix, extend_cost=True)
+    rows = np.flatnonzero(x >= 0)
+    return rows, x[rows]
+
+
+"""
+Available solvers of the linear assignment problem. Each takes an NxM cost
+matrix and returns the (row indices, column indices) of the assignment.
+'lap' (Jonker-Volgenant) needs the optional `lap` package.
+"""
+ASSIGNMENT_BACKENDS = {
+    'scipy': _solve_scipy,
+    'lap': _solve_lap,
+}
+
+_backend = _solve_scipy
+
+
+def set_backend(name):
+    """Select the linear assignment solver used by `min_cost_matching`, one
+    of `ASSIGNMENT_BACKENDS`."""
+    global _backend
+    if name not in ASSIGNMENT_BACKENDS:
+        raise ValueError('unknown assignment backend %s' % name)
+    _backend = ASSIGNMENT_BACKENDS[name]
+
+
+def solve_assignment(cost_matrix, max_distance):
+    """Solve the linear assignment problem of a gated cost matrix.
+
+    Rows and columns only connected through entries larger than
+    `max_distance` can never be matched to each other, so large matrices are
+    split into the connected components of the feasible entries, and each
+    component is solved on its own. Rows or columns without any feasible
+    entry are skipped.
+
+    Parameters
+    ----------
+    cost_matrix : ndarray
+        The NxM dimensional cost matrix, entries larger than `max_distance`
+        are infeasible.
+    max_distance : float
+        Gating threshold.
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        The row and column indices of the assignment.
+
+    """
+    if cost_matrix.size < SPLIT_MIN_SIZE:
+        return _backend(cost_matrix)
+
+    num_rows, num_cols = cost_matrix.shape
+    rows, cols = np.nonzero(cost_matrix <= max_distance)
+    graph = csr_matrix((np.ones(len(rows)), (rows, num_rows + cols)),
+                       shape=(num_rows + num_cols, num_rows + num_cols))
+    _, labels = connected_components(graph, directed=False)
+
+    row_labels, col_labels = labels[:num_rows], labels[num_rows:]
+    feasible_labels = np.unique(row_labels[rows])
+    res_rows, res_cols = [], []
+    for label in feasible_labels:
+        block_rows = np.flatnonzero(row_labels == label)
+        block_cols = np.flatnonzero(col_labels == label)
+        r, c = _backend(cost_matrix[np.ix_(block_rows, block_cols)])
+        res_rows.append(block_rows[r])
+        res_cols.append(block_cols[c])
+
+    if not res_rows:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    return np.concatenate(res_rows), np.concatenate(res_cols)
+
 
 def min_cost_matching(
         distance_metric, max_distance, tracks, detections, track_indices=None,
@@ -55,23 +141,21 @@ def min_cost_matching(
     cost_matrix = distance_metric(
         tracks, detections, track_indices, detection_indices)
     cost_matrix[cost_matrix > max_distance] = max_distance + 1e-5
-    indices = linear_assignment(cost_matrix)
-
-    matches, unmatched_tracks, unmatched_detections = [], [], []
-    for col, detection_idx in enumerate(detection_indices):
-        if col not in indices[:, 1]:
-            unmatched_detections.append(detection_idx)
-    for row, track_idx in enumerate(track_indices):
-        if row not in indices[:, 0]:
-            unmatched_tracks.append(track_idx)
-    for row, col in indices:
-        track_idx = track_indices[row]
-        detection_idx = detection_indices[col]
-        if cost_matrix[row, col] > max_distance:
-            unmatched_tracks.append(track_idx)
-            unmatched_detections.append(detection_idx)
-        else:
-            matches.append((track_idx, detection_idx))
+    rows, cols = solve_assignment(cost_matrix, max_distance)
+
+    matched = cost_matrix[rows, cols] <= max_distance
+    rows, cols = rows[matched], cols[matched]
+    matched_rows = np.zeros(len(track_indices), dtype=bool)
+    matched_cols = np.zeros(len(detection_indices), dtype=bool)
+    matched_rows[rows] = True
+    matched_cols[cols] = True
+
+    matches = [(track_indices[row], detection_indices[col])
+               for row, col in zip(rows.tolist(), cols.tolist())]
+    unmatched_tracks = [track_indices[row]
+                        for row in np.flatnonzero(~matched_rows).tolist()]
+    unmatched_detections = [detection_indices[col]
+                            for col in np.flatnonzero(~matched_cols).tolist()]
     return matches, unmatched_tracks, unmatched_detections
 
 
@@ -87,7 +171,8 @@ def matching_cascade(
         a list of N track indices and M detection indices. The metric should
         return the NxM dimensional cost matrix, where element (i, j) is the
         association cost between the i-th track in the given track indices and
-        the j-th detection in the given detection indices.
+        the j-th detection in the given detection indices. It is called once
+        for all tracks and detections, each level matches on a slice of it.
     max_distance : float
         Gating threshold. Associations with cost larger than this value are
         disregarded.
@@ -121,21 +206,36 @@ def matching_cascade(
 
     unmatched_detections = detection_indices
     matches = []
-    for level in range(cascade_depth):
+    if len(track_indices) == 0 or len(detection_indices) == 0:
+        return matches, list(track_indices), unmatched_detections
+
+    # The cost of a (track, detection) pair does not depend on the level, so
+    # compute the whole matrix once and only slice it per level.
+    cost_matrix = distance_metric(
+        tracks, detections, track_indices, detection_indices)
+    track_rows = {k: i for i, k in enumerate(track_indices)}
+    detection_cols = {k: i for i, k in enumerate(detection_indices)}
+
+    def sliced_metric(tracks, dets, track_indices_l, detection_indices_l):
+        return cost_matrix[np.ix_(
+            [track_rows[k] for k in track_indices_l],
+            [detection_cols[k] for k in detection_indices_l])]
+
+    # Bucket the tracks by level, so levels without tracks cost nothing.
+    levels = {}
+    for k in track_indices:
+        level = tracks[k].time_since_update - 1
+        if 0 <= level < cascade_depth:
+            levels.setdefault(level, []).append(k)
+
+    for level in sorted(levels):
         if len(unmatched_detections) == 0:  # No detections left
             break
 
-        track_indices_l = [
-            k for k in track_indices
-            if tracks[k].time_since_update == 1 + level
-        ]
-        if len(track_indices_l) == 0:  # Nothing to match at this level
-            continue
-
         matches_l, _, unmatched_detections = \
             min_cost_matching(
-                distance_metric, max_distance, tracks, detections,
-                track_indices_l, unmatched_detections)
+                sliced_metric, max_distance, tracks, detections,
+                levels[level], unmatched_detections)
         matches += matches_l
     unmatched_tracks = list(set(track_indices) - set(k for k, _ in matches))
     return matches, unmatched_tracks, unmatched_detections
@@ -182,9 +282,9 @@ def gate_cost_matrix(
     gating_threshold = kalman_filter.chi2inv95[gating_dim]
     measurements = np.asarray(
         [detections[i].to_xyah() for i in detection_indices])
-    for row, track_idx in enumerate(track_indices):
-        track = tracks[track_idx]
-        gating_distance = kf.gating_distance(
-            track.mean, track.covariance, measurements, only_position)
-        cost_matrix[row, gating_distance > gating_threshold] = gated_cost
+    means = np.array([tracks[i].mean for i in track_indices])
+    covariances = np.array([tracks[i].covariance for i in track_indices])
+    gating_distance = kf.gating_distance(
+        means, covariances, measurements, only_position)
+    cost_matrix[gating_distance > gating_threshold] = gated_cost
     return cost_matrix
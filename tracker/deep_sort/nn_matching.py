@@ -96,11 +96,26 @@ def _nn_cosine_distance(x, y):
     return distances.min(axis=0)
 
 
+# Cost of pairs whose detection or target has no (usable) feature
+MISSING_FEATURE_COST = 1e+5
+
+# Initial number of targets and samples per target the gallery has room for,
+# both grow when needed
+INITIAL_SLOTS = 16
+INITIAL_SAMPLES = 16
+
+
 class NearestNeighborDistanceMetric(object):
     """
     A nearest neighbor distance metric that, for each target, returns
     the closest distance to any sample that has been observed so far.
 
+    The samples are kept in one preallocated float32 array, a ring buffer of
+    `budget` rows per target, so all target/feature distances of a frame come
+    from one matrix product and a masked min. Features of the wrong dimension
+    (e.g., empty ones of detections without a feature) are not stored, and
+    are at `MISSING_FEATURE_COST` from every target.
+
     Parameters
     ----------
     metric : str
@@ -116,50 +131,120 @@ class NearestNeighborDistanceMetric(object):
     ----------
     samples : Dict[int -> List[ndarray]]
         A dictionary that maps from target identities to the list of samples
-        that have been observed so far.
+        that have been observed so far (built from the gallery, read only).
 
     """
 
     def __init__(self, metric, matching_threshold, budget=None):
-
-
-        if metric == "euclidean":
-            self._metric = _nn_euclidean_distance
-        elif metric == "cosine":
-            self._metric = _nn_cosine_distance
-        else:
+        if metric not in ("euclidean", "cosine"):
             raise ValueError(
                 "Invalid metric; must be either 'euclidean' or 'cosine'")
+        self._normalize = metric == "cosine"
         self.matching_threshold = matching_threshold
         self.budget = budget
-        self.samples = {}
+
+        width = budget if budget is not None else INITIAL_SAMPLES
+        self._dim = None
+        self._gallery = np.zeros((INITIAL_SLOTS, width, 0), np.float32)
+        self._sq_norms = np.zeros((INITIAL_SLOTS, width), np.float32)
+        self._counts = np.zeros(INITIAL_SLOTS, np.int64)    # valid samples
+        self._heads = np.zeros(INITIAL_SLOTS, np.int64)     # next row to write
+        self._slots = {}                                    # target -> slot
+        self._free = list(range(INITIAL_SLOTS - 1, -1, -1))
+
+    @property
+    def samples(self):
+        res = {}
+        for target, slot in self._slots.items():
+            count, head = self._counts[slot], self._heads[slot]
+            order = (np.arange(count) + head - count) % self._gallery.shape[1]
+            res[target] = list(self._gallery[slot, order])
+        return res
+
+    def _prepare(self, features):
+        """Return the stackable features as a float32 matrix (normalized for
+        the cosine metric), and their positions in `features`."""
+        if self._dim is None:
+            dims = [len(f) for f in features if len(f)]
+            if not dims:
+                return np.zeros((0, 0), np.float32), []
+            self._dim = dims[0]
+            self._gallery = np.zeros(self._gallery.shape[:2] + (self._dim,),
+                                     np.float32)
+
+        valid = [i for i, f in enumerate(features) if len(f) == self._dim]
+        x = np.asarray([features[i] for i in valid], np.float32).reshape(
+            len(valid), self._dim)
+        if self._normalize and len(x):
+            x /= np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        return x, valid
+
+    def _slot(self, target):
+        if target in self._slots:
+            return self._slots[target]
+
+        if not self._free:    # double the number of slots
+            num = len(self._counts)
+            self._gallery = np.concatenate(
+                [self._gallery, np.zeros_like(self._gallery)], axis=0)
+            self._sq_norms = np.concatenate(
+                [self._sq_norms, np.zeros_like(self._sq_norms)], axis=0)
+            self._counts = np.concatenate([self._counts, np.zeros(num, np.int64)])
+            self._heads = np.concatenate([self._heads, np.zeros(num, np.int64)])
+            self._free = list(range(2 * num - 1, num - 1, -1))
+
+        slot = self._free.pop()
+        self._counts[slot] = self._heads[slot] = 0
+        self._slots[target] = slot
+        return slot
+
+    def _grow_samples(self):
+        """Double the samples per target, only without budget (the ring
+        buffers never wrap then, so the rows stay in order)."""
+        self._gallery = np.concatenate(
+            [self._gallery, np.zeros_like(self._gallery)], axis=1)
+        self._sq_norms = np.concatenate(
+            [self._sq_norms, np.zeros_like(self._sq_norms)], axis=1)
+        self._heads[:] = self._counts   # full buffers had wrapped to row 0
 
     def partial_fit(self, features, targets, active_targets):
         """Update the distance metric with new data.
 
         Parameters
         ----------
-        features : ndarray
-            An NxM matrix of N features of dimensionality M.
+        features : List[ndarray]
+            A list of N features of dimensionality M.
         targets : ndarray
             An integer array of associated target identities.
         active_targets : List[int]
             A list of targets that are currently present in the scene.
 
         """
-        for feature, target in zip(features, targets):
-            self.samples.setdefault(target, []).append(feature)
-            if self.budget is not None:
-                self.samples[target] = self.samples[target][-self.budget:]
-        self.samples = {k: self.samples[k] for k in active_targets}
+        x, valid = self._prepare(features)
+        width = self._gallery.shape[1]
+        for row, i in enumerate(valid):
+            slot = self._slot(targets[i])
+            if self.budget is None and self._counts[slot] == width:
+                self._grow_samples()
+                width = self._gallery.shape[1]
+
+            head = self._heads[slot]
+            self._gallery[slot, head] = x[row]
+            self._sq_norms[slot, head] = np.dot(x[row], x[row])
+            self._heads[slot] = (head + 1) % width
+            self._counts[slot] = min(self._counts[slot] + 1, width)
+
+        active_targets = set(active_targets)
+        for target in [t for t in self._slots if t not in active_targets]:
+            self._free.append(self._slots.pop(target))
 
     def distance(self, features, targets):
         """Compute distance between features and targets.
 
         Parameters
         ----------
-        features : ndarray
-            An NxM matrix of N features of dimensionality M.
+        features : List[ndarray]
+            A list of N features of dimensionality M.
         targets : List[int]
             A list of targets to match the given `features` against.
 
@@ -171,7 +256,25 @@ class NearestNeighborDistanceMetric(object):
             `targets[i]` and `features[j]`.
 
         """
-        cost_matrix = np.zeros((len(targets), len(features)))
-        for i, target in enumerate(targets):
-            cost_matrix[i, :] = self._metric(self.samples[target], features)
+        cost_matrix = np.full((len(targets), len(features)), MISSING_FEATURE_COST)
+        x, valid = self._prepare(features)
+        rows = [i for i, t in enumerate(targets) if t in self._slots]
+        if not len(x) or not rows:
+            return cost_matrix
+
+        slots = np.array([self._slots[targets[i]] for i in rows])
+        num_slots, width, dim = self._gallery.shape
+        dots = np.dot(self._gallery.reshape(-1, dim), x.T).reshape(
+            num_slots, width, len(x))[slots]
+        if self._normalize:
+            distances = 1. - dots
+        else:
+            distances = np.maximum(0., self._sq_norms[slots][:, :, None] +
+                                   np.square(x).sum(axis=1)[None, None, :] - 2. * dots)
+
+        empty = np.arange(width)[None, :] >= self._counts[slots][:, None]
+        distances[empty] = np.inf
+        nearest = distances.min(axis=1)
+        nearest[np.isinf(nearest)] = MISSING_FEATURE_COST
+        cost_matrix[np.ix_(rows, valid)] = nearest
         return cost_matrix
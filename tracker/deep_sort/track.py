@@ -120,6 +120,12 @@ class Track:
 
         """
         self.mean, self.covariance = kf.predict(self.mean, self.covariance)
+        self.mark_predicted()
+
+    def mark_predicted(self):
+        """Advance the track bookkeeping by one time step, after its state
+        distribution has been predicted (e.g., in a batch by the tracker).
+        """
         self.age += 1
         self.time_since_update += 1
 
@@ -137,6 +143,19 @@ class Track:
         """
         self.mean, self.covariance = kf.update(
             self.mean, self.covariance, detection.to_xyah())
+        self.mark_hit(detection)
+
+    def mark_hit(self, detection):
+        """Update the feature cache and track state with the associated
+        detection, after its state distribution has been corrected (e.g., in a
+        batch by the tracker).
+
+        Parameters
+        ----------
+        detection : Detection
+            The associated detection.
+
+        """
         self.features.append(detection.feature)
 
         self.hits += 1
@@ -35,6 +35,11 @@ class Tracker:
     tracks : List[Track]
         The list of active tracks at the current time step.
 
+    The state distributions of all tracks are kept stacked in one Nx8 mean and
+    one Nx8x8 covariance array, so the Kalman filter steps run as one batched
+    operation per frame. `track.mean` and `track.covariance` are views into
+    these arrays.
+
     """
 
     def __init__(self, metric, max_iou_distance=0.7, max_age=30, n_init=3):
@@ -46,14 +51,29 @@ class Tracker:
         self.kf = kalman_filter.KalmanFilter()
         self.tracks = []
         self._next_id = 1
+        self._stack_states()
+
+    def _stack_states(self):
+        """Rebuild the stacked state arrays after tracks were added or removed,
+        and point each track at its rows."""
+        self._mean = np.array(
+            [t.mean for t in self.tracks], dtype=np.float64).reshape(-1, 8)
+        self._covariance = np.array(
+            [t.covariance for t in self.tracks], dtype=np.float64).reshape(-1, 8, 8)
+        for i, track in enumerate(self.tracks):
+            track.mean, track.covariance = self._mean[i], self._covariance[i]
 
     def predict(self):
         """Propagate track state distributions one time step forward.
 
         This function should be called once every time step, before `update`.
         """
+        if not self.tracks:
+            return
+        self._mean[...], self._covariance[...] = self.kf.predict(
+            self._mean, self._covariance)
         for track in self.tracks:
-            track.predict(self.kf)
+            track.mark_predicted()
 
     def update(self, detections):
         """Perform measurement update and track management.
@@ -63,20 +83,37 @@ class Tracker:
         detections : List[deep_sort.detection.Detection]
             A list of detections at the current time step.
 
+        Returns
+        -------
+        Dict[int, int]
+            Maps the track id of each track matched or initiated at this time
+            step to the index of its detection.
+
         """
         # Run matching cascade.
         matches, unmatched_tracks, unmatched_detections = \
             self._match(detections)
 
         # Update track set.
+        if matches:
+            track_idx = np.array([t for t, _ in matches])
+            measurements = np.array(
+                [detections[d].to_xyah() for _, d in matches])
+            self._mean[track_idx], self._covariance[track_idx] = self.kf.update(
+                self._mean[track_idx], self._covariance[track_idx], measurements)
         for track_idx, detection_idx in matches:
-            self.tracks[track_idx].update(
-                self.kf, detections[detection_idx])
+            self.tracks[track_idx].mark_hit(detections[detection_idx])
         for track_idx in unmatched_tracks:
             self.tracks[track_idx].mark_missed()
+        associations = {self.tracks[t].track_id: d for t, d in matches}
         for detection_idx in unmatched_detections:
             self._initiate_track(detections[detection_idx])
+            associations[self.tracks[-1].track_id] = detection_idx
+
+        num_tracks = len(self.tracks)
         self.tracks = [t for t in self.tracks if not t.is_deleted()]
+        if unmatched_detections or len(self.tracks) != num_tracks:
+            self._stack_states()
 
         # Update distance metric.
         active_targets = [t.track_id for t in self.tracks if t.is_confirmed()]
@@ -87,14 +124,14 @@ class Tracker:
             features += track.features
             targets += [track.track_id for _ in track.features]
             track.features = []
-        self.metric.partial_fit(
-            np.asarray(features), np.asarray(targets), active_targets)
+        self.metric.partial_fit(features, targets, active_targets)
+        return associations
 
     def _match(self, detections):
 
         def gated_metric(tracks, dets, track_indices, detection_indices):
-            features = np.array([dets[i].feature for i in detection_indices])
-            targets = np.array([tracks[i].track_id for i in track_indices])
+            features = [dets[i].feature for i in detection_indices]
+            targets = [tracks[i].track_id for i in track_indices]
             cost_matrix = self.metric.distance(features, targets)
             cost_matrix = linear_assignment.gate_cost_matrix(
                 self.kf, cost_matrix, tracks, dets, track_indices,
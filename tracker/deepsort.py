@@ -7,48 +7,21 @@ import logging
 from tracker.deep_sort.detection import Detection
 from tracker.deep_sort.tracker import Tracker
 from tracker.deep_sort import nn_matching
+from tracker.deep_sort.iou_matching import iou_matrix
 
 
 SAME_TUBE_IOU_MIN = 0.3
-def get_iou(a, b, epsilon=1e-5):
-    """
-    Args:
-        a:          (list of 4 numbers) [x1,y1,x2,y2]
-        b:          (list of 4 numbers) [x1,y1,x2,y2]
-        epsilon:    (float) Small value to prevent division by zero
-
-    Returns:
-        (float) The Intersect of Union score.
-    """
-    # COORDINATES OF THE INTERSECTION BOX
-    x1 = max(a[0], b[0])
-    y1 = max(a[1], b[1])
-    x2 = min(a[2], b[2])
-    y2 = min(a[3], b[3])
-
-    # AREA OF OVERLAP - Area where the boxes intersect
-    width = (x2 - x1)
-    height = (y2 - y1)
-    # handle case where there is NO overlap
-    if (width<0) or (height <0):
-        return 0.0
-    area_overlap = width * height
-
-    # COMBINED AREA
-    area_a = (a[2] - a[0]) * (a[3] - a[1])
-    area_b = (b[2] - b[0]) * (b[3] - b[1])
-    area_combined = area_a + area_b - area_overlap
-
-    # RATIO OF AREA OF OVERLAP OVER COMBINED AREA
-    iou = area_overlap / (area_combined+epsilon)
-    return iou
+
+# max number of appearance features kept per track
+FEATURE_BUDGET = 100
 
 
 class DeepSort:
     def __init__(self, track_labels=[], attach_labels=[]):
         self.trackers = {}
         for i in track_labels:
-            metric = nn_matching.NearestNeighborDistanceMetric("cosine", 0.2, None)
+            metric = nn_matching.NearestNeighborDistanceMetric("cosine", 0.2,
+                                                            FEATURE_BUDGET)
             self.trackers[i] = Tracker(metric, max_iou_distance=0.7,
                                         max_age=100, n_init=4)
 
@@ -56,19 +29,24 @@ class DeepSort:
         self.attach_labels = attach_labels
         self.log('init')
 
-    def find_box_feature(self, box, all_meta):
+    def find_box_features(self, boxes, all_meta):
         """
-        Given a tracked box and all src meta (with 'box', 'label', and 'feature'),
-        return the feature that matched to this box. If none matched, return empty
+        Given tracked boxes and all src meta (with 'box', 'label', and 'feature'),
+        return the feature of the meta that overlaps most with each box. If none
+        overlaps enough, the box gets an empty feature
         """
-        max_iou = SAME_TUBE_IOU_MIN
-        res = []
-        for m in all_meta:
-            iou = get_iou(box, m['box'])
-            if iou > max_iou and 'feature' in m:
-                res = m['feature']
-                max_iou = iou
-        return res
+        cands = [m for m in all_meta if 'feature' in m]
+        if not len(boxes) or not cands:
+            return [[] for _ in boxes]
+
+        def tlwh(b):
+            b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+            return np.c_[b[:, :2], b[:, 2:] - b[:, :2]]
+
+        ious = iou_matrix(tlwh(boxes), tlwh([m['box'] for m in cands]))
+        best = ious.argmax(axis=1)
+        return [cands[j]['feature'] if ious[i, j] > SAME_TUBE_IOU_MIN else []
+                    for i, j in enumerate(best)]
         
     def update(self, pkt):
         '''
@@ -81,6 +59,7 @@ class DeepSort:
         track_boxes = {i:[] for i in self.track_labels}
         track_scores = {i:[] for i in self.track_labels}
         track_features = {i:[] for i in self.track_labels}
+        track_meta = {i:[] for i in self.track_labels}
         out_meta = []
 
         for m in pkt.meta:
@@ -93,6 +72,7 @@ class DeepSort:
                                             box[2]-box[0], box[3]-box[1]])
                 track_scores[label].append(score)
                 track_features[label].append(feature)
+                track_meta[label].append(m)
             elif label in self.attach_labels:
                 out_meta.append(m)
 
@@ -103,17 +83,29 @@ class DeepSort:
                                     for i in range(len(track_boxes[label]))]
 
             self.trackers[label].predict()
-            self.trackers[label].update(detection_list)
+            associations = self.trackers[label].update(detection_list)
 
+            # the feature of the matched det, or of the most overlapping one 
+            # for tracks that missed this frame 
+            missed = []
             for tk in self.trackers[label].tracks:
                 if not tk.is_confirmed() or tk.time_since_update > 1:
                     continue
                 left, top, width, height = tk.to_tlwh()
                 box = [int(left), int(top), int(left + width), int(top + height)]
-                out_meta.append({'box': box,
-                                'id': tk.track_id,
-                                'feature': self.find_box_feature(box, pkt.meta),
-                                'label': label})
+                m = {'box': box, 'id': tk.track_id, 'feature': [], 'label': label}
+                if tk.track_id in associations:
+                    det_meta = track_meta[label][associations[tk.track_id]]
+                    if 'feature' in det_meta:
+                        m['feature'] = det_meta['feature']
+                else:
+                    missed.append(m)
+                out_meta.append(m)
+
+            if missed:
+                features = self.find_box_features([m['box'] for m in missed], pkt.meta)
+                for m, f in zip(missed, features):
+                    m['feature'] = f
 
         # self.log(str([(m['id'], len(m['feature'])) for m in out_meta]))
         pkt.meta = out_meta
@@ -1,7 +1,15 @@
 import numpy as np
 from time import time, sleep
 import logging 
-from tracker.deep_sort.generate_detections import create_box_encoder
+from tracker.deep_sort.generate_detections import create_multi_image_encoder
+from network.utils import READ_TIMEOUT
+
+
+# number of person crops the extractor tries to run through the model at once
+BATCH_SIZE = 16
+
+# max seconds the first pkt of a batch waits for more crops to arrive
+MAX_BATCH_DELAY = 0.03
 
 
 def feature_distance(f1, f2):
@@ -11,42 +19,82 @@ def feature_distance(f1, f2):
     return 1. - np.dot(a, b.T)
 
 class FExtractor:
-    def __init__(self, in_queue, out_queue, model_path):
+    def __init__(self, in_queue, out_queue, model_path, batch_size=BATCH_SIZE,
+                    max_delay=MAX_BATCH_DELAY):
         ''' Generate feature for person dets in pkt. Read data from in_queue,
-            and write the pkt with feature to out_queue
+            and write the pkt with feature to out_queue. The crops of several
+            pkts (from any camera) are encoded together, until batch_size crops
+            are collected or the first pkt waited for max_delay seconds
         '''
         self.in_queue = in_queue
         self.out_queue = out_queue
         self.model_path = model_path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
         self.log('init')
 
 
+    def get_person_boxes(self, pkt):
+        ''' Return the meta indices and the (x, y, w, h) boxes of the persons
+        '''
+        ds_boxes = []
+        person_indices = []
+        for i, info in enumerate(pkt.meta):
+            if info['label'] != 'person':
+                continue
+            b = info['box']
+            person_indices.append(i)
+            ds_boxes.append([b[0], b[1], b[2] - b[0], b[3] - b[1]])
+        return person_indices, ds_boxes
+
+
+    def read_batch(self):
+        ''' Return a list of (pkt, person_indices, boxes), with about
+            batch_size boxes in total
+        '''
+        pkt = self.in_queue.read(block=True, timeout=READ_TIMEOUT)
+        if pkt is None:
+            return []
+
+        batch = [(pkt,) + self.get_person_boxes(pkt)]
+        box_num = len(batch[0][2])
+        deadline = time() + self.max_delay
+        while box_num < self.batch_size:
+            timeout = deadline - time()
+            if timeout <= 0:
+                break
+            pkt = self.in_queue.read(block=True, timeout=timeout)
+            if pkt is None:
+                break
+            batch.append((pkt,) + self.get_person_boxes(pkt))
+            box_num += len(batch[-1][2])
+        return batch
+
+
     def run(self):
         ''' Keeps the extractor running and generate features
             Read pkt from in_queue and write modified pkt to out_queue
         '''
-        encoder = create_box_encoder(self.model_path, batch_size=16)
+        encoder = create_multi_image_encoder(self.model_path,
+                                            batch_size=self.batch_size)
 
         while True:
-            pkt = self.in_queue.read()
-            if pkt is None:
-                sleep(0.01)
+            batch = self.read_batch()
+            if not batch:
                 continue
 
-            ds_boxes = []
-            person_indices = []
-            for i, info in enumerate(pkt.meta):
-                if info['label'] != 'person':
-                    continue
-                b = info['box']
-                person_indices.append(i)
-                ds_boxes.append([b[0], b[1], b[2] - b[0], b[3] - b[1]])
-
-            features = encoder(pkt.img, ds_boxes)
-            for i in range(len(features)):
-                pkt.meta[person_indices[i]]['feature'] = features[i]
+            features = encoder([(pkt.img, boxes) for pkt, _, boxes in batch
+                                    if len(boxes)])
+            features = iter(features)
+            for pkt, person_indices, boxes in batch:
+                if len(boxes):
+                    # boxes outside of the img get no feature
+                    pkt_features, valid = next(features)
+                    for i, f, v in zip(person_indices, pkt_features, valid):
+                        if v:
+                            pkt.meta[i]['feature'] = f
 
-            self.out_queue.write(pkt)
+                self.out_queue.write(pkt)
 
 
     def log(self, s):
@@ -1,16 +1,98 @@
 import numpy as np  
 from collections import defaultdict, OrderedDict
 import logging 
-from tracker.topo_matcher import TopoMatcher
-from tracker.feature_extractor import feature_distance
+from tracker.topo_matcher import TopoMatcher, overlaps
 
 
 # change these values for your testing scenes 
 MIN_TUBE_DURATION = 4  # tube with enough clips should be considered matching
 END_FRAME_NUM_THRES = 5  # tube that ended long enough can be considered 
 MAX_TUBE_INFO_SIZE = 80  # max number of tubes cached for each camera
+MAX_TUBE_INFO_TOTAL = 2000  # max number of tubes cached for all cameras
+TUBE_TIMEOUT = 100  # frames a tube is kept after it's last seen (tracker max_age)
 FEATURE_MATCHING_THRES = 0.4  # reid thres for feature matching 
 
+# initial number of tubes in a TubeIndex, doubled when full
+INDEX_INIT_SIZE = 32
+
+
+class TubeIndex:
+    def __init__(self, size=INDEX_INIT_SIZE):
+        ''' The confirmed tubes of one camera, with their mean features, last
+            frame ids and last boxes stacked, so a new tube is matched against
+            all of them with one matrix-vector product
+        '''
+        self.slots = {}     # tid: row
+        self.free = list(range(size - 1, -1, -1))
+        self.tids = [None] * size
+        self.used = np.zeros(size, bool)
+        self.orders = np.zeros(size, np.int64)     # insertion order in tube_info
+        self.last_frame_ids = np.zeros(size, np.int64)
+        self.last_boxes = np.zeros((size, 4))
+        self.features = None    # (size, feature dim), once the dim is known
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, tid):
+        return tid in self.slots
+
+    def grow(self):
+        size = len(self.tids)
+        self.free = list(range(2 * size - 1, size - 1, -1))
+        self.tids += [None] * size
+        self.used = np.concatenate([self.used, np.zeros(size, bool)])
+        self.orders = np.concatenate([self.orders, np.zeros(size, np.int64)])
+        self.last_frame_ids = np.concatenate(
+                                [self.last_frame_ids, np.zeros(size, np.int64)])
+        self.last_boxes = np.concatenate([self.last_boxes, np.zeros((size, 4))])
+        if self.features is not None:
+            self.features = np.concatenate(
+                        [self.features, np.zeros_like(self.features)])
+
+    def add(self, tid, feature, order):
+        if not self.free:
+            self.grow()
+        i = self.free.pop()
+        if self.features is None:
+            self.features = np.zeros((len(self.tids), len(feature)), np.float32)
+        self.slots[tid] = i
+        self.tids[i] = tid
+        self.used[i] = True
+        self.orders[i] = order
+        self.features[i] = feature
+
+    def update(self, tid, frame_id, box):
+        i = self.slots[tid]
+        self.last_frame_ids[i] = frame_id
+        self.last_boxes[i] = box
+
+    def set_order(self, tid, order):
+        self.orders[self.slots[tid]] = order
+
+    def remove(self, tid):
+        i = self.slots.pop(tid)
+        self.tids[i] = None
+        self.used[i] = False
+        self.free.append(i)
+
+    def match(self, feature, exit_zone, min_frame_id, max_frame_id, thres):
+        ''' Return [(order, tid, feature dist)] of the tubes that left
+            exit_zone between min_frame_id and max_frame_id with a feature
+            dist below thres
+        '''
+        if not self.slots or len(feature) != self.features.shape[1]:
+            return []
+        last = self.last_frame_ids
+        rows = np.flatnonzero(self.used & (last >= min_frame_id) & (last <= max_frame_id) &
+                                overlaps(self.last_boxes, exit_zone))
+        if not len(rows):
+            return []
+        dists = 1. - self.features[rows].dot(np.asarray(feature, np.float32))
+        hits = np.flatnonzero(dists < thres)
+        return [(self.orders[rows[j]], self.tids[rows[j]], dists[j]) for j in hits]
+
+
 class REID:
     def __init__(self, topo_path, img_shape):
         ''' For re-id people across cameras 
@@ -24,7 +106,16 @@ class REID:
         #                   'last_box_pos' box, 
         #                   'feature': feature list,
         #                   'tube_len': number of frames}}
+        # in the order they were last seen
         self.tube_info = defaultdict(lambda: OrderedDict())   
+
+        # all tubes in the order they were last seen, with the frame_id after
+        # which they expire: (cam, tid) : frame_id
+        self.expire_at = OrderedDict()
+
+        # the confirmed tubes of each camera, (cam) : TubeIndex
+        self.tube_index = defaultdict(TubeIndex)
+        self.order_cnt = 0
         self.topo = TopoMatcher(topo_path, img_shape)
 
     def find_best_match(self, matched, frame_id):
@@ -66,6 +157,37 @@ class REID:
             
         return res
 
+    def expire(self, frame_id):
+        ''' Drop the tubes that can't be matched anymore: not seen since
+            longer than both TUBE_TIMEOUT and the transit time to the
+            connected cameras, or over the size limits. Frame ids of all
+            cameras are assumed to be in sync, as for the matching
+        '''
+        while self.expire_at:
+            (cid, tid), deadline = next(iter(self.expire_at.items()))
+            if deadline >= frame_id and len(self.expire_at) <= MAX_TUBE_INFO_TOTAL:
+                break 
+            self.remove_tube(cid, tid)
+
+    def remove_tube(self, cid, tid):
+        del self.tube_info[cid][tid]
+        del self.expire_at[cid, tid]
+        if tid in self.tube_index[cid]:
+            self.tube_index[cid].remove(tid)
+        self.id_mapping.pop((cid, tid), None)
+
+    def touch_tube(self, cid, tid, frame_id):
+        ''' Mark a tube as the most recently seen one '''
+        tube = self.tube_info[cid][tid]
+        self.tube_info[cid].move_to_end(tid)
+        tube['order'] = self.next_order()
+        if tid in self.tube_index[cid]:
+            self.tube_index[cid].set_order(tid, tube['order'])
+
+        self.expire_at[cid, tid] = frame_id + max(TUBE_TIMEOUT, 
+                            END_FRAME_NUM_THRES + self.topo.max_transit(cid))
+        self.expire_at.move_to_end((cid, tid))
+
     def get_id(self, cid, tid, frame_id, box, feature):
         '''
         Assign a new tube id if for current tube_id: see if the tube could come 
@@ -76,7 +198,9 @@ class REID:
         - cam_id, tube_id: the tracking result from tracker
         - frame_id: the current frame id 
         - box: the current box 
-        - feature: the reid feature of the box   
+        - feature: the reid feature of the box, or None if the tube already
+            got MIN_TUBE_DURATION features (see tracker/tracker_worker.py).
+            Skipped if the tube is not confirmed, e.g. it was evicted
         
         # box_list: a list of tuples (frame_id, box) of the tube
         # frame_list: a list of tuples (frame_id, frame) of the camera
@@ -84,10 +208,16 @@ class REID:
         Return: 
         - new cam_id, new track_id, whether it's just re-ided
         '''
-        # skip no feature tubes 
-        if not len(feature):
+        # skip no feature tubes, and the tubes sent without feature that are
+        # not confirmed (anymore), e.g. evicted: they need features again
+        if feature is None:
+            if not self.confirmed(cid, tid):
+                return cid, tid, False 
+        elif not len(feature):
             return cid, tid, False 
 
+        self.expire(frame_id)
+
         # skip too short tubes 
         if tid not in self.tube_info[cid]:
             self.tube_info[cid][tid] = {
@@ -95,67 +225,56 @@ class REID:
                                 'first_box_pos': box,
                                 'features': [feature],
                             }
-        self.tube_info[cid][tid]['tube_len'] += 1
+            # remove the least recently seen tube of the camera 
+            if len(self.tube_info[cid]) > MAX_TUBE_INFO_SIZE:
+                self.remove_tube(cid, next(iter(self.tube_info[cid])))
+        self.touch_tube(cid, tid, frame_id)
+        tube = self.tube_info[cid][tid]
+        tube['tube_len'] += 1
 
         # calculate the mean of the first few features for the tube 
-        if self.tube_info[cid][tid]['tube_len'] < MIN_TUBE_DURATION:
-            self.tube_info[cid][tid]['features'].append(feature)
+        if tube['tube_len'] < MIN_TUBE_DURATION:
+            tube['features'].append(feature)
             return cid, tid, False 
-        elif self.tube_info[cid][tid]['tube_len'] == MIN_TUBE_DURATION:
-            self.tube_info[cid][tid]['feature'] = np.mean(self.tube_info[cid][tid]['features'], axis=0)
+        elif tube['tube_len'] == MIN_TUBE_DURATION:
+            tube['feature'] = np.mean(tube['features'], axis=0)
+            self.tube_index[cid].add(tid, tube['feature'], tube['order'])
             self.log('%s-%d confirmed' % (cid, tid))
 
         # update the last frame_id and box position 
-        self.tube_info[cid][tid]['last_frame_id'] = frame_id
-        self.tube_info[cid][tid]['last_box_pos'] = box
+        tube['last_frame_id'] = frame_id
+        tube['last_box_pos'] = box
+        self.tube_index[cid].update(tid, frame_id, box)
         
         # return if the tube is previously re-ided
         if (cid, tid) in self.id_mapping:
             cid, tid = self.id_mapping[cid, tid]
+            # keep the tube alive while it's continued in another camera 
             if tid in self.tube_info[cid]:
-                tmp = self.tube_info[cid][tid]
-                del self.tube_info[cid][tid]
-                self.tube_info[cid][tid] = tmp
+                self.touch_tube(cid, tid, frame_id)
             return cid, tid, False
         
-        # Try to match current tube with other tubes 
+        # Try to match current tube with the ended tubes of the connected
+        # cameras, that left them through the exit zone of the topo file
         # matching dict: {(cid, tid): feature_dist} 
-        matched = {}  
-        for c in self.tube_info:
-            # skip if two cameeras are not connected or the same 
-            if c == cid or not self.topo.connected_camera(cid, c):
+        candidates = []
+        neighbors = self.topo.entry_neighbors(cid, tube['first_box_pos'])
+        for ci, c in enumerate(self.tube_info):
+            # skip if the cameras are not connected through the entry zone 
+            if c not in neighbors:
                 continue 
 
-            for t in self.tube_info[c]:
-                tb = self.tube_info[c][t]
-                if 'feature' not in tb:
-                    continue 
-
-                prev_fid, prev_feature = tb['last_frame_id'], tb['feature']
-                prev_pos = tb['last_box_pos']
-
-                tube_feature = self.tube_info[cid][tid]['feature']
-                first_box_pos = self.tube_info[cid][tid]['first_box_pos']
-
-                # skip if the enter/exit region doesn't match the topo file 
-                if not self.topo.can_be_matched(cam1=cid, box1=first_box_pos,
-                                                cam2=c, box2=prev_pos):
-                    continue 
-
-                '''
-                self.log('try cur:%s-%d(%d>%s) to prev:%s-%d(%d>%s)' % (
-                            cid, tid, frame_id, str(first_box_pos),
-                            c, t, prev_fid, str(prev_pos)
-                        ))
-                '''
-
-                # skip if the previous tube is still live 
-                if (frame_id - END_FRAME_NUM_THRES) < prev_fid:
-                    continue 
+            _, exit_zone = self.topo.zones(cid, c)
+            for order, t, fd in self.tube_index[c].match(
+                                    tube['feature'], exit_zone,
+                                    frame_id - self.topo.transit(cid, c),
+                                    frame_id - END_FRAME_NUM_THRES,
+                                    FEATURE_MATCHING_THRES):
+                candidates.append((ci, order, c, t, fd))
 
-                fd = feature_distance(tube_feature, prev_feature) 
-                if fd < FEATURE_MATCHING_THRES:
-                    matched[c, t] = fd
+        # in the order of tube_info, as find_best_match keeps the first of ties
+        candidates.sort(key=lambda x: x[:2])
+        matched = {(c, t): fd for _, _, c, t, fd in candidates}
 
         if matched:
             self.log('match (%s:%d) to %s' % (cid, tid, 
@@ -163,14 +282,18 @@ class REID:
             cid_new, tid_new = self.find_best_match(matched, frame_id)
             self.id_mapping[cid, tid] = (cid_new, tid_new)
             cid, tid = cid_new, tid_new
-
-        # remove too old tubes 
-        if len(self.tube_info[cid]) > MAX_TUBE_INFO_SIZE:
-            k = list(self.tube_info[cid].keys())[-1]
-            del self.tube_info[cid][k]
+            self.touch_tube(cid, tid, frame_id)
 
         return cid, tid, len(matched) > 0
 
+    def confirmed(self, cid, tid):
+        ''' Return if the tube has its mean feature, i.e. needs no more '''
+        return 'feature' in self.tube_info.get(cid, {}).get(tid, {})
+
+    def next_order(self):
+        self.order_cnt += 1
+        return self.order_cnt
+
     def update(self, pkt):
         '''
         Main function of REID 
@@ -181,18 +304,34 @@ class REID:
         Return:
         - pkt: the DataPkt with meta updated, sent to the next hop
         '''
-        for m in pkt.meta:
-            # Skip untrackable objects 
-            if 'id' not in m or 'feature' not in m:
-                continue 
-
-            tube_id, box, feature = m['id'], m['box'], m['feature']
-            cid, tid, reided = self.get_id(pkt.cam_id, tube_id, pkt.frame_id, box, feature)
-            if reided:
-                self.log('!! %d > [%s-%s] [%s-%s]' % (pkt.frame_id, pkt.cam_id, tube_id, cid, tid))
-                m['reid'] = (cid, tid)
+        # Skip untrackable objects 
+        objs = [m for m in pkt.meta if 'id' in m and 'feature' in m]
+        tubes = [(m['id'], m['box'], m['feature']) for m in objs]
+        for m, reid in zip(objs, self.update_tubes(pkt.cam_id, pkt.frame_id, tubes)):
+            if reid is not None:
+                m['reid'] = reid
 
         return pkt
 
+    def update_tubes(self, cam_id, frame_id, tubes):
+        '''
+        Same as update(), on the tubes of one frame only
+
+        Args:
+        - cam_id, frame_id: of the frame
+        - tubes: list of (tube id, box, feature) of the tracked objects
+
+        Return:
+        - a list with the new (cam_id, tube_id) of each tube just re-ided,
+            None for the others
+        '''
+        res = []
+        for tube_id, box, feature in tubes:
+            cid, tid, reided = self.get_id(cam_id, tube_id, frame_id, box, feature)
+            if reided:
+                self.log('!! %d > [%s-%s] [%s-%s]' % (frame_id, cam_id, tube_id, cid, tid))
+            res.append((cid, tid) if reided else None)
+        return res
+
     def log(self, s):
         logging.debug('[REID] %s' % s)
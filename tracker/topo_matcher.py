@@ -1,67 +1,159 @@
-from collections import defaultdict 
-import os 
-import logging 
-from server.action_spatial import overlap
+import os
+import logging
+import numpy as np
+
+
+# default max number of frames between a person leaving one camera and being
+# matched in a connected one
+TRANSIT_FRAMES = 300
+
+
+def overlaps(boxes, zones):
+    ''' Vectorized server.action_spatial.overlap(box, zone): boxes and zones
+        are [..., 4] (x0, y0, x1, y1) arrays broadcast against each other, e.g.
+        one box and (N, 4) zones, or (N, 4) boxes and one zone
+    '''
+    boxes = np.asarray(boxes)
+    zones = np.asarray(zones)
+    return ~((zones[..., 0] > boxes[..., 2]) | (zones[..., 2] < boxes[..., 0]) |
+            (zones[..., 1] > boxes[..., 3]) | (zones[..., 3] < boxes[..., 1]))
+
+
+def parse_zone(s, img_shape):
+    ''' Parse "cam_id, x0, y0, x1, y1" (x y in ratios) into (cam_id, zone in
+        pixels), raise ValueError if malformed
+    '''
+    fields = [f.strip() for f in s.split(',')]
+    if len(fields) != 5 or not fields[0]:
+        raise ValueError('expect "cam_id, x0, y0, x1, y1", got "%s"' % s.strip())
+    try:
+        x0, y0, x1, y1 = [float(f) for f in fields[1:]]
+    except ValueError:
+        raise ValueError('non-numeric zone "%s"' % s.strip())
+    if not (0. <= x0 < x1 <= 1. and 0. <= y0 < y1 <= 1.):
+        raise ValueError('zone "%s" is empty or not within [0, 1]' % s.strip())
+
+    w, h = img_shape
+    return fields[0], (int(w * x0), int(h * y0), int(w * x1), int(h * y1))
+
+
+def load_topology(topo_file, img_shape):
+    ''' Read a camera topology file (see TopoMatcher)
+
+    Return: a list of (cam_1, zone in cam_1, cam_2, zone in cam_2, transit)
+    '''
+    links = []
+    with open(topo_file, 'r') as fin:
+        for i, line in enumerate(fin):
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            try:
+                fields = line.split(':')
+                if len(fields) not in (2, 3):
+                    raise ValueError('expect 2 or 3 fields separated by ":"')
+                c1, z1 = parse_zone(fields[0], img_shape)
+                c2, z2 = parse_zone(fields[1], img_shape)
+                if c1 == c2:
+                    raise ValueError('camera %s linked to itself' % c1)
+                transit = int(fields[2]) if len(fields) > 2 else TRANSIT_FRAMES
+                if transit < 0:
+                    raise ValueError('negative transit time %d' % transit)
+            except ValueError as e:
+                raise ValueError('%s line %d: %s' % (topo_file, i + 1, str(e)))
+            links.append((c1, z1, c2, z2, transit))
+    return links
+
 
 class TopoMatcher:
     def __init__(self, topo_file, img_shape):
         ''' This class decides if a tube should be matched to tubes in a camera
-            based on their enter/exit positions 
+            based on their enter/exit positions
 
         Args:
         - topo_file: path to the file that specifies camera-topo
-            Each line: cam_id,x0,y0,x1,y1 : cam_id,x0,y0,x1,y1
+            Each line: cam_id,x0,y0,x1,y1 : cam_id,x0,y0,x1,y1 [: frames]
             The left half is the entrance area in current camera
             The right half is the exit area in previous camera (x y in ratios)
-        - img_shape: (w, h) number of pixels of the image 
+            The optional frames is the max transit time between the two
+            cameras (TRANSIT_FRAMES if not given)
+        - img_shape: (w, h) number of pixels of the image
         '''
+        links = load_topology(topo_file, img_shape) if os.path.exists(topo_file) else []
+
+        # cameras in the topo file, indexed in the order they appear
+        self.cams = []
+        self.cam_index = {}
+        for c1, _, c2, _, _ in links:
+            for c in (c1, c2):
+                if c not in self.cam_index:
+                    self.cam_index[c] = len(self.cams)
+                    self.cams.append(c)
+
+        # for each pair (cam_1, cam_2): if connected, the entry zone in cam_1,
+        # the exit zone in cam_2, and the max transit frames
+        n = len(self.cams)
+        self.adjacency = np.zeros((n, n), bool)
+        self.entry_zones = np.zeros((n, n, 4), np.int64)
+        self.exit_zones = np.zeros((n, n, 4), np.int64)
+        self.transits = np.zeros((n, n), np.int64)
+        for c1, z1, c2, z2, transit in links:
+            i, j = self.cam_index[c1], self.cam_index[c2]
+            self.adjacency[i, j] = self.adjacency[j, i] = True
+            self.entry_zones[i, j] = self.exit_zones[j, i] = z1
+            self.entry_zones[j, i] = self.exit_zones[i, j] = z2
+            self.transits[i, j] = self.transits[j, i] = transit
 
-        # {cam_1: cam_2: {'entry_zone': cam_1_range, 'exit_zone': cam_2_range}}
-        self.topo = defaultdict(dict)
-        if not os.path.exists(topo_file):
-            return 
-
-        lines = []
-        with open(topo_file, 'r') as fin:
-            lines = fin.readlines()
-
-        w, h = img_shape
-        for line in lines:
-            line = line.strip()
-            if not line or '#' in line:
-                continue 
-            d1, d2 = line.split(' : ')
-            c1, x10, y10, x11, y11 = d1.split(', ')
-            c2, x20, y20, x21, y21 = d2.split(', ')
-            self.topo[c1][c2] = {'entry_zone':(
-                                    int(w * float(x10)), int(h * float(y10)), 
-                                    int(w * float(x11)), int(h * float(y11))),
-                                'exit_zone':(
-                                    int(w * float(x20)), int(h * float(y20)), 
-                                    int(w * float(x21)), int(h * float(y21)))
-                                }
-            self.topo[c2][c1] = {'entry_zone':(
-                                    int(w * float(x20)), int(h * float(y20)), 
-                                    int(w * float(x21)), int(h * float(y21))),
-                                'exit_zone':(
-                                    int(w * float(x10)), int(h * float(y10)), 
-                                    int(w * float(x11)), int(w * float(y11)))
-                                }
-
-        self.log('init: %s' % str(self.topo))
+        self.log('init: %d cameras, %d links' % (n, len(links)))
 
 
     def connected_camera(self, c1, c2):
-        ''' Return if the two cameras are connected 
+        ''' Return if the two cameras are connected
+        '''
+        i, j = self.cam_index.get(c1), self.cam_index.get(c2)
+        return i is not None and j is not None and bool(self.adjacency[i, j])
+
+
+    def transit(self, cam1, cam2):
+        ''' Return the max number of frames between two connected cameras
+        '''
+        return int(self.transits[self.cam_index[cam1], self.cam_index[cam2]])
+
+
+    def max_transit(self, cam):
+        ''' Return the max number of frames a tube that left cam can still be
+            matched in a connected camera, 0 if cam has no connected camera
+        '''
+        if cam not in self.cam_index:
+            return 0
+        return int(self.transits[self.cam_index[cam]].max())
+
+
+    def zones(self, cam1, cam2):
+        ''' Return (entry zone in cam1, exit zone in cam2) of connected cameras
+        '''
+        i, j = self.cam_index[cam1], self.cam_index[cam2]
+        return self.entry_zones[i, j], self.exit_zones[i, j]
+
+
+    def entry_neighbors(self, cam, box):
+        ''' Return the set of cameras connected to cam, whose entry zone in
+            cam overlaps the box
         '''
-        return c2 in self.topo[c1]
+        if cam not in self.cam_index:
+            return set()
+        i = self.cam_index[cam]
+        hit = self.adjacency[i] & overlaps(box, self.entry_zones[i])
+        return {self.cams[j] for j in np.flatnonzero(hit)}
 
 
     def can_be_matched(self, cam1, box1, cam2, box2):
         ''' Return if entry box position can be matched after the exit box
         '''
-        d = self.topo[cam1][cam2]
-        return overlap(box1, d['entry_zone']) and overlap(box2, d['exit_zone'])
+        if not self.connected_camera(cam1, cam2):
+            return False
+        entry_zone, exit_zone = self.zones(cam1, cam2)
+        return bool(overlaps(box1, entry_zone)) and bool(overlaps(box2, exit_zone))
 
 
     def log(self, s):
@@ -0,0 +1,174 @@
+import logging
+import zlib
+from collections import OrderedDict
+from multiprocessing import Event
+from threading import Thread
+
+from tracker.deepsort import DeepSort
+from tracker.reid import REID, MIN_TUBE_DURATION
+from network.data_writer import DataWriter
+from network.utils import Q, POLICY_BLOCK, READ_TIMEOUT
+
+
+''' Sharded tracking: the DeepSort of each camera runs in one of several
+TrackerWorker processes (picked by worker_index), and one ReidCoordinator
+runs the REID of all cameras on compact events sent by the workers:
+
+    event: (cam_id, frame_id, [(tube id, box, feature), ...]), the feature is
+        only sent for the first MIN_TUBE_DURATION frames of a tube (REID
+        needs no more), None afterwards
+    reply: (cam_id, tube id, (new cam_id, new tube id)) for each re-ided tube,
+        marked as 'reid' on the first pkt of the tube tracked after the reply
+        arrived, which can be several frames after the matched frame.
+        (cam_id, tube id, None) if REID got no feature for a tube it does not
+        have confirmed (e.g. evicted), the worker then sends its features again
+
+Each camera is tracked by one worker in arrival order, so the order of the
+pkts of a camera is kept.
+'''
+
+# max number of tubes a worker keeps the sent features and the pending re-id
+# results of
+MAX_TUBE_CNT = 4096
+
+
+def worker_index(cam_id, num_workers):
+    ''' Stable across processes and runs, unlike hash() '''
+    return zlib.crc32(cam_id.encode('utf-8')) % num_workers
+
+
+class TrackerWorker:
+    def __init__(self, index, event_queue, track_labels, attach_labels,
+                    client=None, res_folder=None, queue_size=128):
+        ''' Track the pkts of the cameras assigned to this worker, then
+            forward them (client) and save their meta (res_folder)
+
+        Args:
+        - index: the worker id
+        - event_queue: where the REID events go, read by the ReidCoordinator
+        - track_labels, attach_labels: see DeepSort
+        - client: NetClient of the next hop, None to not upload
+        - res_folder: where to save the meta of each camera, None to not save
+        - queue_size: size of the input queue
+        '''
+        self.index = index
+        self.in_queue = Q(queue_size, policy=POLICY_BLOCK)
+        self.reid_queue = Q(queue_size)
+        self.event_queue = event_queue
+        self.track_labels = track_labels
+        self.attach_labels = attach_labels
+        self.client = client
+        self.res_folder = res_folder
+        self.stopped = Event()
+
+    def run(self):
+        trackers = {}
+        data_savers = {}
+        feature_cnt = OrderedDict()     # (cam_id, tube id): num of features sent
+        reids = OrderedDict()   # (cam_id, tube id): re-id result to mark
+        self.log('start')
+
+        while not self.stopped.is_set():
+            pkt = self.in_queue.read(block=True, timeout=READ_TIMEOUT)
+            if pkt is None:
+                continue
+
+            cid = pkt.cam_id
+            if cid not in trackers:
+                trackers[cid] = DeepSort(
+                    track_labels=self.track_labels,
+                    attach_labels=self.attach_labels
+                )
+                if self.res_folder is not None:
+                    data_savers[cid] = DataWriter(
+                        file_path=self.res_folder + '{}.npy'.format(cid)
+                    )
+                self.log('create tracker for video {}'.format(cid))
+
+            pkt = trackers[cid].update(pkt)
+
+            tubes = []
+            for m in pkt.meta:
+                if 'id' not in m or 'feature' not in m:
+                    continue
+                feature = m['feature']
+                if len(feature):
+                    k = (cid, m['id'])
+                    cnt = feature_cnt.pop(k, 0)
+                    feature_cnt[k] = cnt + 1
+                    if cnt >= MIN_TUBE_DURATION:
+                        feature = None
+                tubes.append((m['id'], m['box'], feature))
+            while len(feature_cnt) > MAX_TUBE_CNT:
+                feature_cnt.popitem(last=False)
+            self.event_queue.write((cid, pkt.frame_id, tubes))
+
+            while True:
+                r = self.reid_queue.read()
+                if r is None:
+                    break
+                if r[2] is None:    # REID needs the features of the tube again
+                    feature_cnt.pop((r[0], r[1]), None)
+                else:
+                    reids[r[0], r[1]] = r[2]
+            while len(reids) > MAX_TUBE_CNT:
+                reids.popitem(last=False)
+            if reids:
+                for m in pkt.meta:
+                    if 'id' in m and (cid, m['id']) in reids:
+                        m['reid'] = reids.pop((cid, m['id']))
+
+            if self.client is not None:
+                self.client.send_data(pkt)
+
+            if cid in data_savers:
+                data_savers[cid].save_data(frame_id=pkt.frame_id, meta=pkt.meta)
+
+        for cid in data_savers:
+            data_savers[cid].save_to_file()
+        self.log('done')
+
+    def stop(self):
+        self.stopped.set()
+
+    def log(self, s):
+        logging.debug('[TrackerWorker-%d] %s' % (self.index, s))
+
+
+class ReidCoordinator(Thread):
+    def __init__(self, topo_path, img_shape, workers, event_queue):
+        ''' Run the REID of all cameras on the events of the TrackerWorkers,
+            and send the re-id results back to the worker of the camera
+
+        Args:
+        - topo_path, img_shape: see REID
+        - workers: the TrackerWorkers
+        - event_queue: the queue the workers write their events to
+        '''
+        Thread.__init__(self)
+        self.daemon = True
+        self.reid = REID(topo_path=topo_path, img_shape=img_shape)
+        self.workers = workers
+        self.event_queue = event_queue
+        self.running = True
+
+    def run(self):
+        while self.running:
+            event = self.event_queue.read(block=True, timeout=READ_TIMEOUT)
+            if event is None:
+                continue
+
+            cid, frame_id, tubes = event
+            res = self.reid.update_tubes(cid, frame_id, tubes)
+            worker = self.workers[worker_index(cid, len(self.workers))]
+            for (tube_id, _, feature), reid in zip(tubes, res):
+                if reid is not None:
+                    worker.reid_queue.write((cid, tube_id, reid))
+                elif feature is None and not self.reid.confirmed(cid, tube_id):
+                    worker.reid_queue.write((cid, tube_id, None))
+
+    def stop(self):
+        self.running = False
+
+    def log(self, s):
+        logging.debug('[ReidCoordinator] %s' % s)
@@ -10,6 +10,7 @@ import logging
 from collections import defaultdict
 
 from server.action_graph import ActGraph  
+from network.utils import READ_TIMEOUT
 
 
 class ReusableForm(Form):
@@ -41,10 +42,9 @@ class WebServer:
 
         def read_im(src):
             while True:
-                im = self.data_queues[src].read()
+                im = self.data_queues[src].read(block=True, timeout=READ_TIMEOUT)
                 if im is None:
                     # print('empty input queue for %s' % src)
-                    sleep(0.04)
                     continue 
 
                 sleep(max(0, self.display_period - (time() - self.last_display_time[src])))